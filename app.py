@@ -1,10 +1,11 @@
 # app.py - 合并版（修复CORS + 集成新预测模块）
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from flask_jwt_extended import (
     JWTManager, create_access_token, 
-    jwt_required, get_jwt_identity
+    jwt_required, get_jwt_identity, get_jwt
 )
+from functools import wraps
 import pymysql
 from datetime import datetime, timedelta
 import json
@@ -72,6 +73,11 @@ def handle_options_request():
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
 app.config['JWT_SECRET_KEY'] = 'jwt-secret-key-change-this'
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=7)
+# 管理员账号（逗号分隔的用户名；登录时写入令牌的 role 声明，/api/admin/* 接口要求 role=admin）
+# 注册接口是开放的，不能默认把某个用户名当作管理员：未设置环境变量时没有任何管理员
+app.config['ADMIN_USERNAMES'] = {u.strip() for u in os.environ.get('ADMIN_USERNAMES', '').split(',') if u.strip()}
+if not app.config['ADMIN_USERNAMES']:
+    print("⚠️ 未设置 ADMIN_USERNAMES 环境变量，/api/admin/* 接口将不可用")
 
 # 数据库配置
 DB_CONFIG = {
@@ -96,6 +102,19 @@ def get_db_connection():
     """获取数据库连接"""
     return pymysql.connect(**DB_CONFIG)
 
+def admin_required():
+    """管理员接口：在 jwt_required 的基础上要求令牌带 role=admin 声明，否则返回403"""
+    def decorator(fn):
+        @wraps(fn)
+        @jwt_required()
+        def wrapper(*args, **kwargs):
+            if get_jwt().get('role') != 'admin':
+                print(f"⛔ 用户 {get_jwt_identity()} 无权访问 {request.path}")
+                return jsonify({'code': 403, 'message': '需要管理员权限', 'data': None}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # -------------------------- 导入蓝图（如果SQLAlchemy可用） --------------------------
 if SQLALCHEMY_AVAILABLE:
     try:
@@ -131,7 +150,10 @@ if SQLALCHEMY_AVAILABLE:
 try:
     from utils.getAllData import *
     from utils.getPublicData import *
+    from utils.homeAggregates import getMaterializedHomeData, startAggregateRefresher
+    from utils.caseTable import CASE_COLUMNS, parseTableParams, queryCases, getHomeCases, getTableStats
     print("✅ 工具函数导入成功")
+    startAggregateRefresher()  # 首页汇总表定时全量重建（启动时启动一次，与爬虫的增量更新用 MySQL 锁互斥）
 except ImportError as e:
     print(f"⚠️  工具函数导入失败: {e}")
 
@@ -242,7 +264,8 @@ def login():
             identity=str(user['user_id']),
             additional_claims={
                 'username': user['username'],
-                'email': user['email']
+                'email': user['email'],
+                'role': 'admin' if user['username'] in app.config['ADMIN_USERNAMES'] else 'user'
             }
         )
         
@@ -481,41 +504,31 @@ def _to_float(value):
     except (TypeError, ValueError):
         return None
 
+def _parse_topk(value):
+    """解析批量预测的 topk：必须是正整数（数字字符串也可以），否则抛出 ValueError"""
+    if isinstance(value, bool):
+        raise ValueError('topk 必须是正整数')
+    try:
+        topk = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('topk 必须是正整数')
+    if topk != value and str(topk) != str(value).strip():
+        raise ValueError('topk 必须是正整数')  # 拒绝 2.5、"3.0" 之类被 int() 截断的值
+    if topk < 1:
+        raise ValueError('topk 必须是正整数')
+    return topk
+
 # -------------------------- 原有业务路由 --------------------------
 @app.route('/getHomeData',methods=['GET','POST'])
 def getHomeData():
     try:
-        pieData = getPieData()
-        configOne,wordData = getConfigOne()
-        casesData = list(getAllCasesData())
-        maxNum,maxType,maxDep,maxHos,maxAge,minAge = getFoundData()
-        boyList,girlList,ratioData = getGenderData()
-        circleData=getCircleData()
-        xData,y1Data,y2Data = getBodyData()
+        # 图表数据读物化汇总表（爬虫写入时增量更新，耗时与类别数有关、与病例数无关）
+        data = getMaterializedHomeData()
+        data['casesData'] = getHomeCases()  # 首页列表只展示前 HOME_CASES_LIMIT 条（完整列表走 /tableData 分页）
         return jsonify({
             'message':'success',
             'code':200,
-            'data':{
-                'pieData':pieData,
-                'configOne':configOne,
-                'casesData':casesData,
-                'maxNum':maxNum,
-                'maxType': maxType,
-                'maxDep': maxDep,
-                'maxHos': maxHos,
-                'maxAge': maxAge,
-                'minAge': minAge,
-                'boyList':boyList,
-                'girlList':girlList,
-                'ratioData':ratioData,
-                'circleData':circleData,
-                'wordData':wordData,
-                'lastData':{
-                    'xData':xData,
-                    'y1Data':y1Data,
-                    'y2Data':y2Data
-                }
-            }
+            'data':data
         })
     except Exception as e:
         print(f"❌ 获取首页数据失败: {e}")
@@ -525,18 +538,39 @@ def getHomeData():
 
 @app.route('/tableData', methods=['GET', 'POST', 'OPTIONS'])
 def tableData():
-    """获取表格数据（兼容废弃版前端）"""
+    """
+    病例列表（分页 + 筛选 + 排序）
+
+    请求参数（query string 或 JSON）:
+        fields=type,gender,age   只返回这些列（默认全部）
+        sort=age&order=desc      排序（id / age / height / weight / time / type / department / hospital）
+        limit=20&cursor=...      每页条数；下一页传上一页返回的 nextCursor
+        type / department / hospital / gender / ageMin / ageMax   筛选
+        q=头痛                    病情描述全文检索
+        all=1                    旧版全量导出（{"resultData": [...]}，仅供显式指定的旧工具使用）
+    响应: {"code": 200, "message": "success", "data": {"rows": [...], "nextCursor": "...", "hasMore": true, "total": 1234}}
+    """
     if request.method == 'OPTIONS':
         return '', 200
-    
+
+    args = request.args.to_dict()
+    args.update(request.get_json(silent=True) or {})
     try:
-        tableDataList = getAllCasesData()
-        resultData = [x[1:] for x in tableDataList]
+        if str(args.get('all', '')).lower() in ('1', 'true'):
+            tableDataList = getAllCasesData()
+            resultData = [x[1:len(CASE_COLUMNS)] for x in tableDataList]  # 不含迁移新增的类型化列
+            return jsonify({
+                'message': 'success', 
+                'code': 200, 
+                'data': {'resultData': resultData}
+            })
         return jsonify({
-            'message': 'success', 
-            'code': 200, 
-            'data': {'resultData': resultData}
+            'message': 'success',
+            'code': 200,
+            'data': queryCases(**parseTableParams(args))
         })
+    except ValueError as e:
+        return jsonify({'message': str(e), 'code': 400}), 400
     except Exception as e:
         print(f"❌ 获取表格数据失败: {e}")
         return jsonify({
@@ -544,6 +578,23 @@ def tableData():
             'code': 500
         }), 500
 
+@app.route('/tableData/stats', methods=['GET'])
+def tableDataStats():
+    """
+    病例数据页的统计卡片和分析图表（全表统计，在服务端按列聚合，前端不必下载全表）
+
+    响应: {"code": 200, "message": "success", "data": {"total": ..., "maleCount": ..., "duration": {...}, ...}}
+    """
+    try:
+        return jsonify({
+            'message': 'success',
+            'code': 200,
+            'data': getTableStats()
+        })
+    except Exception as e:
+        print(f"❌ 获取病例统计失败: {e}")
+        return jsonify({'message': f'获取病例统计失败: {str(e)}', 'code': 500}), 500
+
 # ==================== 🎯 新版症状预测接口（已替换） ====================
 # ==================== 🎯 新版症状预测接口（多候选显示） ====================
 @app.route('/submitModel', methods=['POST'])
@@ -561,14 +612,17 @@ def submitModel():
                 {"name": "流感", "category": "呼吸内科", "score": 0.4394, "symptoms": ["发热", "咳嗽", "乏力"]}
             ],
             "query": "头痛 发热 咳嗽",
-            "count": 2
+            "count": 2,
+            "index_version": "5b396a6601c7"
         }
     }
     """
     try:
         # 动态导入
         try:
-            from disease_predictor import predict_disease
+            from disease_predictor import predict_disease, enable_batching, start_index_watcher, index_version
+            enable_batching()  # 并发请求合并为一次BERT前向传播（可重复调用）
+            start_index_watcher()  # 索引重建后自动热加载（可重复调用）
         except ImportError as e:
             print(f"❌ 无法导入 disease_predictor: {e}")
             return jsonify({
@@ -626,7 +680,8 @@ def submitModel():
                 'data': {
                     'results': top5,
                     'query': content,
-                    'count': len(top5)
+                    'count': len(top5),
+                    'index_version': (index_version() or {}).get('version')
                 }
             })
             
@@ -640,7 +695,8 @@ def submitModel():
                 'data': {
                     'results': [],
                     'query': content,
-                    'count': 0
+                    'count': 0,
+                    'index_version': (index_version() or {}).get('version')
                 }
             }), 200
         
@@ -663,6 +719,99 @@ def submitModel():
         }), 500
 
 
+@app.route('/submitModel/batch', methods=['POST'])
+def submitModelBatch():
+    """
+    批量症状预测（夜间重新分诊等离线任务）
+
+    请求（二选一）：
+        1. JSON: {"queries": ["头痛 发热", "腹痛 呕吐"], "topk": 5}
+           响应: {"code": 200, "message": "success", "data": {"results": [[...], [...]], "count": 2}}
+        2. JSONL（Content-Type: application/x-ndjson），每行 {"id": 1, "content": "头痛 发热"}
+           响应同样为JSONL，逐行返回输入记录 + "results" 字段（边读边算边返回，请求体和结果都不整批放在内存中）；
+           出错的行或批次返回输入记录 + "error" 字段，后续行继续处理
+    """
+    try:
+        from disease_predictor import predict_disease_batch, predict_jsonl
+    except ImportError as e:
+        print(f"❌ 无法导入 disease_predictor: {e}")
+        return jsonify({'code': 500, 'message': '预测模块未安装', 'data': {'results': [], 'count': 0}}), 500
+
+    try:
+        topk = _parse_topk(request.args.get('topk', 5))
+    except ValueError as e:
+        return jsonify({'code': 400, 'message': str(e), 'data': {'results': [], 'count': 0}}), 400
+
+    try:
+        # ===== JSONL流式模式 =====
+        if not request.is_json:
+            def generate():
+                # 逐行读取请求体（不整体读入内存）；响应头发出后出错只能写入一条错误记录，不能再返回500
+                try:
+                    for line in predict_jsonl(request.stream, topk=topk, min_score=0.25, lexical='wexact'):
+                        yield line + '\n'
+                except Exception as e:
+                    print(f"❌ 批量预测中断: {e}")
+                    yield json.dumps({'error': f'批量预测中断: {str(e)}'}, ensure_ascii=False) + '\n'
+
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        # ===== JSON模式 =====
+        body = request.get_json(silent=True) or {}
+        queries = body.get('queries') or []
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'code': 400, 'message': 'queries 不能为空', 'data': {'results': [], 'count': 0}}), 400
+        try:
+            topk = _parse_topk(body.get('topk', topk))
+        except ValueError as e:
+            return jsonify({'code': 400, 'message': str(e), 'data': {'results': [], 'count': 0}}), 400
+
+        results = predict_disease_batch(
+            [str(q) for q in queries],
+            topk=topk,
+            min_score=0.25,
+            lexical='wexact'
+        )
+        return jsonify({
+            'code': 200,
+            'message': 'success',
+            'data': {'results': results, 'count': len(results)}
+        })
+
+    except FileNotFoundError as e:
+        print(f"❌ 模型文件缺失: {e}")
+        return jsonify({'code': 500, 'message': '模型文件缺失', 'data': {'results': [], 'count': 0}}), 500
+
+    except Exception as e:
+        print(f"❌ 批量预测失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'code': 500, 'message': f'批量预测失败: {str(e)}', 'data': {'results': [], 'count': 0}}), 500
+
+
+@app.route('/api/admin/reloadIndex', methods=['POST'])
+@admin_required()
+def reloadIndex():
+    """
+    重新加载疾病索引（重建索引后无需重启服务，仅管理员可调用）
+
+    请求: {"force": false}   force=true 时内容未变化也重新加载
+    响应: {"code": 200, "message": "success", "data": {"reloaded": true, "version": {...}, "previous": {...}}}
+
+    说明：新索引在本请求中加载完成后原子切换，进行中的预测请求继续使用旧版本
+    """
+    try:
+        from disease_predictor import reload_index
+    except ImportError as e:
+        print(f"❌ 无法导入 disease_predictor: {e}")
+        return jsonify({'code': 500, 'message': '预测模块未安装', 'data': None}), 500
+
+    body = request.get_json(silent=True) or {}
+    print(f"🔄 用户 {get_jwt_identity()} 请求重新加载索引")
+    result = reload_index(force=bool(body.get('force', False)))
+    return jsonify({'code': 200, 'message': result['message'], 'data': result})
+
+
 # -------------------------- 测试路由 --------------------------
 @app.route('/api/test', methods=['GET'])
 def test():
@@ -680,16 +829,24 @@ def hello_world():
 @app.route('/api/health', methods=['GET'])
 def health_check():
     # 检查预测模块状态
+    query_cache = None
+    batching = None
+    index = None
     try:
-        from disease_predictor import predict_disease
+        from disease_predictor import predict_disease, query_cache_stats, batching_stats, index_version
         predictor_status = '✅ 已加载'
+        query_cache = query_cache_stats()  # 查询缓存命中/未命中/淘汰统计
+        batching = batching_stats()  # 微批处理统计（未开启时为null）
+        index = index_version()  # 当前生效的索引版本（尚未加载时为null）
     except ImportError:
         predictor_status = '❌ 未安装'
     
     # 检查模型文件
     import os
-    model_path = os.path.join('models', 'medical_biencoder', 'biencoder_index.npz')
-    model_status = '✅ 已训练' if os.path.exists(model_path) else '❌ 未训练'
+    model_dir = os.path.join('models', 'medical_biencoder')
+    model_exists = (os.path.isdir(os.path.join(model_dir, 'biencoder_index'))  # 内存映射索引目录（默认构建产物）
+                    or os.path.exists(os.path.join(model_dir, 'biencoder_index.npz')))  # 旧的 .npz 索引
+    model_status = '✅ 已训练' if model_exists else '❌ 未训练'
     
     return jsonify({
         'status': 'healthy', 
@@ -697,7 +854,10 @@ def health_check():
         'auth_mode': 'plaintext',
         'database': 'pymysql',
         'predictor_module': predictor_status,
-        'model_file': model_status
+        'model_file': model_status,
+        'query_cache': query_cache,
+        'batching': batching,
+        'index': index
     }), 200
 
 # -------------------------- 启动应用 --------------------------
@@ -0,0 +1,390 @@
+"""
+================================================================================
+医疗疾病预测系统 - 离线检索评估与延迟基准测试
+================================================================================
+功能模块：
+1. 固定的标注查询集（症状文本 → 期望疾病），覆盖单症状和多症状查询
+2. 检索质量：Recall@1/5/10、MRR、nDCG@10
+   - semantic：纯语义排序（查询向量与全部疾病向量的余弦相似度）
+   - final：predict_disease 的最终排序（向量召回 + 词面匹配 + 规则引擎）
+3. 延迟与吞吐：p50/p95/p99 延迟、QPS，按 查询编码器 × 推理后端 × 缓存设置 分别统计
+4. JSON报告；指定上一次的报告作为基线时逐项对比，指标下降超过阈值时标记为回归
+
+查询集格式（JSONL，每行一个查询）：
+    {"query": "发热 咳嗽 咽痛", "expected": ["感冒", "流行性感冒"], "kind": "multi"}
+    - expected 中任意一个疾病出现即视为命中（同一组症状常有多个合理答案）
+    - kind: single（单症状）/ multi（多症状），分别统计
+    - 仓库自带 benchmark_queries.jsonl（常见病，人工整理）；
+      --make_queries N 可从当前索引抽样生成更大的查询集（期望疾病为症状来源的疾病）
+
+用法：
+    python benchmark.py
+    python benchmark.py --backends torch onnx-int8 --out reports/bench.json
+    python benchmark.py --encoders teacher student
+    python benchmark.py --baseline reports/last.json --fail_on_regression
+    python benchmark.py --make_queries 1000 --queries sampled_queries.jsonl
+
+作者：Your Name
+日期：2024-01-XX
+================================================================================
+"""
+
+# ==================== 第1部分：依赖导入 ====================
+import os  # 文件路径操作
+import sys  # 退出码
+import io  # 屏蔽预测过程的调试输出
+import json  # 查询集和报告读写
+import time  # 计时
+import random  # 抽样生成查询集
+import hashlib  # 查询集校验和
+import argparse  # 命令行参数解析
+import subprocess  # 记录当前git提交
+import contextlib  # 重定向标准输出
+import itertools  # 编码器 × 后端组合
+from datetime import datetime  # 报告时间
+import numpy as np  # 数值计算
+
+import disease_predictor as dp  # 被测的预测模块
+from embedding_compress import project_queries  # 降维索引的查询投影
+from vector_index import select_topk  # Top-K选择
+
+# ==================== 第2部分：配置 ====================
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+QUERIES_PATH = os.path.join(SCRIPT_DIR, 'benchmark_queries.jsonl')  # 默认查询集
+REPORT_PATH = os.path.join(SCRIPT_DIR, 'benchmark_report.json')  # 默认报告路径
+
+KS = (1, 5, 10)  # Recall@K
+NDCG_K = 10  # nDCG@K
+TOPK = 10  # 评估时每个查询取的结果数
+
+# predict_disease 参数（与 app.py /submitModel 一致）
+MIN_SCORE = 0.25
+LEXICAL = 'wexact'
+
+CACHE_MODES = ('cold', 'warm')  # cold：关闭查询缓存；warm：缓存预热后再计时
+QUALITY_TOLERANCE = 0.01  # 质量指标下降超过该值视为回归
+LATENCY_TOLERANCE = 0.20  # p95延迟上升超过20%视为回归
+
+# ==================== 第3部分：查询集 ====================
+
+def load_queries(path):
+    """
+    读取标注查询集
+
+    返回：
+        list[dict]: [{'query', 'expected': set, 'kind'}, ...]
+    """
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            expected = item['expected']
+            expected = [expected] if isinstance(expected, str) else expected
+            kind = item.get('kind') or ('single' if len(item['query'].split()) == 1 else 'multi')
+            queries.append({'query': item['query'], 'expected': set(expected), 'kind': kind})
+    return queries
+
+def make_queries(n, seed=42, single_ratio=0.3):
+    """
+    从当前索引抽样生成标注查询集
+
+    参数：
+        n (int): 查询数
+        seed (int): 随机种子（固定后每次生成的查询集相同）
+        single_ratio (float): 单症状查询的比例
+
+    返回：
+        list[dict]: 查询集（期望疾病 = 症状来源的疾病；多症状取2~4个症状）
+    """
+    dp.load_model()
+    ci = dp._compiled_index
+    rng = random.Random(seed)
+    pool = [i for i, s in enumerate(ci['symptoms']) if len(s) >= 2]
+    queries = []
+    for i in rng.sample(pool, min(n, len(pool))):
+        symps = ci['symptoms'][i]
+        if rng.random() < single_ratio:
+            picked, kind = [rng.choice(symps)], 'single'
+        else:
+            picked, kind = rng.sample(symps, min(len(symps), rng.randint(2, 4))), 'multi'
+        queries.append({'query': ' '.join(picked), 'expected': [ci['names'][i]], 'kind': kind})
+    return queries
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# ==================== 第4部分：检索质量 ====================
+
+def rank_metrics(ranked, expected):
+    """
+    单个查询的排序指标
+
+    参数：
+        ranked (list[str]): 按得分排序的疾病名称
+        expected (set[str]): 期望疾病（任意一个命中即可）
+
+    返回：
+        dict: recall@1/5/10（Top-K内是否命中）、mrr（第一个命中位置的倒数）、
+              ndcg@10（二值相关性，理想排序为期望疾病全部排在最前）
+    """
+    rel = [name in expected for name in ranked]
+    first = next((i for i, r in enumerate(rel) if r), None)
+    out = {f'recall@{k}': float(first is not None and first < k) for k in KS}
+    out['mrr'] = 1.0 / (first + 1) if first is not None else 0.0
+    dcg = sum(1.0 / np.log2(i + 2) for i, r in enumerate(rel[:NDCG_K]) if r)
+    idcg = sum(1.0 / np.log2(i + 2) for i in range(min(len(expected), NDCG_K)))
+    out[f'ndcg@{NDCG_K}'] = dcg / idcg if idcg else 0.0
+    return out
+
+def _mean_metrics(rows):
+    if not rows:
+        return {}
+    return {k: round(float(np.mean([r[k] for r in rows])), 4) for k in rows[0]}
+
+def semantic_ranking(tok, enc, ci, query):
+    """纯语义排序：查询向量与全部疾病向量的余弦相似度Top-K（不经过向量召回和规则引擎）"""
+    wrapped = dp.canonical_query(query.split())
+    q = project_queries(dp._encode_texts(tok, enc, [wrapped])[0], ci['projection'])
+    order = select_topk(ci['embeddings'] @ q, TOPK)
+    return [ci['names'][i] for i in order]
+
+def final_ranking(query, min_score=MIN_SCORE, lexical=LEXICAL):
+    """最终排序：predict_disease 的输出（屏蔽其调试打印）"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = dp.predict_disease(query, topk=TOPK, min_score=min_score, lexical=lexical, return_dict=True)
+    return [r['name'] for r in results]
+
+def evaluate_quality(queries, min_score=MIN_SCORE, lexical=LEXICAL):
+    """
+    评估当前后端的检索质量
+
+    返回：
+        dict: {'semantic': {'all': {...}, 'single': {...}, 'multi': {...}}, 'final': {...}}
+    """
+    tok, enc, _ = dp.load_model()
+    ci = dp._compiled_index
+    per = {'semantic': [], 'final': []}
+    for item in queries:
+        per['semantic'].append((item['kind'], rank_metrics(semantic_ranking(tok, enc, ci, item['query']), item['expected'])))
+        per['final'].append((item['kind'], rank_metrics(final_ranking(item['query'], min_score, lexical), item['expected'])))
+
+    report = {}
+    for mode, rows in per.items():
+        report[mode] = {'all': _mean_metrics([m for _, m in rows])}
+        for kind in sorted({k for k, _ in rows}):
+            report[mode][kind] = _mean_metrics([m for k, m in rows if k == kind])
+    return report
+
+def missing_labels(queries):
+    """查询集中在当前索引里找不到的期望疾病名称（查询集需要按索引修正）"""
+    names = set(dp._compiled_index['names'])
+    return sorted({e for item in queries for e in item['expected'] if e not in names})
+
+# ==================== 第5部分：延迟与吞吐 ====================
+
+def _latency_stats(samples_ms, total_s):
+    a = np.asarray(samples_ms)
+    return {
+        'n': int(len(a)),
+        'p50_ms': round(float(np.percentile(a, 50)), 3),
+        'p95_ms': round(float(np.percentile(a, 95)), 3),
+        'p99_ms': round(float(np.percentile(a, 99)), 3),
+        'mean_ms': round(float(a.mean()), 3),
+        'qps': round(len(a) / max(total_s, 1e-9), 1),
+    }
+
+def measure_latency(queries, cache_mode, repeat=3, min_score=MIN_SCORE, lexical=LEXICAL):
+    """
+    测量 predict_disease 的单查询延迟
+
+    参数：
+        cache_mode (str): 'cold' 关闭查询向量/结果缓存（每次完整计算）；
+                          'warm' 开启缓存并预热一遍后计时（重复查询的线上场景）
+        repeat (int): 查询集重复次数
+    """
+    texts = [item['query'] for item in queries]
+    if cache_mode == 'cold':
+        dp.configure_query_cache(max_size=0)
+    else:
+        dp.configure_query_cache(max_size=dp.QUERY_CACHE_SIZE, cache_results=True)
+        for t in texts:
+            final_ranking(t, min_score, lexical)
+
+    samples = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        t_start = time.perf_counter()
+        for _ in range(repeat):
+            for t in texts:
+                t0 = time.perf_counter()
+                dp.predict_disease(t, topk=TOPK, min_score=min_score, lexical=lexical, return_dict=True)
+                samples.append((time.perf_counter() - t0) * 1000)
+        total = time.perf_counter() - t_start
+    return _latency_stats(samples, total)
+
+def measure_batch_throughput(queries, repeat=3, min_score=MIN_SCORE, lexical=LEXICAL):
+    """predict_disease_batch 的吞吐（不使用缓存）"""
+    texts = [item['query'] for item in queries] * repeat
+    dp.predict_disease_batch(texts[:dp.BATCH_PREDICT_SIZE], topk=TOPK, min_score=min_score, lexical=lexical)  # 预热
+    t0 = time.perf_counter()
+    dp.predict_disease_batch(texts, topk=TOPK, min_score=min_score, lexical=lexical)
+    total = time.perf_counter() - t0
+    return {'n': len(texts), 'qps': round(len(texts) / max(total, 1e-9), 1)}
+
+# ==================== 第6部分：运行与报告 ====================
+
+def _run_name(backend, encoder):
+    """报告中的配置名：教师模型只写后端（与旧报告兼容），学生模型为 后端/student"""
+    return backend if encoder == 'teacher' else f'{backend}/{encoder}'
+
+def run_benchmark(queries, backends=('torch',), repeat=3, min_score=MIN_SCORE, lexical=LEXICAL, encoders=('teacher',)):
+    """
+    按 查询编码器 × 后端 依次评估质量和延迟
+
+    返回：
+        dict: {配置名: {'quality': {...}, 'latency': {'cold': {...}, 'warm': {...}}, 'batch': {...}}}
+              配置不可用时为 {'error': 原因}
+    """
+    results = {}
+    saved = (dp._embedding_cache.max_size, dp.CACHE_RESULTS)
+    try:
+        for encoder, backend in itertools.product(encoders, backends):
+            name = _run_name(backend, encoder)
+            print(f'🔧 配置: {name}')
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    dp.load_model(backend, encoder)
+            except (FileNotFoundError, ImportError, ValueError) as e:
+                print(f'   ⚠️ 不可用: {e}')
+                results[name] = {'error': str(e)}
+                continue
+
+            dp.configure_query_cache(max_size=0)
+            entry = {'quality': evaluate_quality(queries, min_score, lexical), 'latency': {}}
+            for mode in CACHE_MODES:
+                entry['latency'][mode] = measure_latency(queries, mode, repeat, min_score, lexical)
+            entry['batch'] = measure_batch_throughput(queries, repeat, min_score, lexical)
+            results[name] = entry
+            _print_backend(name, entry)
+    finally:
+        dp.configure_query_cache(max_size=saved[0], cache_results=saved[1])
+    return results
+
+def _print_backend(backend, entry):
+    for mode in ('semantic', 'final'):
+        m = entry['quality'][mode]['all']
+        print(f"   📊 {mode:8s} R@1 {m['recall@1']:.3f}  R@5 {m['recall@5']:.3f}  R@10 {m['recall@10']:.3f}  "
+              f"MRR {m['mrr']:.3f}  nDCG@{NDCG_K} {m[f'ndcg@{NDCG_K}']:.3f}")
+    for mode, lat in entry['latency'].items():
+        print(f"   ⏱️ {mode:5s} p50 {lat['p50_ms']:.2f}ms  p95 {lat['p95_ms']:.2f}ms  "
+              f"p99 {lat['p99_ms']:.2f}ms  {lat['qps']:.1f} q/s")
+    print(f"   ⏱️ batch {entry['batch']['qps']:.1f} q/s")
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare_reports(current, baseline, quality_tol=QUALITY_TOLERANCE, latency_tol=LATENCY_TOLERANCE):
+    """
+    与基线报告逐项对比
+
+    返回：
+        list[str]: 回归项说明（质量指标下降超过 quality_tol，或p95延迟上升超过 latency_tol）
+    """
+    regressions = []
+    for backend, entry in current['backends'].items():
+        base = baseline.get('backends', {}).get(backend)
+        if not base or 'error' in entry or 'error' in base:
+            continue
+        for mode in ('semantic', 'final'):
+            for kind, metrics in entry['quality'][mode].items():
+                for key, value in metrics.items():
+                    old = base['quality'].get(mode, {}).get(kind, {}).get(key)
+                    if old is not None and value < old - quality_tol:
+                        regressions.append(f'{backend} {mode}/{kind} {key}: {old:.4f} → {value:.4f}')
+        for mode, lat in entry['latency'].items():
+            old = base.get('latency', {}).get(mode, {}).get('p95_ms')
+            if old and lat['p95_ms'] > old * (1 + latency_tol):
+                regressions.append(f"{backend} {mode} p95: {old:.2f}ms → {lat['p95_ms']:.2f}ms")
+    return regressions
+
+# ==================== 第7部分：命令行入口 ====================
+
+def main():
+    """
+    用法见文件开头
+    """
+    ap = argparse.ArgumentParser(description='疾病预测离线评估与延迟基准测试')
+    ap.add_argument('--queries', type=str, default=QUERIES_PATH, help='标注查询集（JSONL）')
+    ap.add_argument('--make_queries', type=int, default=None,
+                    help='从当前索引抽样生成N条查询写入 --queries 指定的文件后退出')
+    ap.add_argument('--backends', nargs='+', default=['torch'], choices=list(dp.BACKENDS), help='要测试的推理后端')
+    ap.add_argument('--encoders', nargs='+', default=['teacher'], choices=list(dp.QUERY_ENCODERS),
+                    help='要测试的查询编码器（student 为蒸馏的小模型）')
+    ap.add_argument('--repeat', type=int, default=3, help='延迟测试时查询集重复次数')
+    ap.add_argument('--min_score', type=float, default=MIN_SCORE, help='predict_disease 的最低分数阈值')
+    ap.add_argument('--lexical', type=str, default=LEXICAL, choices=['fuzzy', 'exact', 'wexact', 'none'],
+                    help='predict_disease 的词面匹配模式')
+    ap.add_argument('--out', type=str, default=REPORT_PATH, help='JSON报告输出路径')
+    ap.add_argument('--baseline', type=str, default=None, help='上一次的JSON报告（用于对比）')
+    ap.add_argument('--fail_on_regression', action='store_true', help='存在回归时以退出码1结束')
+    args = ap.parse_args()
+
+    if args.make_queries:
+        queries = make_queries(args.make_queries)
+        with open(args.queries, 'w', encoding='utf-8') as f:
+            for item in queries:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        print(f'✅ 已生成 {len(queries)} 条查询: {args.queries}')
+        return
+
+    queries = load_queries(args.queries)
+    print(f"📂 查询集: {args.queries}（{len(queries)} 条，单症状 "
+          f"{sum(q['kind'] == 'single' for q in queries)} 条）")
+
+    backends = run_benchmark(queries, args.backends, args.repeat, args.min_score, args.lexical, args.encoders)
+    missing = missing_labels(queries) if dp._compiled_index is not None else []
+    if missing:
+        print(f"⚠️ {len(missing)} 个期望疾病不在当前索引中（相关查询无法命中）: {'、'.join(missing[:20])}")
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'index': dp.index_version(),
+        'queries': {'path': os.path.abspath(args.queries), 'sha1': _file_sha1(args.queries),
+                    'n': len(queries), 'missing_labels': missing},
+        'params': {'topk': TOPK, 'min_score': args.min_score, 'lexical': args.lexical,
+                   'repeat': args.repeat, 'candidate_k': dp.CANDIDATE_K},
+        'backends': backends,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'✅ 报告已保存到: {args.out}')
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('queries', {}).get('sha1') != report['queries']['sha1']:
+            print('⚠️ 基线使用的查询集不同，对比结果仅供参考')
+        regressions = compare_reports(report, baseline)
+        if regressions:
+            print(f'❌ 发现 {len(regressions)} 项回归:')
+            for r in regressions:
+                print(f'   - {r}')
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print('✅ 与基线相比没有回归')
+
+# ==================== 第8部分：程序入口 ====================
+if __name__ == '__main__':
+    main()
@@ -29,12 +29,24 @@ import os  # 文件路径操作
 import sys  # 系统参数（未使用，保留兼容性）
 import json  # JSON数据解析（症状列表）
 import argparse  # 命令行参数解析
+import threading  # 线程锁（缓存在Flask多线程下共享）
+import time  # 缓存过期时间
+import itertools  # 编译代数计数器
+import hashlib  # 索引内容校验和（热加载版本号）
+from datetime import datetime  # 索引加载时间
+from collections import OrderedDict  # LRU缓存
+import queue  # 微批处理请求队列
+from concurrent.futures import Future  # 微批处理结果回传
 import numpy as np  # 数值计算（向量操作）
+from scipy import sparse  # 稀疏矩阵（疾病×症状词 倒排矩阵）
 import torch  # PyTorch深度学习框架
 from transformers import (
     BertTokenizer,  # BERT分词器
     BertModel  # BERT预训练模型
 )
+from index_store import open_index, read_version_marker, store_build_id, version_marker_path  # 内存映射索引目录（兼容旧的 .npz）
+from embedding_compress import open_embeddings, load_projection, project_queries  # 降维/量化索引
+from vector_index import load_vector_index, vector_index_build, select_topk, META_NAME as VECTOR_INDEX_NAME  # 向量召回索引、Top-K选择
 
 # ==================== 第2部分：路径配置 ====================
 """
@@ -71,6 +83,37 @@ MODEL_DIR = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'biencoder
 # 索引文件路径
 INDEX_PATH = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'biencoder_index.npz')
 
+# 内存映射索引目录（index_store.py 格式，存在时优先使用；多进程共享页缓存，启动无需解压）
+INDEX_STORE_PATH = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'biencoder_index')
+
+# 向量召回索引（机器学习.py --build_index 或 vector_index.py 生成；不存在时对全部疾病打分）
+VECTOR_INDEX_PATH = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', VECTOR_INDEX_NAME)
+
+# 规则文件路径（罕见病/常见病/专科降权等规则，修改后无需重启即可生效）
+RULES_PATH = os.path.join(PROJECT_ROOT, 'disease_rules.json')
+
+# ONNX导出目录（python disease_predictor.py --export_onnx 生成）
+ONNX_DIR = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'onnx')
+ONNX_PATHS = {
+    'onnx': os.path.join(ONNX_DIR, 'biencoder.onnx'),  # FP32
+    'onnx-int8': os.path.join(ONNX_DIR, 'biencoder.int8.onnx'),  # 动态INT8量化
+}
+
+# 推理后端：torch / onnx / onnx-int8（CPU服务器推荐 onnx-int8）
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+BACKEND = os.environ.get('PREDICTOR_BACKEND', 'torch')
+
+# 学生查询编码器（python 机器学习.py --distill 生成，层数少、只用于编码查询；文档向量仍来自 MODEL_DIR 的模型）
+STUDENT_DIR = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'student')
+STUDENT_ONNX_PATHS = {
+    'onnx': os.path.join(ONNX_DIR, 'student.onnx'),
+    'onnx-int8': os.path.join(ONNX_DIR, 'student.int8.onnx'),
+}
+
+# 查询编码器：teacher（微调后的完整模型）/ student（蒸馏的小模型，延迟更低）
+QUERY_ENCODERS = ('teacher', 'student')
+QUERY_ENCODER = os.environ.get('PREDICTOR_QUERY_ENCODER', 'teacher')
+
 
 # ==================== 第3部分：超参数配置 ====================
 """
@@ -83,6 +126,25 @@ INDEX_PATH = os.path.join(PROJECT_ROOT, 'models', 'medical_biencoder', 'biencode
 MAX_LEN = 128  # BERT最大输入长度（token数）
 FIELD_TAGS = ['[SYM]', '[DESC]', '[CAUSE]', '[CAT]']  # 症状、描述、病因、科室标记
 
+# 查询缓存配置（可通过 configure_query_cache() 在运行时修改）
+QUERY_CACHE_SIZE = 2048  # 最多缓存的查询数（LRU淘汰）
+QUERY_CACHE_TTL = 3600  # 缓存有效期（秒），0表示永不过期
+CACHE_RESULTS = True  # 是否同时缓存最终Top-K结果
+
+# 微批处理配置（并发请求合并为一次BERT前向传播，见 enable_batching()）
+BATCHING_ENABLED = False  # 默认关闭（命令行单次查询不需要）
+BATCH_MAX_SIZE = 32  # 每批最多合并的查询数
+BATCH_MAX_WAIT_MS = 5.0  # 第一个查询到达后最多等待的毫秒数（延迟上限）
+
+# ===== 批量预测配置 =====
+BATCH_PREDICT_SIZE = 64  # 批量预测每批的查询数（一次编码 + 一次 B×N 矩阵乘法）
+
+# ===== 候选召回配置 =====
+CANDIDATE_K = 300  # 近似向量索引（ivf/hnsw）召回的候选数，另外并入有词面命中的疾病（见 _candidate_rows）
+
+# ===== 索引热加载配置 =====
+INDEX_WATCH_INTERVAL = 10.0  # 检查索引文件变化的间隔（秒），见 start_index_watcher()
+
 # ==================== 第4部分：全局缓存 ====================
 """
 全局缓存机制：
@@ -94,10 +156,28 @@ FIELD_TAGS = ['[SYM]', '[DESC]', '[CAUSE]', '[CAT]']  # 症状、描述、病因
 - _tokenizer: BERT分词器
 - _model: BERT模型
 - _index_data: 疾病索引数据（NumPy数组）
+- _compiled_index: 预编译索引（解析后的症状列表、词ID、IDF向量，见 _compile_index）
+- 编译后的规则数组保存在预编译索引自身的 ci['rules'] 中（见 get_rules）
+- _vector_index: 向量召回索引（见 vector_index.py，未构建时为None）
+
+索引热加载（见 reload_index）：
+- 新版本在后台加载、预编译完成后，一次赋值替换 _compiled_index
+- 预测函数在开始时取一次 _compiled_index 的引用，向量索引和版本信息都在其中，
+  替换发生时进行中的请求继续使用旧版本直到结束
 """
 _tokenizer = None  # 分词器缓存
-_model = None  # 模型缓存
+_model = None  # 模型缓存（torch BertModel 或 OnnxEncoder）
+_backend = None  # 当前模型对应的推理后端
+_encoder = None  # 当前查询编码器（teacher / student）
 _index_data = None  # 索引数据缓存
+_compiled_index = None  # 预编译索引缓存
+_rules_lock = threading.Lock()  # 规则编译锁（同一索引、同一版规则文件只编译一次）
+_last_good_rules = None  # 最近一次编译成功的规则JSON（规则文件损坏时对新索引重新编译）
+_vector_index = None  # 向量召回索引缓存
+_generation = itertools.count(1)  # 索引/规则的编译代数（用作结果缓存key，旧版本结果自动失效）
+_reload_lock = threading.Lock()  # 同一时间只允许一次索引重新加载
+_watcher = None  # 索引文件监视线程 (thread, stop_event)
+_watcher_lock = threading.Lock()
 
 # ==================== 第5部分：工具函数 ====================
 
@@ -350,16 +430,723 @@ def _lexical_score(query_tokens, doc_symptoms, mode='fuzzy', idf=None):
     union = len(q_ngrams | d_ngrams)  # 并集大小
     return (inter / union) if union > 0 else 0.0
 
+def _compile_index(data):
+    """
+    预编译疾病索引（只在加载时执行一次）
+
+    参数：
+        data: open_index 返回的索引对象（IndexStore 或 NpzFile，包含embeddings、names、symptoms等）
+
+    返回：
+        dict: 内存索引，包含：
+            - embeddings: (N, 768) 疾病向量（降维索引为 (N, k)；float16/int8 存储时为 CompressedEmbeddings）
+            - projection: (d, k) 查询需施加的PCA投影矩阵，未降维时为None
+            - names / categories: list[str] 疾病名称 / 科室
+            - symptoms: list[list[str]] 已解析的症状列表
+            - symptom_sets: list[frozenset] 症状集合（规则引擎直接使用，已去掉空字符串）
+            - vocab: dict 症状词 → 整数ID
+            - term_ids: list[np.ndarray] 每个疾病的症状词ID（去重、升序，不含空字符串）
+            - idf: dict 症状词 → IDF值（兼容 _lexical_score）
+            - idf_vec: (V,) 按词ID排列的IDF向量（已截断为非负）
+
+    作用：
+        原来每次 predict_disease 都要对 8.8k 条症状做 json.loads 并重建IDF字典，
+        预编译后单次请求的开销只与查询词数量相关
+    """
+    names = [str(n) for n in data['names']]
+    cats = [str(c) for c in data['categories']]
+    symps = [json.loads(s) for s in data['symptoms']]
+    symp_sets = [frozenset(t for t in s if t) for s in symps]  # 与 _lexical_score 一致：空字符串不算症状词
+
+    # 1. IDF字典（与原逻辑一致：{str(词): float(IDF)}）
+    idf = {}
+    if 'idf_terms' in data and 'idf_vals' in data:
+        idf = {str(k): float(v) for k, v in zip(data['idf_terms'], data['idf_vals'])}
+
+    # 2. 症状词表：IDF词在前，其余症状词依次追加
+    vocab = {}
+    for t in idf:
+        vocab.setdefault(t, len(vocab))
+    for s in symps:
+        for t in s:
+            if t:
+                vocab.setdefault(t, len(vocab))
+
+    # 3. 每个疾病的症状词ID
+    term_ids = [
+        np.array(sorted(vocab[t] for t in st), dtype=np.int32)
+        for st in symp_sets
+    ]
+
+    # 4. 稠密IDF向量（与 wsum 中的 max(0, idf.get(t, 0)) 保持一致）
+    idf_vec = np.zeros(len(vocab), dtype=np.float64)
+    for t, v in idf.items():
+        idf_vec[vocab[t]] = max(0.0, v)
+
+    # 5. 疾病×症状词 CSR矩阵（exact/wexact/完全匹配计数都由矩阵-向量乘法得到）
+    term_matrix = _binary_csr(term_ids, len(vocab))
+    doc_len = np.array([len(st) for st in symp_sets], dtype=np.float64)  # 每个疾病的症状词数
+    doc_wsum = term_matrix @ idf_vec  # 每个疾病症状词的IDF加权和
+
+    # 6. 疾病×字符bigram CSR矩阵（fuzzy模式）
+    gram_vocab = {}
+    gram_ids = []
+    for s in symps:
+        grams = set()
+        for t in s:
+            if t:
+                grams |= _char_ngrams(t, 2)
+        gram_ids.append(np.array(
+            sorted(gram_vocab.setdefault(g, len(gram_vocab)) for g in grams),
+            dtype=np.int32
+        ))
+    gram_matrix = _binary_csr(gram_ids, len(gram_vocab))
+    doc_gram_len = np.array([len(g) for g in gram_ids], dtype=np.float64)
+
+    # 7. 症状词包含关系图（多症状规则中的 0.5 分模糊匹配直接查表）
+    terms = list(vocab)
+    substr_postings = _build_substr_postings(terms)
+    contain_graph = _binary_csr(
+        [np.array(sorted(_find_containment(t, vocab, terms, substr_postings)), dtype=np.int32)
+         for t in terms],
+        len(terms)
+    )
+
+    return {
+        'generation': next(_generation),
+        'embeddings': open_embeddings(data),  # float32 memmap；float16/int8 存储按块反量化打分，不另存 float32 副本
+        'projection': load_projection(data),  # PCA投影（未降维时为None）
+        'names': names,
+        'categories': cats,
+        'symptoms': symps,
+        'symptom_sets': symp_sets,
+        'vocab': vocab,
+        'terms': terms,  # 词ID → 症状词
+        'term_ids': term_ids,
+        'idf': idf,
+        'idf_vec': idf_vec,
+        'term_matrix': term_matrix,
+        'doc_len': doc_len,
+        'doc_wsum': doc_wsum,
+        'gram_vocab': gram_vocab,
+        'gram_matrix': gram_matrix,
+        'doc_gram_len': doc_gram_len,
+        'substr_postings': substr_postings,
+        'contain_graph': contain_graph,
+    }
+
+def _binary_csr(row_ids, n_cols):
+    """
+    由每行的列ID列表构建 0/1 CSR矩阵
+
+    参数：
+        row_ids (list[np.ndarray]): 每行非零元素的列ID（已去重）
+        n_cols (int): 列数
+
+    返回：
+        scipy.sparse.csr_matrix: 形状 (len(row_ids), n_cols)，数据类型 float64
+    """
+    indptr = np.zeros(len(row_ids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(r) for r in row_ids])
+    indices = np.concatenate(row_ids) if row_ids else np.zeros(0, dtype=np.int32)
+    values = np.ones(len(indices), dtype=np.float64)
+    return sparse.csr_matrix((values, indices, indptr), shape=(len(row_ids), n_cols))
+
+def _indicator(keys, table):
+    """
+    将词集合转为 0/1 指示向量（不在词表中的词忽略）
+
+    示例：
+        >>> _indicator({'头痛', '未知词'}, {'发热': 0, '头痛': 1})
+        array([0., 1.])
+    """
+    x = np.zeros(len(table), dtype=np.float64)
+    for k in keys:
+        idx = table.get(k)
+        if idx is not None:
+            x[idx] = 1.0
+    return x
+
+def _lexical_scores(query_tokens, ci, mode='fuzzy'):
+    """
+    向量化词面匹配（对所有疾病一次性计算，结果与逐条调用 _lexical_score 一致）
+
+    参数：
+        query_tokens (list[str]): 查询症状词
+        ci (dict): _compile_index() 生成的预编译索引
+        mode (str): 'none' / 'exact' / 'wexact' / 'fuzzy'
+
+    返回：
+        np.ndarray: (N,) 每个疾病的词面匹配得分
+
+    计算方法（Q为查询词集合，D为疾病症状词集合）：
+        - exact:  |Q∩D| = 矩阵×指示向量，|Q∪D| = |Q| + |D| - |Q∩D|
+        - wexact: 同上，指示向量乘以IDF权重
+        - fuzzy:  同 exact，但在字符bigram矩阵上计算
+    """
+    n = len(ci['names'])
+    q_set = {t for t in query_tokens if t}
+
+    if mode == 'none' or not q_set:
+        return np.zeros(n, dtype=np.float64)
+
+    if mode in ('exact', 'wexact'):
+        x = _indicator(q_set, ci['vocab'])
+
+        if mode == 'wexact' and ci['idf']:
+            # IDF加权Jaccard：不在IDF表中的查询词权重为0（与 idf.get(t, 0) 一致）
+            w = x * ci['idf_vec']
+            w_inter = ci['term_matrix'] @ w
+            w_union = w.sum() + ci['doc_wsum'] - w_inter
+            scores = w_inter / np.maximum(1e-9, w_union)
+        else:
+            # 没有IDF时 wexact 退化为词数加权，与 exact 相同
+            inter = ci['term_matrix'] @ x
+            scores = inter / (len(q_set) + ci['doc_len'] - inter)
+
+        scores[ci['doc_len'] == 0] = 0.0
+        return scores
+
+    # fuzzy：字符bigram Jaccard
+    q_grams = set()
+    for t in q_set:
+        q_grams |= _char_ngrams(t, 2)
+    if not q_grams:
+        return np.zeros(n, dtype=np.float64)
+
+    xg = _indicator(q_grams, ci['gram_vocab'])
+    inter = ci['gram_matrix'] @ xg
+    scores = inter / (len(q_grams) + ci['doc_gram_len'] - inter)
+    scores[ci['doc_gram_len'] == 0] = 0.0
+    return scores
+
+def _substr_keys(t):
+    """
+    症状词的倒排键：长度≥2时为所有相邻字符对，否则为词本身
+
+    示例：
+        >>> _substr_keys("偏头痛")
+        {'偏头', '头痛'}
+        >>> _substr_keys("痛")
+        {'痛'}
+    """
+    if len(t) < 2:
+        return {t} if t else set()
+    return {t[i:i+2] for i in range(len(t) - 1)}
+
+def _build_substr_postings(terms):
+    """
+    构建症状词的 字符/字符对 → 词ID集合 倒排表（用于查找"包含qt的词"）
+
+    说明：
+        每个词同时登记单字和相邻字符对，这样无论查询词长度为1还是≥2都能命中
+    """
+    postings = {}
+    for i, t in enumerate(terms):
+        for key in _substr_keys(t) | set(t):
+            postings.setdefault(key, set()).add(i)
+    return postings
+
+def _find_containment(qt, vocab, terms, postings):
+    """
+    查找与qt存在包含关系的词ID集合（qt in t 或 t in qt，不含qt自身）
+
+    方法：
+        1. 包含qt的词：qt的所有倒排键的倒排集合求交，再逐个确认 qt in t
+        2. 被qt包含的词：枚举qt的所有子串，直接查词表
+    """
+    if not qt:
+        return set()
+
+    # 1. 包含qt的词（候选集合通常很小）
+    keys = _substr_keys(qt)
+    cands = None
+    for key in keys:
+        ids = postings.get(key)
+        if not ids:
+            cands = set()
+            break
+        cands = set(ids) if cands is None else (cands & ids)
+    found = {i for i in (cands or ()) if qt in terms[i] and terms[i] != qt}
+
+    # 2. 被qt包含的词（症状词很短，子串数量有限）
+    for a in range(len(qt)):
+        for b in range(a + 1, len(qt) + 1):
+            idx = vocab.get(qt[a:b])
+            if idx is not None and b - a < len(qt):
+                found.add(idx)
+    return found
+
+def _containment_ids(qt, ci):
+    """
+    查找与查询词存在包含关系的症状词ID（qt in dt 或 dt in qt，不含qt自身）
+
+    说明：
+        - 词表内的词：直接读取预计算的包含关系图（CSR的一行）
+        - 词表外的词：通过倒排表即时计算
+    """
+    idx = ci['vocab'].get(qt)
+    if idx is not None:
+        g = ci['contain_graph']
+        return g.indices[g.indptr[idx]:g.indptr[idx + 1]]
+    return sorted(_find_containment(qt, ci['vocab'], ci['terms'], ci['substr_postings']))
+
+def _match_features(q_token_set, ci):
+    """
+    向量化计算多症状规则所需的匹配特征
+
+    参数：
+        q_token_set (set[str]): 查询症状词集合
+        ci (dict): 预编译索引
+
+    返回：
+        tuple: (exact_count, match_ratio)，均为 (N,) 数组
+            - exact_count: 精确匹配的症状数
+            - match_ratio: 查询侧/文档侧匹配率的调和平均（模糊匹配计0.5）
+
+    计算方法：
+        1. 精确匹配数 = 疾病×症状词矩阵 × 查询指示向量
+        2. 对每个查询词qt，从包含关系图中取出"与qt有包含关系、且不是查询词"的词，
+           构造指示列，一次稀疏矩阵乘法得到每个疾病是否命中；再排除本身已精确命中qt的疾病
+           （包含关系在加载时预计算，多症状查询的开销与单症状查询相当）
+        3. 匹配数 = 精确数 + 0.5 × 模糊数，之后按原公式计算调和平均
+    """
+    T = ci['term_matrix']
+    vocab = ci['vocab']
+    n_q = len(q_token_set)
+
+    exact = T @ _indicator(q_token_set, vocab)
+
+    # 每个查询词一列：包含关系指示列 + 自身指示列
+    rel_rows, rel_cols, self_rows, self_cols = [], [], [], []
+    for j, qt in enumerate(sorted(q_token_set)):
+        for tid in _containment_ids(qt, ci):
+            if ci['terms'][tid] not in q_token_set:
+                rel_rows.append(tid)
+                rel_cols.append(j)
+        if qt in vocab:
+            self_rows.append(vocab[qt])
+            self_cols.append(j)
+
+    partial = np.zeros(T.shape[0], dtype=np.float64)
+    if rel_rows:
+        shape = (T.shape[1], n_q)
+        rel = sparse.csc_matrix((np.ones(len(rel_rows)), (rel_rows, rel_cols)), shape=shape)
+        own = sparse.csc_matrix((np.ones(len(self_rows)), (self_rows, self_cols)), shape=shape)
+        hit = (T @ rel).toarray() > 0  # (N, n_q) 是否存在包含关系的文档症状词
+        present = (T @ own).toarray() > 0  # (N, n_q) 查询词本身是否已精确命中
+        partial = (hit & ~present).sum(axis=1).astype(np.float64)
+
+    matched = exact + 0.5 * partial
+    ratio_q = matched / max(1, n_q)
+    ratio_d = matched / np.maximum(1.0, ci['doc_len'])
+    match_ratio = np.where(
+        (ratio_q > 0) | (ratio_d > 0),
+        2 * (ratio_q * ratio_d) / np.maximum(1e-9, ratio_q + ratio_d),
+        0.0
+    )
+    return exact, match_ratio
+
+def _match_features_batch(q_token_sets, ci):
+    """
+    批量版 _match_features：一批查询共用几次稀疏矩阵乘法
+
+    参数：
+        q_token_sets (list[set[str]]): B 个查询的症状词集合
+        ci (dict): 预编译索引
+
+    返回：
+        tuple: (exact_count, match_ratio)，均为 (B, N) 数组，每一行与 _match_features 的结果一致
+
+    计算方法：
+        所有查询的指示向量拼成 (V, B) 稀疏矩阵；包含关系指示列按 (查询, 查询词) 展开成 (V, C) 矩阵，
+        命中结果再按列所属的查询求和
+    """
+    T = ci['term_matrix']
+    vocab = ci['vocab']
+    n_docs, n_vocab = T.shape
+    n_batch = len(q_token_sets)
+
+    x_rows, x_cols = [], []
+    rel_rows, rel_cols, self_rows, self_cols, col_owner = [], [], [], [], []
+    for b, q_token_set in enumerate(q_token_sets):
+        for qt in sorted(q_token_set):
+            j = len(col_owner)
+            col_owner.append(b)
+            if qt in vocab:
+                x_rows.append(vocab[qt])
+                x_cols.append(b)
+                self_rows.append(vocab[qt])
+                self_cols.append(j)
+            for tid in _containment_ids(qt, ci):
+                if ci['terms'][tid] not in q_token_set:
+                    rel_rows.append(tid)
+                    rel_cols.append(j)
+
+    x = sparse.csc_matrix((np.ones(len(x_rows)), (x_rows, x_cols)), shape=(n_vocab, n_batch))
+    exact = (T @ x).toarray().T  # (B, N)
+
+    partial = np.zeros((n_batch, n_docs), dtype=np.float64)
+    if rel_rows:
+        shape = (n_vocab, len(col_owner))
+        rel = sparse.csc_matrix((np.ones(len(rel_rows)), (rel_rows, rel_cols)), shape=shape)
+        own = sparse.csc_matrix((np.ones(len(self_rows)), (self_rows, self_cols)), shape=shape)
+        hit = (T @ rel).toarray() > 0  # (N, C)
+        present = (T @ own).toarray() > 0  # (N, C)
+        owner = np.zeros((len(col_owner), n_batch), dtype=np.float64)
+        owner[np.arange(len(col_owner)), col_owner] = 1.0
+        partial = ((hit & ~present).astype(np.float64) @ owner).T
+
+    n_q = np.array([len(q) for q in q_token_sets], dtype=np.float64)[:, None]
+    matched = exact + 0.5 * partial
+    ratio_q = matched / np.maximum(1.0, n_q)
+    ratio_d = matched / np.maximum(1.0, ci['doc_len'])
+    match_ratio = np.where(
+        (ratio_q > 0) | (ratio_d > 0),
+        2 * (ratio_q * ratio_d) / np.maximum(1e-9, ratio_q + ratio_d),
+        0.0
+    )
+    return exact, match_ratio
+
+def _match_info_reference(q_token_set, symp_sets):
+    """
+    多症状匹配特征的逐疾病参考实现（原始Python循环版本，仅用于一致性校验）
+    """
+    exact_counts, ratios = [], []
+    for d_token_set in symp_sets:
+        if not d_token_set:
+            exact_counts.append(0)
+            ratios.append(0.0)
+            continue
+
+        exact_matches = q_token_set & d_token_set
+        exact_count = len(exact_matches)
+        matched_count = exact_count
+        remaining_q = q_token_set - exact_matches
+        remaining_d = d_token_set - exact_matches
+        for qt in remaining_q:
+            if any(qt in dt or dt in qt for dt in remaining_d):
+                matched_count += 0.5
+
+        match_ratio_q = matched_count / max(1, len(q_token_set))
+        match_ratio_d = matched_count / max(1, len(d_token_set))
+        if match_ratio_q > 0 or match_ratio_d > 0:
+            match_ratio = 2 * (match_ratio_q * match_ratio_d) / \
+                          max(1e-9, match_ratio_q + match_ratio_d)
+        else:
+            match_ratio = 0.0
+
+        exact_counts.append(exact_count)
+        ratios.append(match_ratio)
+    return np.array(exact_counts, dtype=np.float64), np.array(ratios, dtype=np.float64)
+
+def check_scorer_parity(n_queries=200, seed=42, index_path=None):
+    """
+    校验向量化评分与原始逐疾病评分的一致性（不需要加载BERT模型）
+
+    参数：
+        n_queries (int): 随机生成的查询数量
+        seed (int): 随机种子
+        index_path (str): 索引目录或npz路径（默认优先 INDEX_STORE_PATH，其次 INDEX_PATH）
+
+    返回：
+        int: 不一致的(查询, 模式)数量，0表示完全一致
+
+    查询构造：
+        从症状词表中随机抽取1~4个词，并混入子串（触发包含匹配）和词表外的词
+    """
+    data = open_index(index_path or _index_path())
+    return _check_parity(_compile_index(data), n_queries, seed, label='评分一致性校验')
+
+def check_synthetic_parity(n_queries=200, seed=42):
+    """
+    在人工构造的小索引上校验评分一致性（不需要模型和已构建的索引）
+
+    参数：
+        n_queries (int): 随机生成的查询数量
+        seed (int): 随机种子
+
+    返回：
+        int: 不一致的(查询, 模式)数量，0表示完全一致
+
+    说明：
+        真实索引里不一定出现的边界情况都放在这里：症状列表含空字符串、只有空字符串、
+        空列表、重复症状词、IDF表中有负值和不在任何疾病中的词
+    """
+    symptoms = [
+        ['头痛', '', '发热'],
+        [''],
+        [],
+        ['头痛', '头痛', '恶心'],
+        ['偏头痛', '恶心', ''],
+        ['咳嗽', '干咳', '', ''],
+        ['痛'],
+        ['发热', '咳嗽', '咽痛', '鼻塞'],
+        ['腹痛', '腹泻', ''],
+        ['胸痛', '呼吸困难'],
+    ]
+    idf_terms = ['头痛', '发热', '咳嗽', '恶心', '痛', '罕见症状', '鼻塞']
+    idf_vals = [1.2, 0.8, 0.9, 1.5, -0.3, 2.0, 1.1]
+    data = {
+        'names': [f'疾病{i}' for i in range(len(symptoms))],
+        'categories': ['内科'] * len(symptoms),
+        'symptoms': [json.dumps(s, ensure_ascii=False) for s in symptoms],
+        'embeddings': np.zeros((len(symptoms), 4), dtype=np.float32),
+        'idf_terms': np.array(idf_terms),
+        'idf_vals': np.array(idf_vals),
+    }
+    return _check_parity(_compile_index(data), n_queries, seed, label='合成索引一致性校验')
+
+def _check_parity(ci, n_queries, seed, label):
+    """
+    check_scorer_parity / check_synthetic_parity 共用的校验循环
+
+    参数：
+        ci (dict): 预编译索引
+        n_queries (int): 随机生成的查询数量
+        seed (int): 随机种子
+        label (str): 结果输出的标题
+
+    返回：
+        int: 不一致的(查询, 模式)数量
+    """
+    import random
+
+    rng = random.Random(seed)
+    terms = [t for t in ci['terms'] if t]
+    if not terms:
+        print("⚠️  索引中没有症状词，跳过校验")
+        return 0
+
+    mismatches = 0
+    for _ in range(n_queries):
+        q = rng.sample(terms, min(len(terms), rng.randint(1, 4)))
+        if rng.random() < 0.3:
+            t = rng.choice(terms)
+            q.append(t[:max(1, len(t) - 1)])  # 子串
+        if rng.random() < 0.2:
+            q.append(rng.choice(terms) + '加重')  # 词表外的超串
+        if rng.random() < 0.1:
+            q.append('词表外症状')
+        q_set = set(q)
+
+        for mode in ('fuzzy', 'exact', 'wexact', 'none'):
+            ref = np.array([_lexical_score(q, s, mode=mode, idf=ci['idf']) for s in ci['symptoms']])
+            vec = _lexical_scores(q, ci, mode)
+            if not np.allclose(ref, vec, rtol=1e-9, atol=1e-12):
+                mismatches += 1
+                print(f"❌ 词面得分不一致: mode={mode} query={' '.join(q)}")
+
+        ref_exact, ref_ratio = _match_info_reference(q_set, ci['symptom_sets'])
+        vec_exact, vec_ratio = _match_features(q_set, ci)
+        if not (np.array_equal(ref_exact, vec_exact) and np.allclose(ref_ratio, vec_ratio, rtol=1e-12, atol=0)):
+            mismatches += 1
+            print(f"❌ 匹配特征不一致: query={' '.join(q)}")
+
+    print(f"{'✅' if mismatches == 0 else '❌'} {label}: {n_queries} 个查询, {mismatches} 处不一致")
+    return mismatches
+
+# ==================== 第5部分（续）：规则引擎编译 ====================
+
+def _compile_rules(rules, ci):
+    """
+    将规则文件编译为逐疾病的掩码和乘数数组
+
+    参数：
+        rules (dict): disease_rules.json 的内容
+        ci (dict): 预编译索引（提供疾病名称和科室）
+
+    返回：
+        dict: 编译后的规则
+            - single_keys: list[str] 单症状映射的症状键
+            - single_masks: (K, N) bool 每个症状键对应的常见病掩码
+            - single_boost: float 单症状常见病加权
+            - very_common_mask / very_common_penalty: 多症状查询时的核心常见病掩码 / 非核心病降权
+            - rare_mask / rare_penalty: 罕见病掩码 / 降权
+            - specialist_mask / specialist_penalty: 专科科室掩码 / 降权
+            - specialist_keywords / specialist_max_terms: 专科关键词 / 生效的最大查询词数
+            - common_mult: (N,) 常见病乘数（不在列表中的疾病为1.0）
+
+    作用：
+        每条规则在预测时变成一次逐元素乘法，不再逐疾病循环
+    """
+    names = np.array(ci['names'], dtype=object)
+    cats = np.array(ci['categories'], dtype=object)
+
+    def mask_of(values, column):
+        return np.isin(column, list(values)) if values else np.zeros(len(column), dtype=bool)
+
+    single = rules.get('single_symptom', {})
+    single_map = single.get('common_map', {})
+    single_keys = list(single_map)
+    single_masks = np.array(
+        [mask_of(single_map[k], names) for k in single_keys], dtype=bool
+    ).reshape(len(single_keys), len(names))
+
+    very_common = rules.get('very_common', {})
+    rare = rules.get('rare', {})
+    specialist = rules.get('specialist', {})
+
+    common_mult = np.ones(len(names), dtype=np.float64)
+    for name, weight in rules.get('common_diseases', {}).items():
+        common_mult[names == name] = float(weight)
+
+    return {
+        'generation': next(_generation),
+        'single_keys': single_keys,
+        'single_masks': single_masks,
+        'single_boost': float(single.get('boost', 1.0)),
+        'very_common_mask': mask_of(very_common.get('diseases', []), names),
+        'very_common_penalty': float(very_common.get('penalty', 1.0)),
+        'rare_mask': mask_of(rare.get('diseases', []), names),
+        'rare_penalty': float(rare.get('penalty', 1.0)),
+        'specialist_mask': mask_of(specialist.get('departments', []), cats),
+        'specialist_penalty': float(specialist.get('penalty', 1.0)),
+        'specialist_keywords': list(specialist.get('keywords', [])),
+        'specialist_max_terms': int(specialist.get('max_query_terms', 2)),
+        'common_mult': common_mult,
+    }
+
+def get_rules(ci):
+    """
+    获取编译后的规则（热加载）
+
+    参数：
+        ci (dict): 当前使用的预编译索引
+
+    返回：
+        dict: _compile_rules() 的结果
+
+    热加载机制：
+        1. 每次调用检查规则文件的修改时间和大小（一次 os.stat，开销可忽略）
+        2. 编译结果保存在 ci['rules'] 中，与索引同生命周期：换索引后旧规则随旧索引一起释放，
+           新旧索引上的请求各自使用自己的规则，互不覆盖
+        3. 文件变化时重新读取并编译
+        4. 新规则解析失败时保留上一版规则继续服务，并打印错误；
+           换索引后首次编译就失败时，用最近一次成功的规则JSON对新索引重新编译
+           （编译结果中的掩码按疾病ID排列，绝不跨索引复用）
+    """
+    global _last_good_rules
+    st = os.stat(RULES_PATH)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = ci.get('rules')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with _rules_lock:
+        cached = ci.get('rules')
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            with open(RULES_PATH, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            compiled = _compile_rules(raw, ci)
+        except (ValueError, TypeError, AttributeError) as e:
+            if cached is not None:
+                print(f"⚠️  规则文件解析失败，继续使用上一版规则: {e}")
+                compiled = cached[1]
+            elif _last_good_rules is not None:
+                print(f"⚠️  规则文件解析失败，用上一版规则对当前索引重新编译: {e}")
+                compiled = _compile_rules(_last_good_rules, ci)
+            else:
+                raise
+            ci['rules'] = (key, compiled)  # 文件再次修改前不再重复解析
+            return compiled
+
+        _last_good_rules = raw
+        ci['rules'] = (key, compiled)
+    print(f"✅ 规则已编译: {RULES_PATH}")
+    return compiled
+
+def _lexical_hit_rows(q_tokens, ci, rules):
+    """
+    词面/规则可能加权的疾病ID（语义排名靠后也可能被规则提到前面，召回时不能丢）
+
+    包括：
+        - 症状词与查询词精确相同、或存在包含关系（多症状规则的精确/模糊匹配）
+        - 单症状查询时命中"常见病"规则的疾病（× single_boost）
+
+    返回：
+        np.ndarray: 疾病ID（升序）
+    """
+    q_token_set = {t for t in q_tokens if t}
+    term_ids = set()
+    for qt in q_token_set:
+        if qt in ci['vocab']:
+            term_ids.add(ci['vocab'][qt])
+        term_ids.update(int(t) for t in _containment_ids(qt, ci))
+    x = np.zeros(len(ci['vocab']), dtype=np.float64)
+    x[list(term_ids)] = 1.0
+    hit = ci['term_matrix'] @ x > 0
+    if len(q_token_set) == 1:
+        single_symptom = next(iter(q_token_set))
+        hit_keys = [k for k, key in enumerate(rules['single_keys']) if key in single_symptom]
+        if hit_keys:
+            hit |= rules['single_masks'][hit_keys].any(axis=0)
+    return np.flatnonzero(hit)
+
+def _candidate_rows(ids, q_tokens, ci):
+    """
+    候选疾病 = 向量索引召回的ID ∪ 词面/规则命中的疾病（_lexical_hit_rows）
+
+    说明：
+        只用于近似索引（ivf/hnsw）；精确索引（exact）不截断，直接对全部疾病打分——
+        暴力检索本来就要算全部相似度，截断不省计算，只会让结果与不建索引时不同
+
+    返回：
+        np.ndarray: 候选疾病ID（升序）
+    """
+    return np.union1d(ids[ids >= 0], _lexical_hit_rows(q_tokens, ci, get_rules(ci)))
+
+def _candidate_view(ci, rows):
+    """
+    取预编译索引在候选疾病上的子集（词表、包含关系图等全局结构共享，不复制）
+
+    参数：
+        ci (dict): 预编译索引
+        rows (np.ndarray): 候选疾病ID（升序）
+
+    返回：
+        dict: 与 ci 结构相同，逐疾病的数组/矩阵只保留候选行
+    """
+    view = dict(ci)
+    for key in ('embeddings', 'doc_len', 'doc_wsum', 'doc_gram_len', 'term_matrix', 'gram_matrix'):
+        view[key] = ci[key][rows]
+    for key in ('names', 'categories', 'symptoms', 'symptom_sets'):
+        view[key] = [ci[key][i] for i in rows]
+    return view
+
+def _candidate_rules(rules, rows):
+    """
+    取编译后规则在候选疾病上的子集（与 _candidate_view 配合使用）
+    """
+    view = dict(rules)
+    view['single_masks'] = rules['single_masks'][:, rows]
+    for key in ('very_common_mask', 'rare_mask', 'specialist_mask', 'common_mult'):
+        view[key] = rules[key][rows]
+    return view
+
 # ==================== 第6部分：模型加载 ====================
 
-def load_model():
+def load_model(backend=None, encoder=None):
     """
     加载BERT模型和疾病索引（带缓存机制）
     
+    参数：
+        backend (str): 推理后端
+            - None（默认）: 沿用已加载的后端；首次加载时使用 BACKEND
+            - 'torch': PyTorch BertModel
+            - 'onnx': ONNX Runtime FP32（需先运行 --export_onnx）
+            - 'onnx-int8': ONNX Runtime 动态INT8量化
+        encoder (str): 查询编码器
+            - None（默认）: 沿用已加载的编码器；首次加载时使用 QUERY_ENCODER
+            - 'teacher': 微调后的完整模型（MODEL_DIR）
+            - 'student': 蒸馏的小模型（STUDENT_DIR），与索引中的文档向量处于同一空间
+    
     返回：
         tuple: (tokenizer, model, index_data)
             - tokenizer: BertTokenizer实例
-            - model: BertModel实例（已移动到GPU/CPU）
+            - model: BertModel实例（已移动到GPU/CPU），ONNX后端时为 OnnxEncoder
             - index_data: dict-like对象（包含embeddings、names、symptoms等）
     
     缓存机制：
@@ -393,75 +1180,1089 @@ def load_model():
         ✅ 加载索引: 8807 个疾病
         ✅ 模型加载完成 (设备: cpu)
     """
-    global _tokenizer, _model, _index_data  # 声明使用全局变量
-    
+    global _tokenizer, _model, _backend, _encoder, _index_data, _compiled_index  # 声明使用全局变量
+
     # ===== 检查缓存 =====
-    if _tokenizer is not None:
+    if _model is not None and backend in (None, _backend) and encoder in (None, _encoder):
         # 已缓存，直接返回
         return _tokenizer, _model, _index_data
     
+    backend = backend or _backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f'未知的推理后端: {backend}（可选: {", ".join(BACKENDS)}）')
+    encoder = encoder or _encoder or QUERY_ENCODER
+    if encoder not in QUERY_ENCODERS:
+        raise ValueError(f'未知的查询编码器: {encoder}（可选: {", ".join(QUERY_ENCODERS)}）')
+    
+    if _index_data is None:
+        _load_index()
+    if encoder == 'student':
+        _check_student()
+    
+    # ===== 加载分词器 =====
+    if _tokenizer is None:
+        # 1. 加载分词器（从训练后的模型目录）
+        _tokenizer = BertTokenizer.from_pretrained(
+            MODEL_DIR,
+            local_files_only=True  # 仅使用本地文件（不从HuggingFace下载）
+        )
+        
+        # 2. 添加字段标记到分词器（训练时添加的特殊token）
+        _tokenizer.add_special_tokens({
+            'additional_special_tokens': FIELD_TAGS  # ['[SYM]', '[DESC]', '[CAUSE]', '[CAT]']
+        })
+    
+    # ===== 加载编码器 =====
+    if backend == 'torch':
+        _model = _load_torch_encoder(_tokenizer, model_dir=_encoder_dir(encoder))
+    else:
+        path = _onnx_paths(encoder)[backend]
+        _model = OnnxEncoder(path)
+        print(f"✅ ONNX模型加载完成 ({backend}: {path})")
+    if encoder == 'student':
+        print(f"✅ 查询编码器: 学生模型 ({STUDENT_DIR})")
+    _model.cache_generation = next(_generation)  # 查询向量缓存的key（每次加载的模型各不相同，不依赖 id()）
+    _backend = backend
+    _encoder = encoder
+    _result_cache.clear()  # 结果缓存的key不区分模型，切换后清空
+    _embedding_cache.clear()  # 旧模型的查询向量不会再命中，直接释放
+    
+    # ===== 返回缓存 =====
+    return _tokenizer, _model, _index_data
+
+def _encoder_dir(encoder):
+    """查询编码器的torch模型目录"""
+    return STUDENT_DIR if encoder == 'student' else MODEL_DIR
+
+def _onnx_paths(encoder):
+    """查询编码器的ONNX模型路径 {后端: 路径}"""
+    return STUDENT_ONNX_PATHS if encoder == 'student' else ONNX_PATHS
+
+def _check_student():
+    """
+    检查学生模型是否存在，以及是否由构建当前索引的编码器蒸馏而来
+
+    说明：
+        distill_meta.json 中的教师指纹与索引中的 encoder_fingerprint 不一致时，
+        学生的查询向量与文档向量不在同一空间（教师重新训练过），只打印警告，需要重新蒸馏
+    """
+    if not os.path.isdir(STUDENT_DIR):
+        raise FileNotFoundError(f'学生模型不存在: {STUDENT_DIR}。请先运行 python 机器学习.py --distill')
+    meta_path = os.path.join(STUDENT_DIR, 'distill_meta.json')
+    if not os.path.exists(meta_path) or 'encoder_fingerprint' not in _index_data:
+        return
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        teacher = json.load(f).get('teacher_fingerprint')
+    if teacher and teacher != str(_index_data['encoder_fingerprint'][0]):
+        print('⚠️  学生模型的教师与当前索引的编码器不一致，查询向量可能不在同一空间，请重新运行 --distill')
+
+def _index_path():
+    """
+    当前使用的索引路径：内存映射目录优先，其次旧的 .npz 文件
+    """
+    if os.path.isdir(INDEX_STORE_PATH):
+        return INDEX_STORE_PATH
+    return INDEX_PATH
+
+def _load_index():
+    """
+    检查路径并加载、预编译疾病索引（结果写入 _index_data / _compiled_index）
+    """
+    global _index_data, _compiled_index, _vector_index
+    
+    index_path = _index_path()
+    
     # ===== 验证路径 =====
     print(f"🔍 检查路径...")
     print(f"   模型目录: {MODEL_DIR}")
-    print(f"   索引文件: {INDEX_PATH}")
+    print(f"   索引文件: {index_path}")
     
-    if not os.path.exists(INDEX_PATH):
-        raise FileNotFoundError(f'索引文件不存在: {INDEX_PATH}')
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f'索引文件不存在: {index_path}')
     
     if not os.path.isdir(MODEL_DIR):
         raise FileNotFoundError(f'模型目录不存在: {MODEL_DIR}')
     
+    if not os.path.exists(RULES_PATH):
+        raise FileNotFoundError(f'规则文件不存在: {RULES_PATH}')
+    
     print("✅ 路径检查通过")
     
-    # ===== 加载索引文件 =====
-    # np.load返回一个dict-like对象，可以用data['key']访问
-    _index_data = np.load(INDEX_PATH, allow_pickle=True)
-    print(f"✅ 加载索引: {len(_index_data['names'])} 个疾病")
-    
-    # ===== 加载BERT模型 =====
-    # 1. 加载分词器（从训练后的模型目录）
-    _tokenizer = BertTokenizer.from_pretrained(
-        MODEL_DIR,
-        local_files_only=True  # 仅使用本地文件（不从HuggingFace下载）
-    )
+    _index_data, _compiled_index = _open_index_version(index_path)
+    _vector_index = _compiled_index['vector_index']
+
+def _open_index_version(index_path, checksum=None):
+    """
+    加载并预编译一个版本的疾病索引（不修改全局变量）
+
+    参数：
+        index_path (str): 索引目录或 .npz 文件
+        checksum (str): 已计算好的内容校验和（None时计算）
+
+    返回：
+        tuple: (index_data, compiled_index)
+            compiled_index 额外包含 'vector_index'（向量召回索引或None）和 'version'（版本信息）
+    """
+    signature = _index_signature()
+    checksum = checksum or _index_checksum(index_path)
     
-    # 2. 加载BERT模型（从训练后的模型目录）
-    _model = BertModel.from_pretrained(
-        MODEL_DIR,
+    # ===== 加载索引文件 =====
+    # 目录格式：向量矩阵 np.memmap 映射（不解压、不反序列化）；npz格式：np.load
+    # 两者都是dict-like对象，可以用data['key']访问
+    data = open_index(index_path)
+    print(f"✅ 加载索引: {len(data['names'])} 个疾病")
+
+    # 预编译索引（解析症状JSON、构建词ID和IDF向量，只做一次）
+    ci = _compile_index(data)
+    print(f"✅ 索引预编译完成: {len(ci['vocab'])} 个症状词")
+
+    # 向量召回索引（可选）：加载失败时退回到对全部疾病打分
+    vindex = None
+    if os.path.exists(VECTOR_INDEX_PATH):
+        try:
+            vindex = load_vector_index(VECTOR_INDEX_PATH, ci['embeddings'])
+            if vindex.kind == 'exact':
+                print("✅ 向量索引: exact（对全部疾病打分，不截断候选）")
+            else:
+                print(f"✅ 向量索引: {vindex.kind}（每次召回 {CANDIDATE_K} 个候选 + 词面命中的疾病）")
+        except (ValueError, ImportError, OSError) as e:
+            print(f"⚠️  向量索引不可用，使用全量打分: {e}")
+    
+    ci['vector_index'] = vindex
+    ci['version'] = {
+        'version': checksum[:12],
+        'checksum': checksum,
+        'signature': signature,
+        'path': index_path,
+        'n_diseases': len(ci['names']),
+        'vector_index': vindex.kind if vindex is not None else None,
+        'loaded_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    return data, ci
+
+def _load_torch_encoder(tok, device=None, model_dir=None):
+    """
+    加载PyTorch版BERT编码器（已添加字段标记、设置为评估模式）
+
+    参数：
+        model_dir (str): 模型目录（默认 MODEL_DIR；学生模型为 STUDENT_DIR）
+    """
+    # 1. 加载BERT模型（从训练后的模型目录）
+    model = BertModel.from_pretrained(
+        model_dir or MODEL_DIR,
         local_files_only=True
     )
     
-    # 3. 添加字段标记到分词器（训练时添加的特殊token）
-    _tokenizer.add_special_tokens({
-        'additional_special_tokens': FIELD_TAGS  # ['[SYM]', '[DESC]', '[CAUSE]', '[CAT]']
-    })
-    
-    # 4. 调整模型嵌入层维度（匹配新词表大小）
-    _model.resize_token_embeddings(len(_tokenizer))
+    # 2. 调整模型嵌入层维度（匹配添加字段标记后的词表大小）
+    model.resize_token_embeddings(len(tok))
     
-    # 5. 移动到设备并设置为评估模式
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    _model.to(device).eval()  # .eval()禁用dropout
+    # 3. 移动到设备并设置为评估模式
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device).eval()  # .eval()禁用dropout
     print(f"✅ 模型加载完成 (设备: {device})")
-    
-    # ===== 返回缓存 =====
-    return _tokenizer, _model, _index_data
+    return model
 
-# ==================== 第7部分：核心预测函数 ====================
+# ==================== 第6部分（续）：ONNX推理后端 ====================
 
-@torch.no_grad()  # 禁用梯度计算（推理模式，节省显存）
-def predict_disease(
-    symptoms,  # 用户输入的症状文本
-    topk=5,  # 返回前K个结果
-    min_score=0.3,  # 最低相似度阈值
-    alpha=0.7,  # 语义权重（已废弃，保留兼容性）
-    lexical='fuzzy',  # 词面匹配模式
-    return_dict=False  # 返回格式（False=纯文本，True=字典列表）
-):
+class OnnxEncoder:
     """
-    症状预测疾病（混合系统：BERT语义 + 词面匹配 + 医学规则）
-    
-    参数详解：
+    ONNX Runtime 查询编码器（CPU推理，可加载FP32或INT8量化模型）
+
+    说明：
+        ONNX模型只输出 last_hidden_state，平均池化和L2归一化在NumPy中完成，
+        与PyTorch路径的 mean_pooling + normalize 计算一致
+    """
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('ONNX后端需要安装 onnxruntime: pip install onnxruntime')
+
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'ONNX模型不存在: {path}。请先运行 --export_onnx')
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            opts.intra_op_num_threads = int(num_threads)
+        self.path = path
+        self.session = ort.InferenceSession(path, opts, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, tok, texts):
+        """
+        编码文本列表
+
+        返回：
+            np.ndarray: (len(texts), hidden_dim) 已L2归一化的向量
+        """
+        enc_in = tok(
+            list(texts),
+            max_length=MAX_LEN,
+            truncation=True,
+            padding=True,
+            return_tensors='np'
+        )
+        feeds = {k: v.astype(np.int64) for k, v in enc_in.items() if k in self.input_names}
+        hidden = self.session.run(['last_hidden_state'], feeds)[0]
+
+        # 平均池化（忽略padding）+ L2归一化（与 torch.nn.functional.normalize 的eps一致）
+        mask = enc_in['attention_mask'][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return (pooled / norms).astype(np.float32)
+
+def export_onnx(quantize=True, opset=14, compare=True, encoder='teacher'):
+    """
+    导出微调后的BERT编码器为ONNX（可选动态INT8量化）
+
+    参数：
+        quantize (bool): 是否同时生成INT8量化模型
+        opset (int): ONNX算子集版本
+        compare (bool): 导出后是否与torch模型对比（余弦偏差 + Top-K一致率）
+        encoder (str): 'teacher' 导出 MODEL_DIR 的模型；'student' 导出蒸馏的学生模型
+
+    输出：
+        models/medical_biencoder/onnx/biencoder.onnx（学生模型为 student.onnx）
+        models/medical_biencoder/onnx/biencoder.int8.onnx（quantize=True时；学生模型为 student.int8.onnx）
+
+    说明：
+        导出前会添加 FIELD_TAGS 并调整嵌入层，与 load_model() 的torch模型完全一致
+    """
+    import inspect
+
+    try:
+        import onnxruntime  # noqa: F401（提前检查依赖）
+    except ImportError:
+        raise ImportError('导出ONNX需要安装 onnx 和 onnxruntime: pip install onnx onnxruntime')
+
+    tok = BertTokenizer.from_pretrained(MODEL_DIR, local_files_only=True)
+    tok.add_special_tokens({'additional_special_tokens': FIELD_TAGS})
+    bert = _load_torch_encoder(tok, device=torch.device('cpu'), model_dir=_encoder_dir(encoder))
+    paths = _onnx_paths(encoder)
+
+    class _LastHidden(torch.nn.Module):
+        """只输出 last_hidden_state 的包装（池化在推理端完成）"""
+        def __init__(self, bert):
+            super().__init__()
+            self.bert = bert
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.bert(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                return_dict=True
+            ).last_hidden_state
+
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    dummy = tok([format_query(['头痛', '发热'])], return_tensors='pt')
+    axes = {0: 'batch', 1: 'seq'}
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    print(f"📦 导出ONNX: {paths['onnx']}")
+    torch.onnx.export(
+        _LastHidden(bert).eval(),
+        (dummy['input_ids'], dummy['attention_mask'], dummy['token_type_ids']),
+        paths['onnx'],
+        input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+        output_names=['last_hidden_state'],
+        dynamic_axes={
+            'input_ids': axes,
+            'attention_mask': axes,
+            'token_type_ids': axes,
+            'last_hidden_state': axes,
+        },
+        opset_version=opset,
+        **kwargs
+    )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"📦 动态INT8量化: {paths['onnx-int8']}")
+        quantize_dynamic(paths['onnx'], paths['onnx-int8'], weight_type=QuantType.QInt8)
+
+    for name, path in paths.items():
+        if os.path.exists(path):
+            print(f"   {name:10s} {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+
+    if compare:
+        return compare_backends(
+            backends=['onnx', 'onnx-int8'] if quantize else ['onnx'],
+            tok=tok, torch_model=bert, encoder=encoder
+        )
+
+def _heldout_queries(ci, n_queries=200, seed=42):
+    """从索引症状中随机组合1~3个症状，构造对比用的查询集合"""
+    import random
+    rng = random.Random(seed)
+    pool = [s for s in ci['symptoms'] if s]
+    queries = []
+    for _ in range(n_queries):
+        s = rng.choice(pool)
+        queries.append(canonical_query(rng.sample(s, min(len(s), rng.randint(1, 3)))))
+    return queries
+
+def compare_backends(backends=('onnx', 'onnx-int8'), n_queries=200, topk=10, tok=None, torch_model=None,
+                     encoder='teacher'):
+    """
+    对比ONNX后端与torch模型：向量余弦偏差、Top-K一致率、单查询延迟
+
+    参数：
+        backends (list[str]): 要对比的ONNX后端
+        n_queries (int): 对比查询数量（从索引症状随机组合）
+        topk (int): 计算Top-K一致率的K
+        encoder (str): 'teacher' / 'student'（对比同一个编码器的不同后端）
+
+    返回：
+        dict: {后端: {'cos_mean', 'cos_min', 'topk_agreement', 'top1_agreement', 'latency_ms'}}
+
+    指标说明：
+        - cos_mean / cos_min: 同一查询在两个后端的向量余弦相似度（越接近1偏差越小）
+        - topk_agreement: 语义检索Top-K集合的平均重合比例
+        - top1_agreement: Top-1相同的查询比例
+        - latency_ms: batch_size=1时的平均编码延迟
+    """
+    if _index_data is None:
+        _load_index()
+    ci = _compiled_index
+    if tok is None or torch_model is None:
+        tok = BertTokenizer.from_pretrained(MODEL_DIR, local_files_only=True)
+        tok.add_special_tokens({'additional_special_tokens': FIELD_TAGS})
+        torch_model = _load_torch_encoder(tok, device=torch.device('cpu'), model_dir=_encoder_dir(encoder))
+
+    queries = _heldout_queries(ci, n_queries)
+    embs = ci['embeddings']
+
+    def run(enc):
+        vecs = np.vstack([_encode_texts(tok, enc, queries[i:i + 32]) for i in range(0, len(queries), 32)])
+        t0 = time.perf_counter()
+        for q in queries[:50]:
+            _encode_texts(tok, enc, [q])
+        latency = (time.perf_counter() - t0) * 1000.0 / min(50, len(queries))
+        return vecs, latency
+
+    def topk_ids(vecs):
+        sims = project_queries(vecs, ci['projection']) @ embs.T
+        return np.argsort(-sims, axis=1)[:, :topk]
+
+    ref_vecs, ref_latency = run(torch_model)
+    ref_top = topk_ids(ref_vecs)
+    report = {'torch': {'latency_ms': round(ref_latency, 3)}}
+
+    print(f"\n📊 后端对比（{len(queries)} 个查询，Top-{topk}）")
+    print(f"   {'torch':10s} 延迟 {ref_latency:.2f} ms")
+    for name in backends:
+        vecs, latency = run(OnnxEncoder(_onnx_paths(encoder)[name]))
+        cos = np.sum(vecs * ref_vecs, axis=1)
+        top = topk_ids(vecs)
+        overlap = np.mean([len(set(a) & set(b)) / topk for a, b in zip(top, ref_top)])
+        top1 = float(np.mean(top[:, 0] == ref_top[:, 0]))
+        report[name] = {
+            'cos_mean': float(cos.mean()),
+            'cos_min': float(cos.min()),
+            'topk_agreement': float(overlap),
+            'top1_agreement': top1,
+            'latency_ms': round(latency, 3),
+        }
+        print(f"   {name:10s} 延迟 {latency:.2f} ms  余弦 均值={cos.mean():.6f} 最小={cos.min():.6f}  "
+              f"Top-{topk}一致率={overlap:.4f}  Top-1一致率={top1:.4f}")
+    return report
+
+# ==================== 第6部分（续）：索引热加载 ====================
+
+def _index_signature():
+    """
+    索引文件的轻量签名（路径 + 修改时间 + 大小，只做 os.stat）
+
+    说明：
+        目录格式取 meta.json（重建时整个目录被替换，meta.json 随之变化）；同时包含版本标记和向量索引元信息
+    """
+    path = _index_path()
+    main = os.path.join(path, 'meta.json') if os.path.isdir(path) else path
+    sig = [path]
+    for p in (main, version_marker_path(INDEX_STORE_PATH), VECTOR_INDEX_PATH):
+        try:
+            st = os.stat(p)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+def _index_incomplete():
+    """
+    检查一次重建是否已全部写完（版本标记、索引目录、向量索引属于同一次构建）
+
+    返回：
+        str 或 None: 未写完的原因；已写完（或旧版本写出的索引没有版本标记）时返回None
+
+    说明：
+        重建顺序为 索引目录 → 版本标记 → 向量索引（见 机器学习.py build_index），
+        目录替换的两次 rename 之间、以及向量索引重写完成之前都会返回原因
+    """
+    marker = read_version_marker(INDEX_STORE_PATH)
+    if marker is None:
+        return None
+    if store_build_id(INDEX_STORE_PATH) != marker:
+        return '索引目录正在替换（与版本标记不一致）'
+    vbuild = vector_index_build(VECTOR_INDEX_PATH)
+    if vbuild is not None and vbuild != marker:
+        return '向量索引尚未按新索引重建（与版本标记不一致）'
+    return None
+
+def _index_checksum(index_path):
+    """
+    索引内容的SHA1校验和（作为版本号；修改时间变化但内容相同时不重新加载）
+
+    覆盖范围：索引目录下所有文件（或 .npz 文件）+ 向量索引的元信息和数据文件
+    """
+    if os.path.isdir(index_path):
+        files = [os.path.join(index_path, f) for f in sorted(os.listdir(index_path))]
+    else:
+        files = [index_path]
+    vdir = os.path.dirname(VECTOR_INDEX_PATH)
+    vbase = os.path.splitext(os.path.basename(VECTOR_INDEX_PATH))[0]
+    if os.path.isdir(vdir):
+        files += [os.path.join(vdir, f) for f in sorted(os.listdir(vdir))
+                  if f.startswith(vbase + '.') and not f.endswith('.tmp')]
+
+    h = hashlib.sha1()
+    for fpath in files:
+        if not os.path.isfile(fpath):
+            continue
+        h.update(os.path.basename(fpath).encode('utf-8'))
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def index_version():
+    """
+    当前生效的索引版本
+
+    返回：
+        dict 或 None（索引尚未加载）:
+            {'version': 校验和前12位, 'path', 'n_diseases', 'vector_index', 'loaded_at', 'generation'}
+    """
+    ci = _compiled_index
+    if ci is None:
+        return None
+    info = {k: v for k, v in ci['version'].items() if k not in ('checksum', 'signature')}
+    info['generation'] = ci['generation']
+    return info
+
+def reload_index(force=False):
+    """
+    重新加载疾病索引并原子切换（管理接口和监视线程调用）
+
+    参数：
+        force (bool): 内容校验和未变化时也重新加载
+
+    返回：
+        dict: {'reloaded': 是否切换, 'message': 说明, 'version': 当前版本, 'previous': 切换前的版本}
+
+    切换过程：
+        1. 在调用线程中加载、预编译新索引（旧版本继续服务）
+        2. 一次赋值替换 _compiled_index；进行中的请求持有旧版本的引用，照常完成
+        3. 预编译新索引对应的规则；结果缓存的key包含索引代数，旧版本的缓存自然失效
+        4. 新索引加载失败、或重建尚未全部写完（_index_incomplete）时保留旧版本，返回原因
+    """
+    global _index_data, _compiled_index, _vector_index
+
+    with _reload_lock:
+        old = _compiled_index
+        previous = index_version()
+        index_path = _index_path()
+        if not os.path.exists(index_path):
+            return {'reloaded': False, 'message': f'索引文件不存在: {index_path}',
+                    'version': previous, 'previous': previous}
+
+        incomplete = _index_incomplete()
+        if incomplete:
+            return {'reloaded': False, 'message': f'索引重建尚未完成: {incomplete}',
+                    'version': previous, 'previous': previous}
+
+        try:
+            signature = _index_signature()
+            checksum = _index_checksum(index_path)
+            if old is not None and not force and checksum == old['version']['checksum']:
+                old['version']['signature'] = signature  # 内容未变，记录新签名避免重复检查
+                return {'reloaded': False, 'message': '索引内容未变化',
+                        'version': previous, 'previous': previous}
+            data, ci = _open_index_version(index_path, checksum)
+        except Exception as e:
+            print(f"⚠️  新索引加载失败，继续使用当前版本: {e}")
+            return {'reloaded': False, 'message': f'新索引加载失败: {e}',
+                    'version': previous, 'previous': previous}
+
+        _index_data, _compiled_index, _vector_index = data, ci, ci['vector_index']
+        get_rules(ci)  # 预编译规则，切换后的第一个请求不用等待
+        if _encoder == 'student':
+            _check_student()  # 新索引换了编码器时提示重新蒸馏
+
+        current = index_version()
+        print(f"🔄 索引已切换: {(previous or {}).get('version')} → {current['version']}"
+              f"（{current['n_diseases']} 个疾病）")
+        return {'reloaded': True, 'message': 'success', 'version': current, 'previous': previous}
+
+def _watch_index(stop, interval):
+    """
+    监视线程主循环：签名连续两次检查一致、版本标记与索引目录和向量索引一致（重建已写完），
+    且与当前版本不同时重新加载
+    """
+    pending = None
+    while not stop.wait(interval):
+        ci = _compiled_index
+        if ci is None:
+            continue
+        try:
+            signature = _index_signature()
+            if signature == ci['version']['signature']:
+                pending = None
+            elif signature != pending or _index_incomplete():
+                pending = signature  # 文件仍在变化（重建进行中），下一轮再确认
+            else:
+                pending = None
+                reload_index()
+        except Exception as e:
+            print(f"⚠️  索引监视出错: {e}")
+
+def start_index_watcher(interval=None):
+    """
+    启动索引文件监视线程（可重复调用，已启动时直接返回）
+
+    参数：
+        interval (float): 检查间隔（秒），默认 INDEX_WATCH_INTERVAL
+
+    示例：
+        >>> start_index_watcher()  # Flask 启动后调用；重建索引后约 2×interval 秒内自动切换
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is not None and _watcher[0].is_alive():
+            return
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=_watch_index, args=(stop, interval or INDEX_WATCH_INTERVAL),
+            name='index-watcher', daemon=True
+        )
+        thread.start()
+        _watcher = (thread, stop)
+
+def stop_index_watcher():
+    """停止索引文件监视线程"""
+    global _watcher
+    if _watcher is not None:
+        _watcher[1].set()
+        _watcher = None
+
+# ==================== 第6部分（续）：查询缓存 ====================
+
+class QueryCache:
+    """
+    线程安全的LRU缓存（带过期时间和命中统计）
+
+    用途：
+        - 查询向量缓存：规范化查询 → 768维查询向量（命中时跳过BERT前向传播）
+        - 结果缓存：(规范化查询, 参数) → Top-K结果
+
+    统计：
+        hits / misses / evictions（超出容量被淘汰）/ expirations（超时失效）
+    """
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key → (写入时间, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """读取缓存，未命中或已过期返回None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if self.ttl and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)  # 标记为最近使用
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """清空缓存（统计计数保留）"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """返回统计信息（用于 /api/health）"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+_embedding_cache = QueryCache()  # 查询向量缓存
+_result_cache = QueryCache()  # Top-K结果缓存
+
+def canonical_query(tokens):
+    """
+    规范化查询：去重 + 排序 + 添加[SYM]标记
+
+    参数：
+        tokens (list[str]): 症状词列表
+
+    返回：
+        str: 规范化后的查询文本（同时作为缓存key和BERT输入）
+
+    示例：
+        >>> canonical_query(['发热', '头痛', '发热'])
+        '[SYM] 发热 头痛'
+    
+    说明：
+        症状之间没有顺序关系，"头痛 发热"与"发热 头痛"编码为同一个向量，
+        保证缓存命中与否不影响预测结果
+    """
+    return format_query(sorted({t for t in tokens if t}))
+
+def _encode_texts(tok, enc, texts):
+    """
+    批量编码查询文本（padding到批内最大长度）
+
+    返回：
+        np.ndarray: (len(texts), 768) 已L2归一化的向量
+    """
+    if isinstance(enc, OnnxEncoder):
+        return enc.encode(tok, texts)
+
+    device = next(enc.parameters()).device
+    enc_in = tok(
+        list(texts),
+        max_length=MAX_LEN,  # 最大长度128
+        truncation=True,  # 超过最大长度时截断
+        padding=True,  # padding到批内最大长度
+        return_tensors='pt'  # 返回PyTorch张量
+    )
+    enc_in = {k: v.to(device) for k, v in enc_in.items()}
+    with torch.no_grad():
+        out = enc(**enc_in, return_dict=True)
+        vecs = mean_pooling(out.last_hidden_state, enc_in['attention_mask'])
+        vecs = torch.nn.functional.normalize(vecs, p=2, dim=1)
+    return vecs.cpu().numpy()
+
+def encode_query(tok, enc, wrapped_query):
+    """
+    获取查询向量（先查缓存，未命中时运行BERT并写入缓存）
+
+    参数：
+        tok / enc: load_model() 返回的分词器和模型
+        wrapped_query (str): canonical_query() 的结果
+
+    返回：
+        np.ndarray: (768,) 已L2归一化的查询向量（只读）
+    """
+    key = (enc.cache_generation, wrapped_query)
+    vec = _embedding_cache.get(key)
+    if vec is not None:
+        return vec
+
+    if BATCHING_ENABLED:
+        # 交给后台批处理线程，与其他并发请求合并为一次前向传播
+        vec = _get_batcher(tok, enc).submit(wrapped_query).result()
+    else:
+        vec = _encode_texts(tok, enc, [wrapped_query])[0]
+    vec.setflags(write=False)  # 缓存共享，禁止原地修改
+    _embedding_cache.put(key, vec)
+    return vec
+
+def _copy_results(results):
+    """复制结果列表（调用方会修改字典和症状列表）"""
+    return [dict(r, symptoms=list(r['symptoms'])) for r in results]
+
+def configure_query_cache(max_size=None, ttl=None, cache_results=None):
+    """
+    修改查询缓存配置（会清空现有缓存）
+
+    参数：
+        max_size (int): 最大条目数，0表示禁用缓存
+        ttl (float): 过期时间（秒），0表示永不过期
+        cache_results (bool): 是否缓存最终Top-K结果
+    """
+    global CACHE_RESULTS
+    for cache in (_embedding_cache, _result_cache):
+        if max_size is not None:
+            cache.max_size = int(max_size)
+        if ttl is not None:
+            cache.ttl = ttl
+        cache.clear()
+    if cache_results is not None:
+        CACHE_RESULTS = bool(cache_results)
+
+def query_cache_stats():
+    """
+    查询缓存统计（供 /api/health 使用）
+
+    返回：
+        dict: {'embedding': {...}, 'result': {...}, 'cache_results': bool}
+    """
+    return {
+        'embedding': _embedding_cache.stats(),
+        'result': _result_cache.stats(),
+        'cache_results': CACHE_RESULTS,
+    }
+
+# ==================== 第6部分（续）：微批处理编码 ====================
+
+class QueryBatcher:
+    """
+    查询编码微批处理器（后台线程）
+
+    工作方式：
+        1. 请求线程调用 submit(text)，立即得到一个 Future
+        2. 后台线程取到第一个查询后，最多再等待 max_wait_ms 毫秒，
+           或凑满 max_batch 个查询，然后做一次padding批量前向传播
+        3. 每个查询的向量通过各自的 Future 返回给调用方
+
+    作用：
+        并发请求时吞吐量随批大小增长，而不是被 batch_size=1 的固定开销限制；
+        单个请求的额外延迟不超过 max_wait_ms
+    """
+    def __init__(self, tok, enc, max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.tok = tok
+        self.enc = enc
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self.batches = 0  # 已执行的前向传播次数
+        self.items = 0  # 已编码的查询数
+        self.max_seen = 0  # 出现过的最大批大小
+        self._thread = threading.Thread(target=self._run, name='QueryBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """提交一个查询，返回 Future（result() 为 (768,) 向量）"""
+        fut = Future()
+        if self._stopped.is_set():
+            fut.set_exception(RuntimeError('批处理器已停止'))
+        else:
+            self._queue.put((text, fut))
+        return fut
+
+    def _collect(self):
+        """阻塞等待第一个查询，然后在延迟上限内收集一批"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # 留给下一轮退出
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            # 同一批内相同的查询只编码一次
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vecs = _encode_texts(self.tok, self.enc, texts)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+
+            by_text = dict(zip(texts, vecs))
+            for text, fut in batch:
+                fut.set_result(by_text[text].copy())
+
+            self.batches += 1
+            self.items += len(batch)
+            self.max_seen = max(self.max_seen, len(batch))
+
+    def stop(self):
+        """停止后台线程（已提交的查询会先处理完）"""
+        self._stopped.set()
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0,
+            'max_batch_seen': self.max_seen,
+            'pending': self._queue.qsize(),
+        }
+
+_batcher = None  # 当前批处理器
+_batcher_lock = threading.Lock()
+
+def _get_batcher(tok, enc):
+    """获取（必要时创建）绑定到当前模型的批处理器"""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None or _batcher.enc is not enc:
+            if _batcher is not None:
+                _batcher.stop()
+            _batcher = QueryBatcher(tok, enc, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+        return _batcher
+
+def enable_batching(max_batch=None, max_wait_ms=None):
+    """
+    开启微批处理（Flask等多线程服务使用）
+
+    参数：
+        max_batch (int): 每批最多合并的查询数
+        max_wait_ms (float): 等待凑批的最长时间（毫秒），即单请求额外延迟上限
+
+    说明：
+        可重复调用；参数变化时下一次编码会以新参数重建批处理器
+    """
+    global BATCHING_ENABLED, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, _batcher
+    with _batcher_lock:
+        changed = False
+        if max_batch is not None and int(max_batch) != BATCH_MAX_SIZE:
+            BATCH_MAX_SIZE = int(max_batch)
+            changed = True
+        if max_wait_ms is not None and float(max_wait_ms) != BATCH_MAX_WAIT_MS:
+            BATCH_MAX_WAIT_MS = float(max_wait_ms)
+            changed = True
+        if changed and _batcher is not None:
+            _batcher.stop()
+            _batcher = None
+        BATCHING_ENABLED = True
+
+def disable_batching():
+    """关闭微批处理并停止后台线程"""
+    global BATCHING_ENABLED, _batcher
+    with _batcher_lock:
+        BATCHING_ENABLED = False
+        if _batcher is not None:
+            _batcher.stop()
+            _batcher = None
+
+def batching_stats():
+    """微批处理统计（供 /api/health 使用），未开启时返回 None"""
+    b = _batcher
+    if not BATCHING_ENABLED:
+        return None
+    return b.stats() if b is not None else {'max_batch': BATCH_MAX_SIZE, 'max_wait_ms': BATCH_MAX_WAIT_MS,
+                                            'batches': 0, 'items': 0}
+
+# ==================== 第7部分：核心预测函数 ====================
+
+def _rank_diseases(q, q_tokens, ci, topk, min_score, lexical, rows=None):
+    """
+    对单个查询向量打分并返回Top-K（语义相似度 + 词面匹配 + 规则引擎）
+
+    参数：
+        q (np.ndarray): (768,) 已L2归一化的查询向量
+        q_tokens (list[str]): 查询症状词（已去除字段标记）
+        ci (dict): 预编译索引
+        topk (int) / min_score (float) / lexical (str): 同 predict_disease
+        rows (np.ndarray): 向量索引召回的候选疾病ID；None表示对全部疾病打分
+
+    返回：
+        list[dict]: 结果列表（格式见 predict_disease 的 return_dict=True）
+    """
+    # 规则来自 disease_rules.json，已编译为逐疾病的掩码/乘数数组（文件变化时自动重新编译）
+    rules = get_rules(ci)
+    
+    # 只对候选疾病打分：索引和规则都切到候选子集，后续计算与全量完全相同
+    if rows is not None:
+        ci = _candidate_view(ci, rows)
+        rules = _candidate_rules(rules, rows)
+    
+    embs = ci['embeddings']  # (N, 768) 所有疾病的BERT向量
+    names = ci['names']  # list[str] 疾病名称
+    cats = ci['categories']  # list[str] 科室
+    symps = ci['symptoms']  # list[list[str]] 症状列表
+    
+    # ==================== 第3步：计算语义相似度 ====================
+    # 余弦相似度 = 向量点积（因为已L2归一化）
+    sims = embs @ q  # (N,) 所有疾病与查询的相似度
+    
+    # ==================== 第4步：计算词面匹配得分 ====================
+    # 稀疏矩阵-向量乘法一次算出所有疾病的得分（与语义分同精度存储）
+    lex_scores = _lexical_scores(q_tokens, ci, mode=lexical).astype(sims.dtype)  # (N,)
+    
+    # ==================== 第5步：融合基础分数 ====================
+    # ⚠️  原逻辑：final = alpha*语义 + (1-alpha)*词面
+    # ✅  新逻辑：仅使用语义分（规则引擎会调整）
+    final_scores = sims  # (N,) 基础分 = 语义相似度
+    
+    # 转换为集合（用于后续规则判断）
+    q_token_set = set(q_tokens)
+    
+    # ==================== 第6步：医学规则引擎 ====================
+    # ===== 🎯 规则1：单症状查询特殊处理 =====
+    if len(q_token_set) == 1:
+        """
+        单症状策略：
+        - 用户只输入一个症状时（如"头痛"），倾向于返回常见病
+        - 原因：单症状信息量少，应避免推荐罕见病
+        
+        实现：
+        - 规则文件中定义【症状→常见病集合】映射（已编译为 症状×疾病 掩码矩阵）
+        - 如果疾病在集合中，加权 × 1.50（+50%）
+        """
+        single_symptom = next(iter(q_token_set))
+        
+        # 合并所有命中症状键的常见病掩码（模糊匹配："头痛"匹配"偏头痛"）
+        hit_keys = [k for k, key in enumerate(rules['single_keys']) if key in single_symptom]
+        if hit_keys:
+            common_mask = rules['single_masks'][hit_keys].any(axis=0)
+            final_scores *= np.where(common_mask, rules['single_boost'], 1.0)
+    
+    # ===== 🎯 规则2：多症状匹配逻辑（关键优化） =====
+    else:
+        """
+        多症状策略：
+        - 用户输入2个或更多症状时，计算精确匹配度和模糊匹配度
+        - 根据匹配情况进行差异化加权
+        
+        匹配指标：
+        1. 精确匹配数：查询症状词在文档症状词中的精确匹配数量
+        2. 模糊匹配数：包含关系匹配（如"头痛"匹配"偏头痛"）
+        3. 匹配率：综合考虑查询侧和文档侧的匹配比例
+        
+        加权策略：
+        - 完全匹配（所有症状都精确匹配）: × 1.40（+40%）
+        - 高匹配率（≥70%）: × 1.15（+15%）
+        - 中匹配率（50~70%）: × 1.08（+8%）
+        - 低匹配率（30~50%）: × 1.00（不变）
+        - 极低匹配率（<30%）: × 0.60（-40%）
+        """
+        # 稀疏矩阵乘法一次得到所有疾病的精确匹配数和匹配率
+        exact_count, match_ratio = _match_features(q_token_set, ci)
+        
+        # 🔥 根据匹配信息加权
+        # ⭐⭐⭐ 完全匹配大幅奖励：精确匹配数 = 查询症状数 且 查询症状数 ≥ 2
+        full_match = (exact_count == len(q_token_set)) & (len(q_token_set) >= 2)
+        for i in np.flatnonzero(full_match):
+            print(f"[DEBUG] 完全匹配: {names[i]} (精确匹配{int(exact_count[i])}个症状，分数 × 1.40)")
+        
+        # 其他匹配率加权：高 +15% / 中 +8% / 低 不变 / 极低 -40%
+        final_scores *= np.select(
+            [full_match, match_ratio >= 0.7, match_ratio >= 0.5, match_ratio >= 0.3],
+            [1.40, 1.15, 1.08, 1.00],
+            default=0.60
+        )
+        
+        # ⭐⭐⭐ 非核心常见病降权：多症状查询时避免过度推荐"感冒"等高频病
+        final_scores *= np.where(rules['very_common_mask'], 1.0, rules['very_common_penalty'])
+    
+    # ==================== 第7步：通用降权（单/多症状都生效） ====================
+    
+    # ===== 🎯 规则3：罕见病降权 =====
+    # 避免推荐低概率疾病（如"骨髓炎"、"败血症"等），× 0.35
+    final_scores *= np.where(rules['rare_mask'], rules['rare_penalty'], 1.0)
+    
+    # ===== 🎯 规则4：专科病在通用症状下降权 =====
+    """
+    策略：
+    - 如果查询症状数 ≤ 2（通用症状）
+    - 且疾病属于专科（骨科、男科、泌尿外科等）
+    - 且症状中不包含专科关键词（如"骨折"、"阴茎"等）
+    - 则降权（× 0.45，即-55%）
+    """
+    if len(q_token_set) <= rules['specialist_max_terms']:
+        query_text = ' '.join(q_tokens)
+        if not any(k in query_text for k in rules['specialist_keywords']):
+            final_scores *= np.where(rules['specialist_mask'], rules['specialist_penalty'], 1.0)
+    
+    # ==================== 第8步：通用常见病加权（所有查询生效） ====================
+    # 极常见病 × 1.35，常见病 × 1.25~1.30，较常见病 × 1.15~1.20（权重见规则文件）
+    final_scores *= rules['common_mult']
+    
+    # ==================== 第9步：选出Top-K并收集结果 ====================
+    # 先按 min_score 过滤，再用 argpartition 选Top-K（只对K个结果排序，不再全量排序）
+    order = select_topk(final_scores, topk, min_score=min_score)
+    
+    return [{
+        'name': str(names[idx]),  # 疾病名称
+        'category': str(cats[idx]),  # 科室
+        'score': float(final_scores[idx]),  # 最终得分
+        'semantic_score': float(sims[idx]),  # 语义得分
+        'lexical_score': float(lex_scores[idx]),  # 词面得分
+        'symptoms': symps[idx][:5]  # 症状列表（最多5个）
+    } for idx in order]
+
+
+def _format_results(results, raw_tokens, return_dict):
+    """
+    按调用方式返回结果：字典列表（Flask）或格式化文本（命令行）
+    """
+    # 根据return_dict参数决定返回格式
+    if return_dict:
+        # Flask模式：返回字典列表
+        return results
+    else:
+        # 命令行模式：返回格式化文本
+        if results:
+            lines = [f"\n🔍 查询: {' '.join(raw_tokens)}"]
+            for i, r in enumerate(results, 1):
+                lines.append(
+                    f"{i:>2}. {r['name']}  [{r['category']}]  "
+                    f"相似度: {r['score']:.4f}"
+                )
+                if r['symptoms']:
+                    lines.append(f"    症状: {'、'.join(r['symptoms'][:8])}")
+            return '\n'.join(lines)
+        else:
+            return "⚠️  未找到达到阈值的结果"
+
+@torch.no_grad()  # 禁用梯度计算（推理模式，节省显存）
+def predict_disease(
+    symptoms,  # 用户输入的症状文本
+    topk=5,  # 返回前K个结果
+    min_score=0.3,  # 最低相似度阈值
+    alpha=0.7,  # 语义权重（已废弃，保留兼容性）
+    lexical='fuzzy',  # 词面匹配模式
+    return_dict=False  # 返回格式（False=纯文本，True=字典列表）
+):
+    """
+    症状预测疾病（混合系统：BERT语义 + 词面匹配 + 医学规则）
+    
+    参数详解：
     ========
     symptoms (str): 用户输入的症状文本
         格式：空格分隔的症状词
@@ -535,7 +2336,7 @@ def predict_disease(
     ========
     1️⃣  加载模型和索引
     2️⃣  编码查询文本（BERT向量）
-    3️⃣  计算语义相似度（余弦相似度）
+    3️⃣  向量索引召回候选（未构建时为全部疾病），计算语义相似度（余弦相似度）
     4️⃣  计算词面匹配得分
     5️⃣  融合基础分数
     6️⃣  应用医学规则引擎：
@@ -559,378 +2360,45 @@ def predict_disease(
         # ==================== 第1步：加载模型和索引 ====================
         tok, enc, data = load_model()
         
-        # 提取索引数据
-        embs = data['embeddings']  # (N, 768) 所有疾病的BERT向量
-        names = data['names']  # (N,) 疾病名称数组
-        cats = data['categories']  # (N,) 科室数组
-        symps = [json.loads(s) for s in data['symptoms']]  # list[list[str]] 症状列表
-        
-        # 读取IDF字典（用于加权词面匹配）
-        idf = {}
-        if 'idf_terms' in data and 'idf_vals' in data:
-            terms = data['idf_terms']  # 症状词表
-            vals = data['idf_vals']  # 对应IDF值
-            idf = {str(k): float(v) for k, v in zip(terms, vals)}
-        
-        # 获取设备
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # 预编译索引（症状JSON和IDF字典已在load_model中解析完毕）
+        ci = _compiled_index
         
         # ==================== 第2步：编码查询文本 ====================
         # 1. 预处理：提取症状词
         raw_tokens = [t for t in symptoms.strip().split() if t]
         
-        # 2. 格式化：添加字段标记
-        wrapped_query = format_query(raw_tokens)  # "头痛 发热" → "[SYM] 头痛 发热"
-        
-        # 3. 分词编码
-        enc_in = tok(
-            [wrapped_query],  # 输入文本列表（batch_size=1）
-            max_length=MAX_LEN,  # 最大长度128
-            truncation=True,  # 超过最大长度时截断
-            padding=True,  # padding到最大长度
-            return_tensors='pt'  # 返回PyTorch张量
-        )
-        
-        # 4. 移动到设备
-        enc_in = {k: v.to(device) for k, v in enc_in.items()}
-        
-        # 5. BERT前向传播
-        out = enc(**enc_in, return_dict=True)
-        
-        # 6. 平均池化 + L2归一化
-        q = mean_pooling(out.last_hidden_state, enc_in['attention_mask'])
-        q = torch.nn.functional.normalize(q, p=2, dim=1).cpu().numpy()[0]
-        # q: (768,) 查询向量（已L2归一化）
-        
-        # ==================== 第3步：计算语义相似度 ====================
-        # 余弦相似度 = 向量点积（因为已L2归一化）
-        sims = embs @ q  # (N,) 所有疾病与查询的相似度
-        
-        # ==================== 第4步：计算词面匹配得分 ====================
+        # 2. 规范化：去重 + 排序 + 添加字段标记
+        #    "发热 头痛 发热" → "[SYM] 发热 头痛"（相同症状组合命中同一条缓存）
+        wrapped_query = canonical_query(raw_tokens)
         q_tokens = _tokens_from_query_text(wrapped_query)  # 提取症状词
-        lex_scores = np.zeros_like(sims)  # (N,) 初始化为0
-        
-        for i, s in enumerate(symps):
-            lex_scores[i] = _lexical_score(q_tokens, s, mode=lexical, idf=idf)
-        
-        # ==================== 第5步：融合基础分数 ====================
-        # ⚠️  原逻辑：final = alpha*语义 + (1-alpha)*词面
-        # ✅  新逻辑：仅使用语义分（规则引擎会调整）
-        final_scores = sims  # (N,) 基础分 = 语义相似度
-        
-        # 转换为集合（用于后续规则判断）
-        q_token_set = set(q_tokens)
-        
-        # ==================== 第6步：医学规则引擎 ====================
-        
-        # ===== 🎯 规则1：单症状查询特殊处理 =====
-        if len(q_token_set) == 1:
-            """
-            单症状策略：
-            - 用户只输入一个症状时（如"头痛"），倾向于返回常见病
-            - 原因：单症状信息量少，应避免推荐罕见病
-            
-            实现：
-            - 定义【症状→常见病集合】映射
-            - 如果疾病在集合中，加权 × 1.50（+50%）
-            """
-            single_symptom = list(q_token_set)[0]
-            
-            # 症状-常见病映射表
-            # 说明：每个症状对应一组典型的常见病
-            SYMPTOM_COMMON_MAP = {
-                '发热': {
-                    '感冒', '流行性感冒', '上呼吸道感染', 
-                    '急性扁桃体炎', '急性咽炎', '急性支气管炎', 
-                    '肺炎', '扁桃体炎'
-                },
-                '发烧': {
-                    '感冒', '流行性感冒', '上呼吸道感染', 
-                    '急性扁桃体炎', '急性咽炎', '急性支气管炎', '肺炎'
-                },
-                '头痛': {
-                    '感冒', '偏头痛', '紧张性头痛', '神经性头痛', 
-                    '流行性感冒', '上呼吸道感染', '高血压'
-                },
-                '头疼': {
-                    '感冒', '偏头痛', '紧张性头痛', '神经性头痛', 
-                    '流行性感冒', '上呼吸道感染'
-                },
-                '咳嗽': {
-                    '急性支气管炎', '肺炎', '感冒', '咽炎', 
-                    '流行性感冒', '支气管炎', '慢性支气管炎'
-                },
-                '咽痛': {
-                    '急性咽炎', '急性扁桃体炎', '感冒', 
-                    '流行性感冒', '上呼吸道感染'
-                },
-                '鼻塞': {
-                    '感冒', '过敏性鼻炎', '鼻炎', '鼻窦炎', '上呼吸道感染'
-                },
-                '腹痛': {
-                    '急性胃肠炎', '急性胃炎', '胃溃疡', '肠炎', '阑尾炎'
-                },
-                '腹泻': {
-                    '急性胃肠炎', '肠炎', '急性肠炎', '病毒性肠炎'
-                },
-                '呕吐': {
-                    '急性胃肠炎', '急性胃炎', '食物中毒', '胃炎'
-                },
-                '胸痛': {
-                    '冠心病', '心绞痛', '肺炎', '肋间神经痛', '胸膜炎'
-                },
-                '呼吸困难': {
-                    '哮喘', '肺炎', '心力衰竭', '支气管炎'
-                },
-            }
-            
-            # 查找当前症状对应的常见病集合
-            SYMPTOM_COMMON = set()
-            for key, diseases in SYMPTOM_COMMON_MAP.items():
-                if key in single_symptom:  # 模糊匹配（"头痛"匹配"头疼"）
-                    SYMPTOM_COMMON.update(diseases)
-            
-            # 单症状常见病加权
-            for i, name in enumerate(names):
-                dn = str(name)
-                if dn in SYMPTOM_COMMON:
-                    final_scores[i] *= 1.50  # +50%奖励
         
-        # ===== 🎯 规则2：多症状匹配逻辑（关键优化） =====
-        else:
-            """
-            多症状策略：
-            - 用户输入2个或更多症状时，计算精确匹配度和模糊匹配度
-            - 根据匹配情况进行差异化加权
-            
-            匹配指标：
-            1. 精确匹配数：查询症状词在文档症状词中的精确匹配数量
-            2. 模糊匹配数：包含关系匹配（如"头痛"匹配"偏头痛"）
-            3. 匹配率：综合考虑查询侧和文档侧的匹配比例
-            
-            加权策略：
-            - 完全匹配（所有症状都精确匹配）: × 1.40（+40%）
-            - 高匹配率（≥70%）: × 1.15（+15%）
-            - 中匹配率（50~70%）: × 1.08（+8%）
-            - 低匹配率（30~50%）: × 1.00（不变）
-            - 极低匹配率（<30%）: × 0.60（-40%）
-            """
-            # 存储每个疾病的匹配信息
-            match_info = []
-            
-            for i, s in enumerate(symps):
-                if not s:
-                    # 如果疾病没有症状列表，跳过
-                    match_info.append({'exact_count': 0, 'match_ratio': 0.0})
-                    continue
-                
-                d_token_set = set(s)  # 文档症状词集合
-                
-                # 1️⃣ 精确匹配
-                exact_matches = q_token_set & d_token_set  # 交集
-                exact_count = len(exact_matches)
-                
-                # 2️⃣ 模糊匹配（包含关系）
-                matched_count = exact_count  # 初始化为精确匹配数
-                remaining_q = q_token_set - exact_matches  # 未精确匹配的查询症状
-                remaining_d = d_token_set - exact_matches  # 未精确匹配的文档症状
-                
-                # 遍历未精确匹配的查询症状，检查是否被文档症状包含
-                for qt in remaining_q:
-                    if any(qt in dt or dt in qt for dt in remaining_d):
-                        matched_count += 0.5  # 模糊匹配计0.5分
-                
-                # 3️⃣ 计算匹配率（调和平均）
-                # 查询侧匹配率 = 匹配数 / 查询症状数
-                match_ratio_q = matched_count / max(1, len(q_token_set))
-                
-                # 文档侧匹配率 = 匹配数 / 文档症状数
-                match_ratio_d = matched_count / max(1, len(d_token_set))
-                
-                # 调和平均（平衡两侧）
-                if match_ratio_q > 0 or match_ratio_d > 0:
-                    match_ratio = 2 * (match_ratio_q * match_ratio_d) / \
-                                  max(1e-9, match_ratio_q + match_ratio_d)
-                else:
-                    match_ratio = 0.0
-                
-                # 存储匹配信息
-                match_info.append({
-                    'exact_count': exact_count,
-                    'match_ratio': match_ratio
-                })
-            
-            # 🔥 根据匹配信息加权
-            for i, info in enumerate(match_info):
-                # ⭐⭐⭐ 完全匹配大幅奖励（新增）
-                # 条件：精确匹配数 = 查询症状数 且 查询症状数 ≥ 2
-                if info['exact_count'] == len(q_token_set) and len(q_token_set) >= 2:
-                    final_scores[i] *= 1.40  # +40%奖励
-                    print(f"[DEBUG] 完全匹配: {names[i]} (精确匹配{info['exact_count']}个症状，分数 × 1.40)")
-                
-                # 其他匹配率加权
-                elif info['match_ratio'] >= 0.7:
-                    final_scores[i] *= 1.15  # 高匹配率 +15%
-                elif info['match_ratio'] >= 0.5:
-                    final_scores[i] *= 1.08  # 中匹配率 +8%
-                elif info['match_ratio'] >= 0.3:
-                    final_scores[i] *= 1.00  # 低匹配率 不变
-                else:
-                    final_scores[i] *= 0.60  # 极低匹配率 -40%
-            
-            # ⭐⭐⭐ 非核心常见病降权（新增）
-            """
-            策略：
-            - 在多症状查询时，避免过度推荐"感冒"等高频病
-            - 只保留核心常见病的高权重，其他病降权
-            """
-            VERY_COMMON = {
-                '感冒', '流行性感冒', '上呼吸道感染', '急性胃肠炎', 
-                '急性支气管炎', '肺炎', '急性咽炎', '急性扁桃体炎',
-                '急性胃炎', '偏头痛', '紧张性头痛'
-            }
-            
-            for i, name in enumerate(names):
-                dn = str(name)
-                if dn not in VERY_COMMON:
-                    final_scores[i] *= 0.88  # 非核心病降权12%
-        
-        # ==================== 第7步：通用降权（单/多症状都生效） ====================
-        
-        # ===== 🎯 规则3：罕见病降权 =====
-        """
-        策略：
-        - 定义罕见病列表（发病率低、专科病、测试病等）
-        - 在所有查询中，大幅降权罕见病（× 0.35，即-65%）
-        
-        作用：
-        - 避免推荐低概率疾病（如"骨髓炎"、"败血症"等）
-        - 提升用户体验（优先推荐常见病）
-        """
-        RARE_DISEASES = {
-            '第1跖趾骨关节炎', '开放性骨折', '水痛症', '立克次体病', 
-            '骨髓炎', '败血症', '脓毒血症', '肢端肥大症性心肌病',
-            '密集恐惧症', '念珠菌性包皮龟头炎', '白屑风', '头风病',
-            '股骨粗隆间骨折', '股骨转子间骨折', '踝部骨折',
-            '混合型卟啉病', '黄体血肿', '肾胚胎瘤',
-            '陈旧性肺结核', '婴幼儿脐疝',
-            '泛细支气管炎-测试', '念珠菌性包皮龟头炎-测试',
-        }
+        # 3. 结果缓存（规则或索引变化后key随之变化，旧结果自然失效）
+        result_key = (wrapped_query, topk, min_score, lexical,
+                      ci['generation'], get_rules(ci)['generation'])
+        cached = _result_cache.get(result_key) if CACHE_RESULTS else None
+        if cached is not None:
+            results = _copy_results(cached)
+            return _format_results(results, raw_tokens, return_dict)
         
-        for i, name in enumerate(names):
-            dn = str(name)
-            
-            # 罕见病降权
-            if dn in RARE_DISEASES:
-                final_scores[i] *= 0.35  # -65%（大幅降权）
-            
-            # ===== 🎯 规则4：专科病在通用症状下降权 =====
-            """
-            策略：
-            - 如果查询症状数 ≤ 2（通用症状）
-            - 且疾病属于专科（骨科、男科、泌尿外科等）
-            - 且症状中不包含专科关键词（如"骨折"、"阴茎"等）
-            - 则降权（× 0.45，即-55%）
-            
-            作用：
-            - 避免"头痛"查询时推荐"股骨骨折"等专科病
-            - 提升推荐的相关性
-            """
-            if len(q_token_set) <= 2:
-                # 专科科室列表
-                specialist_depts = ['骨外科', '骨科', '男科', '泌尿外科', 
-                                   '血液科', '小儿外科']
-                
-                # 专科关键词（如果症状中包含这些词，不降权）
-                specialist_keywords = ['骨折', '骨痛', '阴茎', '包皮', 
-                                      '龟头', '血液', '贫血', '脐']
-                
-                # 判断是否需要降权
-                if str(cats[i]) in specialist_depts and \
-                   not any(k in ' '.join(q_tokens) for k in specialist_keywords):
-                    final_scores[i] *= 0.45  # -55%
+        # 4. 查询向量（命中缓存时跳过BERT前向传播）
+        q = encode_query(tok, enc, wrapped_query)  # (768,) 已L2归一化
+        q = project_queries(q, ci['projection'])  # 降维索引：施加同一PCA投影（缓存的是投影前的向量）
         
-        # ==================== 第8步：通用常见病加权（所有查询生效） ====================
-        """
-        策略：
-        - 定义常见病列表及对应权重
-        - 在所有查询中，对常见病进行加权
+        # ==================== 第3~9步：召回、打分、规则引擎、排序 ====================
+        # 有近似向量索引时先召回 CANDIDATE_K 个语义最近的疾病并入词面命中的疾病，规则引擎只对候选打分
+        rows = None
+        if ci['vector_index'] is not None and ci['vector_index'].kind != 'exact':
+            ids = ci['vector_index'].search(q, CANDIDATE_K)[0][0]
+            rows = _candidate_rows(ids, q_tokens, ci)
         
-        权重设计：
-        - 极常见病（如"感冒"）: × 1.35（+35%）
-        - 常见病（如"流感"）: × 1.25~1.30（+25%~30%）
-        - 较常见病（如"肺炎"）: × 1.15~1.20（+15%~20%）
+        results = _rank_diseases(q, q_tokens, ci, topk, min_score, lexical, rows=rows)
         
-        作用：
-        - 提升常见病的排序位置
-        - 符合医学统计规律（常见病更常见）
-        """
-        COMMON_DISEASES = {
-            '感冒': 1.35,  # ⬅️ 从1.30提升到1.35（+35%）
-            '流行性感冒': 1.28,  # ⬅️ 从1.25提升到1.28（+28%）
-            '上呼吸道感染': 1.25,  # ⬅️ 从1.22提升到1.25（+25%）
-            '急性扁桃体炎': 1.20,  # +20%
-            '急性咽炎': 1.20,
-            '急性支气管炎': 1.18,  # +18%
-            '肺炎': 1.15,  # +15%
-            '急性胃肠炎': 1.18,
-            '急性胃炎': 1.15,
-            '偏头痛': 1.20,
-            '紧张性头痛': 1.18,
-            '咽炎': 1.15,
-            '支气管炎': 1.15,
-            '扁桃体炎': 1.18,
-            '慢性支气管炎': 1.12,  # +12%
-        }
-        
-        for i, name in enumerate(names):
-            if str(name) in COMMON_DISEASES:
-                final_scores[i] *= COMMON_DISEASES[str(name)]
-        
-        # ==================== 第9步：排序并收集结果 ====================
-        # 1. 按最终得分降序排序
-        order = np.argsort(-final_scores)
-        
-        # 2. 收集结果
-        results = []
-        for idx in order:
-            # 过滤低分结果
-            if final_scores[idx] < min_score:
-                continue
-            
-            # 添加结果
-            results.append({
-                'name': str(names[idx]),  # 疾病名称
-                'category': str(cats[idx]),  # 科室
-                'score': float(final_scores[idx]),  # 最终得分
-                'semantic_score': float(sims[idx]),  # 语义得分
-                'lexical_score': float(lex_scores[idx]),  # 词面得分
-                'symptoms': symps[idx][:5]  # 症状列表（最多5个）
-            })
-            
-            # 达到Top-K后停止
-            if len(results) >= topk:
-                break
+        # 写入结果缓存（返回副本，调用方修改结果不会污染缓存）
+        if CACHE_RESULTS:
+            _result_cache.put(result_key, _copy_results(results))
         
         # ==================== 第10步：返回结果 ====================
-        # 根据return_dict参数决定返回格式
-        if return_dict:
-            # Flask模式：返回字典列表
-            return results
-        else:
-            # 命令行模式：返回格式化文本
-            if results:
-                lines = [f"\n🔍 查询: {' '.join(raw_tokens)}"]
-                for i, r in enumerate(results, 1):
-                    lines.append(
-                        f"{i:>2}. {r['name']}  [{r['category']}]  "
-                        f"相似度: {r['score']:.4f}"
-                    )
-                    if r['symptoms']:
-                        lines.append(f"    症状: {'、'.join(r['symptoms'][:8])}")
-                return '\n'.join(lines)
-            else:
-                return "⚠️  未找到达到阈值的结果"
+        return _format_results(results, raw_tokens, return_dict)
         
     except Exception as e:
         # 异常处理
@@ -938,6 +2406,215 @@ def predict_disease(
         traceback.print_exc()  # 打印完整堆栈跟踪
         return [] if return_dict else f"❌ 预测失败: {str(e)}"
 
+# ==================== 第7部分（续）：批量预测 ====================
+
+def _rank_batch(Q, q_tokens_list, ci, topk, min_score, lexical):
+    """
+    批量版 _rank_diseases：一次 (B, N) 矩阵乘法 + 按行向量化的规则引擎
+
+    参数：
+        Q (np.ndarray): (B, 768) 已L2归一化的查询向量
+        q_tokens_list (list[list[str]]): 每个查询的症状词
+        ci (dict): 预编译索引
+        topk / min_score / lexical: 同 predict_disease
+
+    返回：
+        list[list[dict]]: 每个查询的结果，与逐条调用 _rank_diseases 一致（浮点误差内）
+
+    说明：
+        - 每一步乘法的顺序、精度都与单条查询相同，只是把 (N,) 换成了 (B, N)
+        - 有近似向量索引时取本批所有候选（_candidate_rows）的并集打分，再把不属于该查询候选的位置屏蔽掉
+    """
+    rules = get_rules(ci)
+    cand_mask = None
+    if ci['vector_index'] is not None and ci['vector_index'].kind != 'exact':
+        ids = ci['vector_index'].search(Q, CANDIDATE_K)[0]
+        per_query = [_candidate_rows(ids[b], q_tokens_list[b], ci) for b in range(len(Q))]
+        rows = np.unique(np.concatenate(per_query))
+        cand_mask = np.zeros((len(Q), len(rows)), dtype=bool)
+        for b, own in enumerate(per_query):
+            cand_mask[b, np.searchsorted(rows, own)] = True
+        ci = _candidate_view(ci, rows)
+        rules = _candidate_rules(rules, rows)
+
+    # ===== 语义相似度：一次矩阵乘法 =====
+    sims = Q @ ci['embeddings'].T  # (B, N)
+    final_scores = sims  # 基础分 = 语义相似度（同单条查询）
+
+    q_token_sets = [set(t) for t in q_tokens_list]
+    n_q = np.array([len(q) for q in q_token_sets])
+    single = n_q == 1
+    multi = ~single
+
+    # ===== 规则1/2：单症状常见病加权、多症状匹配率加权（同一次乘法） =====
+    mult = np.ones(final_scores.shape, dtype=np.float64)
+    for b in np.flatnonzero(single):
+        single_symptom = next(iter(q_token_sets[b]))
+        hit_keys = [k for k, key in enumerate(rules['single_keys']) if key in single_symptom]
+        if hit_keys:
+            common_mask = rules['single_masks'][hit_keys].any(axis=0)
+            mult[b] = np.where(common_mask, rules['single_boost'], 1.0)
+
+    if multi.any():
+        exact_count, match_ratio = _match_features_batch([q_token_sets[b] for b in np.flatnonzero(multi)], ci)
+        n_multi = n_q[multi][:, None]
+        full_match = (exact_count == n_multi) & (n_multi >= 2)
+        mult[multi] = np.select(
+            [full_match, match_ratio >= 0.7, match_ratio >= 0.5, match_ratio >= 0.3],
+            [1.40, 1.15, 1.08, 1.00],
+            default=0.60
+        )
+    final_scores *= mult
+
+    # 多症状查询：非核心常见病降权
+    if multi.any():
+        final_scores[multi] *= np.where(rules['very_common_mask'], 1.0, rules['very_common_penalty'])
+
+    # ===== 规则3：罕见病降权 =====
+    final_scores *= np.where(rules['rare_mask'], rules['rare_penalty'], 1.0)
+
+    # ===== 规则4：专科病在通用症状下降权 =====
+    specialist_rows = [
+        b for b, q_tokens in enumerate(q_tokens_list)
+        if n_q[b] <= rules['specialist_max_terms']
+        and not any(k in ' '.join(q_tokens) for k in rules['specialist_keywords'])
+    ]
+    if specialist_rows:
+        final_scores[specialist_rows] *= np.where(rules['specialist_mask'], rules['specialist_penalty'], 1.0)
+
+    # ===== 常见病加权 =====
+    final_scores *= rules['common_mult']
+
+    # 屏蔽不属于该查询召回候选的疾病
+    if cand_mask is not None:
+        final_scores = np.where(cand_mask, final_scores, -np.inf)
+
+    # ===== 逐行选出Top-K =====
+    orders = []
+    for b in range(len(Q)):
+        order = select_topk(final_scores[b], topk, min_score=min_score)
+        orders.append(order[np.isfinite(final_scores[b, order])])
+    
+    # 词面得分不参与排序：只对本批入选疾病的并集计算
+    picked = np.unique(np.concatenate(orders)) if orders else np.empty(0, dtype=np.int64)
+    picked_view = _candidate_view(ci, picked)
+    
+    batch_results = []
+    for b, q_tokens in enumerate(q_tokens_list):
+        order = orders[b]
+        lex_scores = _lexical_scores(q_tokens, picked_view, mode=lexical).astype(sims.dtype)
+        lex_scores = lex_scores[np.searchsorted(picked, order)]
+        batch_results.append([{
+            'name': str(ci['names'][idx]),
+            'category': str(ci['categories'][idx]),
+            'score': float(final_scores[b, idx]),
+            'semantic_score': float(final_scores[b, idx]),  # 与单条查询一致（基础分数组被原地加权）
+            'lexical_score': float(lex_scores[i]),
+            'symptoms': ci['symptoms'][idx][:5]
+        } for i, idx in enumerate(order)])
+    return batch_results
+
+@torch.no_grad()
+def predict_disease_batch(queries, topk=5, min_score=0.3, lexical='fuzzy', batch_size=None):
+    """
+    批量症状预测（夜间重新分诊等离线任务）
+
+    参数：
+        queries (list[str]): 症状文本列表
+        topk / min_score / lexical: 同 predict_disease
+        batch_size (int): 每批查询数（默认 BATCH_PREDICT_SIZE）
+
+    返回：
+        list[list[dict]]: 与 queries 一一对应，每项同 predict_disease(return_dict=True)
+
+    与逐条调用的区别：
+        - 每批查询去重后一次padding编码、一次 (B, N) 矩阵乘法，规则引擎按行向量化
+        - 不读写查询/结果缓存（避免离线任务把在线热点挤出缓存）
+        - 出错时直接抛出异常（由调用方决定重试或跳过）
+
+    示例：
+        >>> predict_disease_batch(["头痛 发热", "腹痛 呕吐"], topk=3)
+        [[{'name': '感冒', ...}, ...], [{'name': '急性胃肠炎', ...}, ...]]
+    """
+    tok, enc, data = load_model()
+    ci = _compiled_index
+    batch_size = batch_size or BATCH_PREDICT_SIZE
+
+    all_results = []
+    for start in range(0, len(queries), batch_size):
+        chunk = queries[start:start + batch_size]
+        wrapped = [canonical_query([t for t in str(q).strip().split() if t]) for q in chunk]
+        q_tokens_list = [_tokens_from_query_text(w) for w in wrapped]
+
+        # 批内去重后编码（padding到本批最长查询）
+        uniq = list(dict.fromkeys(wrapped))
+        vecs = _encode_texts(tok, enc, uniq)
+        pos = {w: i for i, w in enumerate(uniq)}
+        Q = project_queries(vecs[[pos[w] for w in wrapped]], ci['projection'])
+
+        all_results.extend(_rank_batch(Q, q_tokens_list, ci, topk, min_score, lexical))
+    return all_results
+
+def predict_jsonl(lines, topk=5, min_score=0.3, lexical='fuzzy', batch_size=None):
+    """
+    流式批量预测：逐行读取JSONL，按批预测，逐行产出JSON字符串（生成器）
+
+    参数：
+        lines (Iterable[str | bytes]): 输入行，每行为 {"content": "头痛 发热", ...}、
+                               {"query": "..."}、JSON字符串或纯文本（可直接传入文件或请求体流）
+        其他参数同 predict_disease_batch
+
+    产出：
+        str: 输入记录原样保留，并加上 "results" 字段，例如
+             {"id": 12, "content": "头痛 发热", "results": [{"name": "感冒", ...}]}
+             无法解码的行产出 {"line": 行号, "error": ...}；整批预测失败时该批每条记录带 "error" 字段
+
+    说明：
+        内存占用只与批大小有关，可以直接处理导出的整张 cases 表；
+        单行或单批出错不会中断后续输出，输出顺序与输入一致
+    """
+    batch_size = batch_size or BATCH_PREDICT_SIZE
+
+    def flush(records):
+        # records: [(输入记录, 行错误)]，有行错误的记录不参与预测
+        valid = [rec for rec, err in records if err is None]
+        queries = [str(r.get('content', r.get('query', '')) or '') for r in valid]
+        try:
+            results = iter(predict_disease_batch(queries, topk, min_score, lexical, batch_size))
+            batch_error = None
+        except Exception as e:
+            print(f"❌ 批量预测失败（{len(valid)} 条）: {e}")
+            results, batch_error = None, f'预测失败: {e}'
+        for rec, err in records:
+            if err is not None or batch_error is not None:
+                yield json.dumps(dict(rec, error=err or batch_error), ensure_ascii=False)
+            else:
+                yield json.dumps(dict(rec, results=next(results)), ensure_ascii=False)
+
+    records = []
+    for lineno, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeDecodeError:
+                records.append(({'line': lineno}, '不是合法的UTF-8文本'))
+                continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            rec = line  # 纯文本行
+        records.append((rec if isinstance(rec, dict) else {'content': str(rec)}, None))
+
+        if len(records) >= batch_size:
+            yield from flush(records)
+            records = []
+
+    if records:
+        yield from flush(records)
+
 # ==================== 第8部分：命令行入口 ====================
 
 def main():
@@ -955,6 +2632,21 @@ def main():
     测试模式：
         python disease_predictor.py --test
     
+    评分一致性校验：
+        python disease_predictor.py --check_parity
+    
+    批量预测（JSONL输入输出，每行 {"id": ..., "content": "头痛 发热"}）：
+        python disease_predictor.py --batch-file cases.jsonl --output triage.jsonl
+    
+    导出ONNX（含INT8量化）并对比：
+        python disease_predictor.py --export_onnx
+        python disease_predictor.py --query "头痛 发热" --backend onnx-int8
+    
+    使用蒸馏的学生查询编码器（可与ONNX后端组合）：
+        python disease_predictor.py --query "头痛 发热" --encoder student
+        python disease_predictor.py --export_onnx --encoder student
+        python disease_predictor.py --query "头痛 发热" --encoder student --backend onnx-int8
+    
     帮助信息：
         python disease_predictor.py --help
     """
@@ -977,12 +2669,66 @@ def main():
                     help='词面匹配模式（默认wexact）')
     ap.add_argument('--test', action='store_true',
                     help='测试模式（运行预定义查询）')
+    ap.add_argument('--check_parity', action='store_true',
+                    help='校验向量化评分与原始逐疾病评分是否一致（无需加载模型）')
+    ap.add_argument('--batch_file', '--batch-file', type=str, default=None,
+                    help='批量预测：JSONL输入文件（"-" 表示标准输入）')
+    ap.add_argument('--output', type=str, default=None,
+                    help='批量预测输出JSONL文件（默认标准输出）')
+    ap.add_argument('--batch_size', type=int, default=BATCH_PREDICT_SIZE,
+                    help=f'批量预测每批查询数（默认{BATCH_PREDICT_SIZE}）')
+    ap.add_argument('--backend', type=str, default=None, choices=list(BACKENDS),
+                    help=f'推理后端（默认 {BACKEND}，可用环境变量 PREDICTOR_BACKEND 设置）')
+    ap.add_argument('--encoder', type=str, default=None, choices=list(QUERY_ENCODERS),
+                    help=f'查询编码器（默认 {QUERY_ENCODER}，可用环境变量 PREDICTOR_QUERY_ENCODER 设置）；'
+                         f'同时作用于 --export_onnx / --compare_backends')
+    ap.add_argument('--export_onnx', action='store_true',
+                    help='导出ONNX模型（含INT8量化）并报告与torch模型的偏差')
+    ap.add_argument('--no_quantize', action='store_true',
+                    help='导出ONNX时不生成INT8量化模型')
+    ap.add_argument('--compare_backends', action='store_true',
+                    help='对比已导出的ONNX模型与torch模型（余弦偏差、Top-K一致率、延迟）')
     
     # 解析参数
     args = ap.parse_args()
     
+    # 选择推理后端和查询编码器（predict_disease 内部的 load_model() 会沿用）
+    if (args.backend or args.encoder) and (args.test or args.query or args.batch_file):
+        load_model(backend=args.backend, encoder=args.encoder)
+    
     # 执行操作
-    if args.test:
+    if args.check_parity:
+        # ===== 评分一致性校验 =====
+        mismatches = check_synthetic_parity()
+        mismatches += check_scorer_parity()
+        sys.exit(1 if mismatches else 0)
+    
+    elif args.export_onnx:
+        # ===== 导出ONNX =====
+        export_onnx(quantize=not args.no_quantize, encoder=args.encoder or 'teacher')
+    
+    elif args.compare_backends:
+        # ===== 后端对比 =====
+        compare_backends(encoder=args.encoder or 'teacher')
+    
+    elif args.batch_file:
+        # ===== 批量预测模式（流式读写JSONL） =====
+        src = sys.stdin if args.batch_file == '-' else open(args.batch_file, 'r', encoding='utf-8')
+        dst = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+        t0, n = time.time(), 0
+        try:
+            for line in predict_jsonl(src, args.topk, args.min_score, args.lexical, args.batch_size):
+                dst.write(line + '\n')
+                n += 1
+        finally:
+            if src is not sys.stdin:
+                src.close()
+            if dst is not sys.stdout:
+                dst.close()
+        elapsed = max(time.time() - t0, 1e-9)
+        print(f"✅ 批量预测完成: {n} 条，{elapsed:.1f}s，{n / elapsed:.1f} 条/秒", file=sys.stderr)
+    
+    elif args.test:
         # ===== 测试模式 =====
         # 运行多个预定义查询
         test_queries = [
@@ -0,0 +1,254 @@
+"""
+================================================================================
+医疗疾病预测系统 - 疾病向量压缩（PCA降维 + float16/int8 存储）
+================================================================================
+功能模块：
+1. fit_pca / project：PCA投影（768维 → 可配置维度，如256）
+2. quantize / dequantize：float16 或 int8（每个向量一个缩放系数）存储
+3. load_embeddings / open_embeddings / project_queries：从索引中读取向量、对查询施加同一投影
+4. topk_agreement：压缩前后Top-K检索结果的一致率
+
+索引中新增的字段（npz 与 index_store 目录格式相同）：
+    embeddings        (N, k) 压缩后的向量（float32 / float16 / int8）
+    embedding_scale   (N,)   int8 时每个向量的缩放系数（原值 ≈ int8 × scale）
+    projection        (d, k) PCA投影矩阵（列正交）
+
+说明：
+    - 使用不减均值的PCA（二阶矩矩阵的主方向）：投影后的内积 q·P·Pᵀ·x 是原余弦相似度的
+      最优低秩近似，分数尺度不变（规则引擎的 min_score 阈值继续有效）；k = d 时与原结果完全一致
+    - 查询向量乘同一投影矩阵即可，与文档向量处于同一空间
+    - 预测服务用 open_embeddings 直接在压缩后的 memmap 上打分：每次只把 CHUNK_ROWS 行反量化为 float32
+      再做矩阵乘法（NumPy 的 float16/int8 矩阵乘法没有BLAS加速），不在每个进程里另存一份 float32 副本，
+      多个 worker 继续共享同一份页缓存；内存按 k/d 和存储精度一起缩小
+    - load_embeddings 返回完整的 float32 矩阵，只用于离线构建/评估
+
+作者：Your Name
+日期：2024-01-XX
+================================================================================
+"""
+
+# ==================== 第1部分：依赖导入 ====================
+import numpy as np  # 数值计算
+
+# ==================== 第2部分：配置 ====================
+
+STORE_DTYPES = ('float32', 'float16', 'int8')  # 支持的存储精度
+PCA_FIT_SAMPLES = 200000  # 拟合PCA最多使用的样本数
+CHUNK_ROWS = 65536  # 分块计算的行数（输入为 memmap 时不会整体读入内存）
+
+# ==================== 第3部分：PCA投影 ====================
+
+def fit_pca(vecs, dim, seed=42):
+    """
+    拟合PCA投影
+
+    参数：
+        vecs (np.ndarray): (N, d) 疾病向量
+        dim (int): 目标维度（不超过 d 和 N）
+        seed (int): 样本过多时的抽样随机种子
+
+    返回：
+        np.ndarray: (d, k) float32 投影矩阵
+
+    示例：
+        >>> P = fit_pca(vecs, 256)
+        >>> reduced = project(vecs, P)  # (N, 256)
+    """
+    n, d = vecs.shape
+    rows = np.arange(n)
+    if n > PCA_FIT_SAMPLES:
+        rows = np.sort(np.random.RandomState(seed).choice(n, PCA_FIT_SAMPLES, replace=False))
+    # 二阶矩矩阵只有 d×d（768×768），分块累加后直接特征分解
+    moment = np.zeros((d, d), dtype=np.float64)
+    for s in range(0, len(rows), CHUNK_ROWS):
+        x = np.asarray(vecs[rows[s:s + CHUNK_ROWS]], dtype=np.float64)
+        moment += x.T @ x
+    vals, vecs_ = np.linalg.eigh(moment / len(rows))
+    k = int(min(dim, d))
+    order = np.argsort(vals)[::-1][:k]
+    return vecs_[:, order].astype(np.float32)
+
+def project(vecs, projection):
+    """
+    施加PCA投影（文档与查询使用同一函数）
+    """
+    return np.asarray(vecs, dtype=np.float32) @ projection
+
+def explained_variance(vecs, projection):
+    """投影保留的能量比例（用于报告）"""
+    total = kept = 0.0
+    for s in range(0, len(vecs), CHUNK_ROWS):
+        x = np.asarray(vecs[s:s + CHUNK_ROWS], dtype=np.float64)
+        total += np.sum(x * x)
+        kept += np.sum((x @ projection) ** 2)
+    return float(kept / max(total, 1e-12))
+
+# ==================== 第4部分：量化存储 ====================
+
+def quantize(vecs, dtype='float32'):
+    """
+    按存储精度压缩向量
+
+    参数：
+        vecs (np.ndarray): (N, k) float32 向量
+        dtype (str): 'float32' / 'float16' / 'int8'
+
+    返回：
+        tuple: (压缩后的向量, 缩放系数)；非int8时缩放系数为None
+
+    int8 量化：
+        scale_i = max|x_i| / 127，q_i = round(x_i / scale_i)，每个向量单独缩放
+    """
+    if dtype not in STORE_DTYPES:
+        raise ValueError(f'不支持的存储精度: {dtype}（可选: {", ".join(STORE_DTYPES)}）')
+    x = np.asarray(vecs, dtype=np.float32)
+    if dtype != 'int8':
+        return x.astype(dtype), None
+    scale = np.maximum(np.abs(x).max(axis=1), 1e-12) / 127.0
+    q = np.clip(np.rint(x / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+def dequantize(vecs, scale=None):
+    """
+    还原为 float32（float32 输入不复制；memmap 保持共享页缓存）
+    """
+    vecs = np.asarray(vecs)
+    if scale is not None:
+        return vecs.astype(np.float32) * np.asarray(scale, dtype=np.float32)[:, None]
+    return vecs.astype(np.float32) if vecs.dtype != np.float32 else vecs
+
+# ==================== 第5部分：索引读取 ====================
+
+def load_embeddings(data):
+    """
+    从索引（npz 或 index_store 目录）读取 float32 疾病向量（离线使用：float16/int8 会整体还原一份）
+
+    参数：
+        data: open_index() / np.load() 返回的索引对象
+
+    返回：
+        np.ndarray: (N, k) float32
+    """
+    scale = data['embedding_scale'] if 'embedding_scale' in data else None
+    return dequantize(data['embeddings'], scale)
+
+class CompressedEmbeddings:
+    """
+    float16/int8 存储的疾病向量，按块反量化后打分（不整体还原）
+
+    参数：
+        vecs: (N, k) float16 / int8 向量（index_store 目录中为只读 memmap）
+        scale: (N,) int8 的缩放系数；float16 为 None
+
+    支持的用法（与 float32 矩阵相同，结果为 float32 ndarray）：
+        embs @ q        (N,) 或 (N, B)
+        Q @ embs.T      (B, N)
+        embs[rows]      反量化后的若干行
+        np.asarray(embs) 整体还原（仅构建 HNSW 等离线场景）
+    """
+    __array_ufunc__ = None  # 让 ndarray @ CompressedEmbeddings 交给 __rmatmul__ 处理
+
+    def __init__(self, vecs, scale=None):
+        self.vecs = vecs
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+        self.shape = tuple(vecs.shape)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+        self.storage_dtype = vecs.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, tuple):
+            raise TypeError('CompressedEmbeddings 只支持按行索引')
+        return dequantize(self.vecs[rows], None if self.scale is None else self.scale[rows])
+
+    def __array__(self, dtype=None, copy=None):
+        full = self[:]
+        return full if dtype is None else full.astype(dtype, copy=False)
+
+    def _chunks(self):
+        for s in range(0, self.shape[0], CHUNK_ROWS):
+            yield s, self[s:s + CHUNK_ROWS]
+
+    def __matmul__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        out = np.empty((self.shape[0],) + x.shape[1:], dtype=np.float32)
+        for s, chunk in self._chunks():
+            out[s:s + len(chunk)] = chunk @ x
+        return out
+
+    @property
+    def T(self):
+        return _TransposedEmbeddings(self)
+
+class _TransposedEmbeddings:
+    """CompressedEmbeddings.T：只支持 Q @ embs.T"""
+    __array_ufunc__ = None
+
+    def __init__(self, base):
+        self.base = base
+        self.shape = base.shape[::-1]
+
+    def __rmatmul__(self, q):
+        q = np.asarray(q, dtype=np.float32)
+        out = np.empty(q.shape[:-1] + (self.base.shape[0],), dtype=np.float32)
+        for s, chunk in self.base._chunks():
+            out[..., s:s + len(chunk)] = q @ chunk.T
+        return out
+
+def open_embeddings(data):
+    """
+    预测服务读取疾病向量：float32 直接返回（memmap 不复制），float16/int8 返回按块反量化的 CompressedEmbeddings
+
+    参数：
+        data: open_index() / np.load() 返回的索引对象
+    """
+    vecs = data['embeddings']
+    if vecs.dtype == np.float32:
+        return vecs
+    return CompressedEmbeddings(vecs, data['embedding_scale'] if 'embedding_scale' in data else None)
+
+def load_projection(data):
+    """
+    读取索引中记录的投影
+
+    返回：
+        np.ndarray 或 None: (d, k) 投影矩阵；未降维的索引返回 None
+    """
+    if 'projection' not in data:
+        return None
+    return np.asarray(data['projection'], dtype=np.float32)
+
+def project_queries(q, proj):
+    """
+    对查询向量施加索引的投影（proj 为 None 时原样返回）
+
+    参数：
+        q (np.ndarray): (d,) 或 (B, d) 已L2归一化的查询向量
+        proj: load_projection() 的返回值
+    """
+    if proj is None:
+        return q
+    return project(q, proj)
+
+# ==================== 第6部分：效果评估 ====================
+
+def topk_agreement(full_q, full_docs, small_q, small_docs, k=10):
+    """
+    压缩前后的Top-K一致率
+
+    参数：
+        full_q / full_docs: 原始精度的查询向量 (B, d) 和疾病向量 (N, d)
+        small_q / small_docs: 压缩后的查询向量 (B, k) 和疾病向量 (N, k)（float32）
+        k (int): Top-K
+
+    返回：
+        dict: {'topk_agreement': Top-K集合平均重合比例, 'top1_agreement': Top-1相同比例}
+    """
+    k = min(k, len(full_docs))
+    a = np.argsort(-(full_q @ full_docs.T), axis=1)[:, :k]
+    b = np.argsort(-(small_q @ small_docs.T), axis=1)[:, :k]
+    overlap = np.mean([len(set(x) & set(y)) / k for x, y in zip(a, b)])
+    return {'topk_agreement': float(overlap), 'top1_agreement': float(np.mean(a[:, 0] == b[:, 0]))}
@@ -0,0 +1,353 @@
+"""
+================================================================================
+医疗疾病预测系统 - 内存映射索引存储（免解压、免pickle）
+================================================================================
+功能模块：
+1. write_index_store：写出未压缩的索引目录（机器学习.py --build_index 调用）
+2. open_index：打开索引（目录格式用 np.memmap 映射；兼容旧的 .npz）
+3. convert_npz：把已有的 biencoder_index.npz 转换为目录格式
+
+目录格式（models/medical_biencoder/biencoder_index/）：
+    meta.json           格式版本、疾病数、向量维度、各字段对应的文件
+    embeddings.f32      (N, d) 原始向量（float32；float16/int8 存储时为 embeddings.f16 / embeddings.i8）
+    idf_vals.f32        (V,) IDF值
+    *.f32               降维/量化时的附加数组（embedding_scale、projection，见 embedding_compress.py）
+    names.strtab        字符串表：疾病名称
+    categories.strtab   字符串表：科室
+    symptoms.strtab     字符串表：症状列表（JSON字符串，与npz中一致）
+    docs.strtab         字符串表：文档文本
+    idf_terms.strtab    字符串表：IDF词表
+    content_hashes.strtab / encoder_fingerprint.strtab
+                        增量重建用的每行内容哈希和编码器指纹（见 机器学习.py --build_index --incremental）
+
+版本标记（与目录同级的 biencoder_index.version）：
+    {"build_id": ...}，目录整体替换完成后最后写入；meta.json 和向量索引元信息中记录同一个 build_id，
+    三者一致才说明一次重建已全部写完（预测服务的监视线程据此决定是否重新加载）
+
+字符串表格式（小端）：
+    8字节魔数 b'STRTAB1\\0' | uint64 条数n | uint64[n+1] 偏移表 | UTF-8 数据区
+    第i个字符串 = 数据区[偏移[i]:偏移[i+1]]，可随机访问，不需要pickle
+
+优势：
+    - 多个 Gunicorn worker 映射同一组文件，共享操作系统页缓存，向量矩阵只占一份内存
+    - 启动时不再解压 savez_compressed 归档、不再反序列化 object 数组
+
+作者：Your Name
+日期：2024-01-XX
+================================================================================
+"""
+
+# ==================== 第1部分：依赖导入 ====================
+import os  # 文件路径操作
+import json  # 元信息读写
+import uuid  # 构建ID
+import shutil  # 替换旧目录
+import argparse  # 命令行参数解析
+from array import array  # 字符串表的长度表（流式写出）
+import numpy as np  # 数值计算
+
+# ==================== 第2部分：格式常量 ====================
+
+FORMAT_NAME = 'medical-index-store'
+FORMAT_VERSION = 1
+STRTAB_MAGIC = b'STRTAB1\x00'
+META_FILE = 'meta.json'
+VERSION_SUFFIX = '.version'  # 版本标记文件后缀（与索引目录同级）
+
+STRING_FIELDS = ('names', 'categories', 'symptoms', 'docs', 'idf_terms')  # 字符串字段
+DTYPE_SUFFIX = {'float32': 'f32', 'float16': 'f16', 'int8': 'i8'}  # 向量存储精度 → 文件后缀
+EXTRA_ARRAYS = ('embedding_scale', 'projection')  # 降维/量化附加数组
+EXTRA_STRINGS = ('content_hashes', 'encoder_fingerprint')  # 增量重建附加字符串字段
+
+# ==================== 第3部分：字符串表 ====================
+
+def write_string_table(path, strings):
+    """
+    写出字符串表（偏移表 + UTF-8 数据区）
+
+    参数：
+        path (str): 输出文件路径
+        strings (Iterable[str]): 字符串序列（可以是生成器，只遍历一次）
+
+    说明：
+        数据区先流式写入临时文件，内存中只保留每条8字节的长度表，再拼接成最终文件
+    """
+    lengths = array('Q')
+    data_path = path + '.data'
+    with open(data_path, 'wb') as data:
+        for s in strings:
+            b = str(s).encode('utf-8')
+            data.write(b)
+            lengths.append(len(b))
+
+    offsets = np.zeros(len(lengths) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum(np.frombuffer(lengths, dtype=np.uint64), dtype=np.uint64)
+
+    with open(path, 'wb') as f:
+        f.write(STRTAB_MAGIC)
+        f.write(np.array([len(lengths)], dtype='<u8').tobytes())
+        f.write(offsets.tobytes())
+        with open(data_path, 'rb') as data:
+            shutil.copyfileobj(data, f, 1 << 20)
+    os.remove(data_path)
+
+class StringTable:
+    """
+    内存映射的只读字符串表（支持 len / 下标访问 / 迭代）
+
+    示例：
+        >>> names = StringTable('biencoder_index/names.strtab')
+        >>> len(names), names[0]
+        (8808, '感冒')
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._mm[:8]) != STRTAB_MAGIC:
+            raise ValueError(f'不是有效的字符串表文件: {path}')
+        n = int(np.frombuffer(self._mm, dtype='<u8', count=1, offset=8)[0])
+        self._offsets = np.frombuffer(self._mm, dtype='<u8', count=n + 1, offset=16)
+        self._base = 16 + 8 * (n + 1)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = self._base + int(self._offsets[i]), self._base + int(self._offsets[i + 1])
+        return bytes(self._mm[start:end]).decode('utf-8')
+
+    def __iter__(self):
+        data = bytes(self._mm[self._base:])
+        offs = self._offsets.tolist()
+        for i in range(len(self)):
+            yield data[offs[i]:offs[i + 1]].decode('utf-8')
+
+    def tolist(self):
+        return list(self)
+
+# ==================== 第4部分：索引目录读写 ====================
+
+class IndexStore:
+    """
+    目录格式索引（接口与 np.load 返回的 NpzFile 一致：data['key']、'key' in data、data.files）
+
+    说明：
+        - 向量矩阵和IDF值为只读 np.memmap，访问时才由操作系统按页读入
+        - 字符串字段返回 StringTable
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != FORMAT_NAME or self.meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f'不支持的索引格式: {path}')
+        self.files = list(self.meta['arrays']) + list(self.meta['strings'])
+        self._cache = {}
+
+    def __contains__(self, key):
+        return key in self.meta['arrays'] or key in self.meta['strings']
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            if key in self.meta['arrays']:
+                spec = self.meta['arrays'][key]
+                self._cache[key] = np.memmap(
+                    os.path.join(self.path, spec['file']),
+                    dtype=spec['dtype'], mode='r', shape=tuple(spec['shape'])
+                )
+            elif key in self.meta['strings']:
+                self._cache[key] = StringTable(os.path.join(self.path, self.meta['strings'][key]))
+            else:
+                raise KeyError(key)
+        return self._cache[key]
+
+def write_index_store(path, embeddings, names, categories, symptoms, docs,
+                      idf_terms=None, idf_vals=None, dtype='float32', extra_arrays=None,
+                      extra_strings=None):
+    """
+    写出目录格式索引（先写临时目录，完成后整体替换，读取方不会看到写了一半的文件）
+
+    参数：
+        path (str): 输出目录
+        embeddings (np.ndarray): (N, d) 疾病向量
+        names / categories / docs (Iterable[str]): 疾病名称 / 科室 / 文档（可以是生成器，如流式读取的文档）
+        symptoms (list[str]): 症状列表的JSON字符串（与npz格式一致）
+        idf_terms / idf_vals: IDF词表和值（可选）
+        dtype (str): 向量存储精度（float32 / float16 / int8；int8 需在 extra_arrays 中提供 embedding_scale）
+        extra_arrays (dict): 附加的 float32 数组（如 projection、embedding_scale）
+        extra_strings (dict): 附加的字符串字段（如 content_hashes、encoder_fingerprint）
+
+    返回：
+        str: 本次构建的 build_id（构建向量索引时传给 save_vector_index，见版本标记）
+    """
+    if dtype not in DTYPE_SUFFIX:
+        raise ValueError(f'不支持的向量精度: {dtype}（可选: {", ".join(DTYPE_SUFFIX)}）')
+
+    path = os.path.abspath(path)
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    emb_file = f'embeddings.{DTYPE_SUFFIX[dtype]}'
+    embeddings.tofile(os.path.join(tmp, emb_file))
+    arrays = {'embeddings': {'file': emb_file, 'dtype': dtype, 'shape': list(embeddings.shape)}}
+
+    columns = {'names': names, 'categories': categories, 'symptoms': symptoms, 'docs': docs}
+    if idf_terms is not None and idf_vals is not None:
+        columns['idf_terms'] = idf_terms
+        idf_vals = np.ascontiguousarray(idf_vals, dtype=np.float32)
+        idf_vals.tofile(os.path.join(tmp, 'idf_vals.f32'))
+        arrays['idf_vals'] = {'file': 'idf_vals.f32', 'dtype': 'float32', 'shape': [len(idf_vals)]}
+
+    for key, values in (extra_strings or {}).items():
+        columns[key] = values
+
+    for key, value in (extra_arrays or {}).items():
+        value = np.ascontiguousarray(value, dtype=np.float32)
+        value.tofile(os.path.join(tmp, f'{key}.f32'))
+        arrays[key] = {'file': f'{key}.f32', 'dtype': 'float32', 'shape': list(value.shape)}
+
+    strings = {}
+    for key, values in columns.items():
+        strings[key] = f'{key}.strtab'
+        write_string_table(os.path.join(tmp, strings[key]), values)
+
+    build_id = uuid.uuid4().hex
+    meta = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'build_id': build_id,
+        'n': int(embeddings.shape[0]),
+        'dim': int(embeddings.shape[1]),
+        'arrays': arrays,
+        'strings': strings,
+    }
+    with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # 替换旧目录（已映射旧文件的进程不受影响，文件在其关闭映射后才真正释放）
+    if os.path.isdir(path):
+        old = path + '.old'
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.rename(tmp, path)
+
+    # 版本标记最后写入：两次 rename 之间目录短暂不存在，读取方看到的标记与目录不一致，不会在此时加载
+    marker = version_marker_path(path)
+    with open(marker + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'build_id': build_id}, f)
+    os.replace(marker + '.tmp', marker)
+    return build_id
+
+def version_marker_path(path):
+    """索引目录对应的版本标记文件路径"""
+    return os.path.abspath(path) + VERSION_SUFFIX
+
+def read_version_marker(path):
+    """
+    读取版本标记中的 build_id（没有标记时返回None，如旧版本写出的目录）
+    """
+    try:
+        with open(version_marker_path(path), 'r', encoding='utf-8') as f:
+            return json.load(f).get('build_id')
+    except (OSError, ValueError):
+        return None
+
+def store_build_id(path):
+    """
+    索引目录 meta.json 中的 build_id（目录不存在或旧格式时返回None）
+    """
+    try:
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f).get('build_id')
+    except (OSError, ValueError):
+        return None
+
+def open_index(path):
+    """
+    打开疾病索引（目录格式或旧的 .npz 格式）
+
+    参数：
+        path (str): 索引目录，或 biencoder_index.npz 文件
+
+    返回：
+        IndexStore 或 NpzFile，均支持 data['embeddings']、data['names'] 等访问方式
+    """
+    if os.path.isdir(path):
+        return IndexStore(path)
+    return np.load(path, allow_pickle=True)
+
+def store_path_for(npz_path):
+    """biencoder_index.npz → 同目录下的 biencoder_index/ 目录"""
+    return os.path.splitext(os.path.abspath(npz_path))[0]
+
+def convert_npz(npz_path, out_dir=None, dtype=None):
+    """
+    将 savez_compressed 生成的 .npz 索引转换为目录格式
+
+    参数：
+        npz_path (str): biencoder_index.npz 路径
+        out_dir (str): 输出目录（默认与npz同名的目录）
+        dtype (str): 向量存储精度（None表示沿用npz中的精度；已量化为int8的索引不能再转换精度）
+
+    返回：
+        str: 输出目录
+    """
+    out_dir = out_dir or store_path_for(npz_path)
+    data = np.load(npz_path, allow_pickle=True)
+    has_idf = 'idf_terms' in data and 'idf_vals' in data
+    n = len(data['names'])
+    extras = {k: data[k] for k in EXTRA_ARRAYS if k in data}
+    extra_strings = {k: data[k] for k in EXTRA_STRINGS if k in data}
+    stored = str(data['embeddings'].dtype)
+    if 'embedding_scale' in extras and dtype not in (None, stored):
+        raise ValueError('int8 量化索引不能转换为其他精度，请用 --build_index 重建')
+    write_index_store(
+        out_dir,
+        embeddings=data['embeddings'],
+        names=data['names'],
+        categories=data['categories'],
+        symptoms=data['symptoms'],
+        docs=data['docs'] if 'docs' in data else [''] * n,
+        idf_terms=data['idf_terms'] if has_idf else None,
+        idf_vals=data['idf_vals'] if has_idf else None,
+        dtype=dtype or stored,
+        extra_arrays=extras,
+        extra_strings=extra_strings,
+    )
+    return out_dir
+
+# ==================== 第5部分：命令行入口 ====================
+
+def main():
+    """
+    用法：
+        python index_store.py --convert models/medical_biencoder/biencoder_index.npz
+        python index_store.py --convert models/medical_biencoder/biencoder_index.npz --dtype float16
+    """
+    ap = argparse.ArgumentParser(description='疾病索引格式转换（npz → 内存映射目录）')
+    ap.add_argument('--convert', type=str, required=True, help='要转换的 biencoder_index.npz 路径')
+    ap.add_argument('--out', type=str, default=None, help='输出目录（默认与npz同名）')
+    ap.add_argument('--dtype', type=str, default=None, choices=['float32', 'float16'],
+                    help='向量存储精度（默认沿用npz；float16 体积减半）')
+    args = ap.parse_args()
+
+    out_dir = convert_npz(args.convert, args.out, args.dtype)
+    store = IndexStore(out_dir)
+    size = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+    print(f"✅ 已转换: {store.meta['n']} 个疾病，{store.meta['dim']} 维，共 {size / 1024 / 1024:.1f} MB")
+    print(f"   输出目录: {out_dir}")
+
+# ==================== 第6部分：程序入口 ====================
+if __name__ == '__main__':
+    main()
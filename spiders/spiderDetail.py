@@ -5,6 +5,8 @@ from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from utils.query import querys
+from utils.homeAggregates import aggregateLock, applyCaseChange, getCaseById
+from utils.caseSchema import parseSmallInt
 
 
 class spider(object):
@@ -77,8 +79,17 @@ class spider(object):
                     allergy = '暂无信息'
 
                 print(height, weight, illDuration, allergy)
-                querys('UPDATE cases SET height=%s,weight=%s,illDuration=%s,allergy=%s WHERE id = %s',
-                       [height, weight, illDuration, allergy, id])
+                # 写入和增量更新在同一把锁内，避免与首页汇总表的全量重建交错
+                with aggregateLock():
+                    oldCase = getCaseById(id)
+                    querys('UPDATE cases SET height=%s,weight=%s,illDuration=%s,allergy=%s,height_cm=%s,weight_kg=%s '
+                           'WHERE id = %s',
+                           [height, weight, illDuration, allergy, parseSmallInt(height), parseSmallInt(weight), id])
+                    # 身高体重变化后增量更新首页汇总表（失败时由定时全量重建兜底）
+                    try:
+                        applyCaseChange(oldCase=oldCase, newCase=getCaseById(id))
+                    except Exception as e:
+                        print(f"更新汇总表失败: {e}")
                 return '爬取成功'
             except Exception as e:
                 print(f"详情页元素定位失败: {e}")
@@ -6,6 +6,8 @@ import os
 import re
 import time  # 确保正确导入 time 模块
 import utils.query
+import utils.homeAggregates
+import utils.caseSchema
 
 
 class spider(object):
@@ -50,6 +52,8 @@ class spider(object):
             cursor.execute(sql)
             conn.commit()
             conn.close()
+            # 类型化列（加列并回填、核对）和索引；已完成时只做核对
+            utils.caseSchema.migrate()
         except Exception as e:
             print(f"数据库初始化错误: {e}")
             pass
@@ -152,14 +156,27 @@ class spider(object):
                 for i in reader:
                     if i[0] == 'type':
                         continue
-                    utils.query.querys('''
-                                       insert into cases(type, gender, age, time, content, docName, docHospital,
-                                                         department, detailUrl)
-                                       values (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                       ''', [i[0], i[1], i[2], i[3], i[4], i[5], i[6], i[7], i[8]])
+                    age_years, _, _, visit_date = utils.caseSchema.typedValues(i[2], None, None, i[3])
+                    # 写入和增量更新在同一把锁内，避免与首页汇总表的全量重建交错
+                    with utils.homeAggregates.aggregateLock():
+                        utils.query.querys('''
+                                           insert into cases(type, gender, age, time, content, docName, docHospital,
+                                                             department, detailUrl, age_years, visit_date)
+                                           values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                           ''', [i[0], i[1], i[2], i[3], i[4], i[5], i[6], i[7], i[8], age_years, visit_date])
+                        self.update_aggregates()
         except Exception as e:
             print(f"保存数据库错误: {e}")
 
+    def update_aggregates(self):
+        # 刚插入的病例计入首页汇总表；失败时只提示，定时全量重建会补上
+        try:
+            newCase = utils.query.querys('select * from cases where id = last_insert_id()', [], 'select')
+            if newCase:
+                utils.homeAggregates.applyCaseChange(newCase=newCase[0])
+        except Exception as e:
+            print(f"更新汇总表错误: {e}")
+
 
 if __name__ == '__main__':
     spiderObj = spider()
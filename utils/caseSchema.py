@@ -0,0 +1,261 @@
+import re
+import time
+import datetime
+from utils.query import querys, namedLock
+
+# ==================== cases 表的类型化影子列 ====================
+# 原表的 age/height/weight/time 都是 varchar(255)，统计时要逐行 int() 解析并跳过'无'等占位值。
+# 这里增加与原列并存的类型化列（原列保持不变，旧代码照常工作）：
+#   age_years  SMALLINT  年龄        ← age
+#   height_cm  SMALLINT  身高（厘米） ← height
+#   weight_kg  SMALLINT  体重（公斤） ← weight
+#   visit_date DATE      求诊日期    ← time（只有'2023.5.12'这样带年份的值能转换）
+# 无法解析的值（'无'、'未知'、空值、没有年份的日期等）存 NULL。
+# 另外给 type / department / docHospital / age_years 建二级索引、给 content 建全文索引，供首页统计和列表筛选使用。
+# 加列和回填是同一步：列存在但有漏填的行时统计结果会出错，所以回填后逐行核对，仍有漏填就抛错。
+# 迁移是显式的部署步骤（python -m utils.caseSchema，爬虫启动时也会执行）：加列和全文索引会重建表，
+# Web 服务与之共用一个连接，所以不在 Web 进程里迁移。未迁移、迁移失败的库，
+# 统计和列表查询通过 typedSql() 退回从原始列现场解析（结果相同，只是需要逐行 cast），
+# 没有全文索引时病情描述检索退回 like（fulltextReady()）。
+#
+# 用法：
+#   python -m utils.caseSchema                 加列并回填、核对、建索引（可重复执行）
+#   python -m utils.caseSchema --batch 5000    每批回填5000行
+
+TYPED_COLUMNS = [
+    ('age_years', 'smallint null'),
+    ('height_cm', 'smallint null'),
+    ('weight_kg', 'smallint null'),
+    ('visit_date', 'date null'),
+]
+FULLTEXT_INDEX = 'ft_cases_content'
+CASE_INDEXES = [
+    ('idx_cases_type', 'index idx_cases_type (type)'),
+    ('idx_cases_department', 'index idx_cases_department (department)'),
+    ('idx_cases_docHospital', 'index idx_cases_docHospital (docHospital)'),
+    ('idx_cases_age_years', 'index idx_cases_age_years (age_years)'),
+    # 病情描述全文检索（ngram 分词支持中文，MySQL 5.7.6+）
+    (FULLTEXT_INDEX, f'fulltext index {FULLTEXT_INDEX} (content) with parser ngram'),
+]
+BACKFILL_BATCH = 2000
+READY_RECHECK = 60  # 未迁移时重新检查类型化列的间隔（秒）
+MIGRATION_LOCK = 'cases_typed_columns'  # 迁移的 GET_LOCK 锁名（多个 worker / 爬虫同时启动时只有一个执行迁移）
+MIGRATION_LOCK_TIMEOUT = 600  # 命令行迁移等待锁的最长时间（秒）
+
+INT_RE = re.compile(r'[+-]?[0-9]+')
+DATE_RE = re.compile(r'([0-9]{4})\.([0-9]{1,2})\.([0-9]{1,2})')
+INT_SQL_PATTERN = '^[+-]?[0-9]+$'  # 与 INT_RE / DATE_RE 相同的 MySQL 正则
+DATE_SQL_PATTERN = '^[0-9]{4}[.][0-9]{1,2}[.][0-9]{1,2}$'
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+# 类型化列 → 原始 varchar 列（未迁移时的退路）
+RAW_COLUMNS = {'age_years': 'age', 'height_cm': 'height', 'weight_kg': 'weight'}
+COLUMNS_SQL = ("select column_name from information_schema.columns "
+               "where table_schema = database() and table_name = 'cases'")
+INDEXES_SQL = ("select distinct index_name from information_schema.statistics "
+               "where table_schema = database() and table_name = 'cases'")
+
+_typedReady = False
+_typedCheckedAt = 0.0
+_fulltextReady = False
+_fulltextCheckedAt = 0.0
+
+
+def parseSmallInt(value):
+    """'170' → 170；'无'、'未知'、None、超出 SMALLINT 范围 → None"""
+    if value is None or not INT_RE.fullmatch(str(value)):
+        return None
+    number = int(value)
+    return number if SMALLINT_MIN <= number <= SMALLINT_MAX else None
+
+
+def parseVisitDate(value):
+    """'2023.5.12' → date(2023, 5, 12)；没有年份或不是合法日期 → None"""
+    match = DATE_RE.fullmatch(str(value)) if value is not None else None
+    if not match:
+        return None
+    try:
+        return datetime.date(*map(int, match.groups()))
+    except ValueError:
+        return None
+
+
+def typedValues(age, height, weight, time):
+    """原始 varchar 值对应的类型化列 (age_years, height_cm, weight_kg, visit_date)"""
+    return parseSmallInt(age), parseSmallInt(height), parseSmallInt(weight), parseVisitDate(time)
+
+
+def _existing(sql):
+    return {row[0] for row in querys(sql, [], 'select')}
+
+
+def typedColumnsReady():
+    """
+    cases 表的类型化列是否可用：全部列都存在且没有漏填的行
+    （确认后不再查询；不可用时每 READY_RECHECK 秒重新检查一次）
+    """
+    global _typedReady, _typedCheckedAt
+    if not _typedReady and time.time() - _typedCheckedAt >= READY_RECHECK:
+        _typedCheckedAt = time.time()
+        _typedReady = ({name for name, _ in TYPED_COLUMNS} <= _existing(COLUMNS_SQL)
+                       and not unbackfilledIds(limit=1))
+    return _typedReady
+
+
+def fulltextReady():
+    """content 的全文索引是否已建立（确认后不再查询；没有时每 READY_RECHECK 秒重新检查一次）"""
+    global _fulltextReady, _fulltextCheckedAt
+    if not _fulltextReady and time.time() - _fulltextCheckedAt >= READY_RECHECK:
+        _fulltextCheckedAt = time.time()
+        _fulltextReady = FULLTEXT_INDEX in _existing(INDEXES_SQL)
+    return _fulltextReady
+
+
+def resetTypedColumnsCache():
+    """迁移完成或切换数据库后调用，下次 typedColumnsReady() / fulltextReady() 重新检查"""
+    global _typedReady, _typedCheckedAt, _fulltextReady, _fulltextCheckedAt
+    _typedReady, _typedCheckedAt = False, 0.0
+    _fulltextReady, _fulltextCheckedAt = False, 0.0
+
+
+def rawSmallIntSql(col):
+    """从 varchar 原始列现场解析 SMALLINT 的表达式（与 parseSmallInt 相同：纯整数且在范围内，否则 NULL）"""
+    return (f"case when {col} regexp '{INT_SQL_PATTERN}' and cast({col} as signed) "
+            f"between {SMALLINT_MIN} and {SMALLINT_MAX} then cast({col} as signed) end")
+
+
+def rawDateSql(col):
+    """从 varchar 原始列现场解析日期的表达式（与 parseVisitDate 相同：带年份的合法日期，否则 NULL）"""
+    return (f"case when {col} regexp '{DATE_SQL_PATTERN}' and {col} not like '0000.%%' "
+            f"then str_to_date({col}, '%%Y.%%c.%%e') end")
+
+
+def typedSql(name):
+    """
+    统计和列表查询中引用类型化列 age_years / height_cm / weight_kg / visit_date 的写法
+
+    已迁移时直接用列名（可以走索引）；未迁移时退回原始列的现场解析表达式，查询结果相同
+    """
+    if typedColumnsReady():
+        return name
+    if name == 'visit_date':
+        return rawDateSql('time')
+    return rawSmallIntSql(RAW_COLUMNS[name])
+
+
+def unbackfilledIds(limit=None, batch=BACKFILL_BATCH):
+    """
+    类型化列漏填的行：原始值能解析，对应的类型化列却是 NULL
+
+    说明：
+        先在 MySQL 中用正则筛出"看起来能解析、类型化列为 NULL"的行，再用同一套解析函数逐行确认
+        （超出 SMALLINT 范围的数字、'2023.2.30' 这样的非法日期本来就存 NULL，不算漏填）
+
+    返回：
+        list: 漏填行的 id（升序，最多 limit 个）
+    """
+    cond = ' or '.join([f"({typed} is null and {raw} regexp '{INT_SQL_PATTERN}')" for typed, raw in RAW_COLUMNS.items()]
+                       + [f"(visit_date is null and time regexp '{DATE_SQL_PATTERN}')"])
+    lastId, ids = 0, []
+    while True:
+        rows = querys(f'select id, age, height, weight, time, age_years, height_cm, weight_kg, visit_date '
+                      f'from cases where id > %s and ({cond}) order by id limit %s', [lastId, batch], 'select')
+        for row in rows:
+            parsed = typedValues(*row[1:5])
+            if any(stored is None and value is not None for stored, value in zip(row[5:], parsed)):
+                ids.append(row[0])
+                if limit and len(ids) >= limit:
+                    return ids
+        if len(rows) < batch:
+            return ids
+        lastId = rows[-1][0]
+
+
+def addTypedColumns(batch=BACKFILL_BATCH):
+    """
+    添加缺少的类型化列并回填（加列和回填是同一步，可重复执行）
+
+    说明：
+        - 新加了列、或者发现漏填的行（迁移中途中断、旧版本程序写入等）时整表回填
+        - 回填后逐行核对，仍有漏填时抛 RuntimeError；统计查询在核对通过前继续使用原始列
+
+    返回：
+        list: 新增的列名
+    """
+    global _typedReady
+    existing = _existing(COLUMNS_SQL)
+    missing = [(name, ddl) for name, ddl in TYPED_COLUMNS if name not in existing]
+    if missing:
+        querys('alter table cases ' + ', '.join(f'add column {name} {ddl}' for name, ddl in missing), [])
+    if missing or unbackfilledIds(limit=1, batch=batch):
+        print(f"✅ 回填完成，共 {backfillTypedColumns(batch)} 行")
+    left = unbackfilledIds(batch=batch)
+    if left:
+        raise RuntimeError(f"类型化列回填后仍有 {len(left)} 行漏填（id: {', '.join(map(str, left[:10]))}"
+                           f"{' ...' if len(left) > 10 else ''}），请检查后重新运行 python -m utils.caseSchema")
+    _typedReady = True
+    return [name for name, _ in missing]
+
+
+def addIndexes():
+    """添加缺少的二级索引（可重复执行），返回新建的索引名"""
+    existing = _existing(INDEXES_SQL)
+    missing = [(name, ddl) for name, ddl in CASE_INDEXES if name not in existing]
+    regular = [ddl for _, ddl in missing if not ddl.startswith('fulltext')]
+    if regular:
+        querys('alter table cases ' + ', '.join(f'add {ddl}' for ddl in regular), [])
+    # 全文索引单独建：InnoDB 一次只能新建一个全文索引，首次添加时还要重建表
+    for ddl in (ddl for _, ddl in missing if ddl.startswith('fulltext')):
+        querys(f'alter table cases add {ddl}', [])
+    return [name for name, _ in missing]
+
+
+def backfillTypedColumns(batch=BACKFILL_BATCH):
+    """
+    按 id 分批回填类型化列
+
+    说明：
+        - 每批按主键顺序读取 batch 行的原始值，在 Python 中解析（与爬虫写入时使用同一套解析函数），
+          再用一条 update ... join 写回，每批一次往返
+        - 可重复执行：每次都按原始列重新计算
+
+    返回：
+        int: 回填的行数
+    """
+    lastId, done = 0, 0
+    while True:
+        rows = querys('select id, age, height, weight, time from cases where id > %s order by id limit %s',
+                      [lastId, batch], 'select')
+        if not rows:
+            return done
+        params = []
+        for caseId, age, height, weight, visitTime in rows:
+            params += [caseId, *typedValues(age, height, weight, visitTime)]
+        values = ' union all '.join(['select %s id, %s a, %s h, %s w, %s d'] * len(rows))
+        querys(f'update cases c join ({values}) v on c.id = v.id '
+               f'set c.age_years = v.a, c.height_cm = v.h, c.weight_kg = v.w, c.visit_date = v.d', params)
+        lastId = rows[-1][0]
+        done += len(rows)
+        print(f"  已回填 {done} 行（id ≤ {lastId}）")
+
+
+def migrate(batch=BACKFILL_BATCH, lockTimeout=MIGRATION_LOCK_TIMEOUT):
+    """
+    加列并回填、核对 → 建索引（先回填再建 age_years 索引，避免回填时逐行维护索引）
+
+    说明：
+        持有 MySQL 命名锁执行，lockTimeout 秒内拿不到锁（其他进程正在迁移）时抛 TimeoutError；
+        回填后仍有漏填的行时抛 RuntimeError
+    """
+    with namedLock(MIGRATION_LOCK, lockTimeout):
+        columns = addTypedColumns(batch)
+        print(f"✅ 类型化列: {', '.join(columns) if columns else '已存在'}（已核对，无漏填）")
+        indexes = addIndexes()
+        print(f"✅ 索引: {', '.join(indexes) if indexes else '已存在'}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='cases 表类型化列与索引迁移')
+    parser.add_argument('--batch', type=int, default=BACKFILL_BATCH, help='每批回填的行数')
+    args = parser.parse_args()
+    migrate(args.batch)
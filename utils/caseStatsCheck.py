@@ -0,0 +1,378 @@
+import utils.caseSchema as caseSchema
+from utils.query import querys
+from utils.getAllData import getConfigOne, getFoundData, getCircleData, getBodyData
+from utils.homeAggregates import aggregateLock, applyCaseChange, getCaseById, getMaterializedHomeData, rebuildAggregates
+
+# ==================== 首页统计的固定数据检查 ====================
+# 在临时库中写入一组固定病例，与原来的 Python 计数器（下面的 legacy* 函数，保留自改写前的
+# utils.getAllData，只去掉了 print、改为接收病例行）的结果比较。分别检查"未迁移"（typedSql 退回现场
+# 解析原始 varchar 列）和"已迁移"（类型化列）两种状态：
+#   - utils.getAllData 的 SQL 聚合
+#   - 全量重建后的汇总表 case_aggregates
+#   - 爬虫增量更新后的汇总表
+# 固定数据覆盖：大小写不同的类型、只差尾部空格的类型/医院、NULL 类型、'07'/负数年龄、体重为'无'、数量并列时的排序
+#
+# 与旧计数器有意不同的行（DIVERGENT_CASES）：
+#   - 年龄无法解析（'无'、空值）：旧代码 int() 抛 ValueError，/getHomeData 直接 500；新实现不计入年龄统计
+#   - 年龄超出 SMALLINT 范围（'99999'）：旧代码计入（maxAge=99999、归入'60岁以上'）；
+#     新实现与类型化列 age_years 一致，当作缺失，不计入年龄统计
+#   - 身高或体重无法解析（'无'身高配数字体重、空值）：旧代码 int() 抛 ValueError；新实现该病例身高体重按0计
+# 这些行按上述规则换成旧代码能处理的值后（_legacyRows），再与旧计数器比较
+#
+# 用法：python -m utils.caseStatsCheck   （需要 CREATE/DROP DATABASE 权限；结束后删除临时库并切回原库）
+
+CHECK_DATABASE = 'medicalinfo_stats_check'
+
+CASES_DDL = '''
+    create table cases
+    (
+        id          int primary key auto_increment,
+        type        varchar(255),
+        gender      varchar(255),
+        age         varchar(255),
+        time        varchar(255),
+        content     varchar(255),
+        docName     varchar(255),
+        docHospital varchar(255),
+        department  varchar(255),
+        detailUrl   varchar(2555),
+        height      varchar(255),
+        weight      varchar(255),
+        illDuration varchar(255),
+        allergy     varchar(255)
+    ) default charset = utf8mb4
+'''
+CASE_FIELDS = ['type', 'gender', 'age', 'time', 'content', 'docName', 'docHospital', 'department', 'detailUrl',
+               'height', 'weight', 'illDuration', 'allergy']
+
+# (类型, 性别, 年龄, 求诊时间, 医院, 科室, 身高, 体重)
+FIXED_CASES = [
+    ('感冒', '男', '25', '2023.5.12', '医院A', '内科', '170', '60'),
+    ('感冒', '女', '07', '5.12', '医院B', '内科', '160', '无'),
+    ('胃炎', '男', '33', '2023.2.30', '医院A', '消化内科', '175', '70'),
+    ('Flu', '女', '65', '未知', '医院A', '内科', '无', '无'),
+    ('flu', '未知', '61', '2023.1.1', '医院C', '外科', '180', '80'),
+    ('flu ', '女', '52', '2023.4.2', '医院B ', '外科', '165', '55'),
+    ('胃炎', '女', '45', '2022.12.3', '医院B', '消化内科', '158', '50'),
+    (None, '男', '60', '2023.3.8', '医院C', '外科', '170', '65'),
+    ('胃炎', '女', '-3', '3.8', '医院A', '内科', '163', '48'),
+    ('感冒', '男', '33', '2021.7.9', '医院C', '消化内科', '172', '68'),
+    ('骨折', '男', '10', '2023.6.1', '医院B', '外科', '181', '75'),
+]
+# 与旧计数器有意不同的行（见文件开头的说明）
+DIVERGENT_CASES = [
+    ('胃炎', '男', '无', '2023.2.30', '医院A', '消化内科', '175', '70'),
+    ('flu', '未知', '99999', '2023.1.1', '医院C', '外科', '180', '80'),
+    ('胃炎', '女', '', '3.8', '医院A', '内科', '', ''),
+    ('骨折', '男', '12', '2023.6.1', '医院B', '外科', '无', '75'),
+]
+# 增量检查时爬虫"新插入"的病例
+EXTRA_CASE = ('flu', '女', '19', '2024.1.2', '医院C', '外科', '166', '52')
+
+
+# ==================== 原来的 Python 计数器 ====================
+
+def legacyPieData(casesList):
+    ageDic = {'0-10岁':0,'10-20岁':0,'10-20岁':0,'20-30岁':0,'30-40岁':0,'40-50岁':0,'50-60岁':0,'60岁以上':0}
+    for caseItem in casesList:
+        if int(caseItem[3]) < 10:
+            ageDic['0-10岁'] += 1
+        elif int(caseItem[3]) < 20:
+            ageDic['10-20岁'] += 1
+        elif int(caseItem[3]) < 30:
+            ageDic['20-30岁'] += 1
+        elif int(caseItem[3]) < 40:
+            ageDic['30-40岁'] += 1
+        elif int(caseItem[3]) < 50:
+            ageDic['40-50岁'] += 1
+        elif int(caseItem[3]) < 60:
+            ageDic['50-60岁'] += 1
+        else:
+            ageDic['60岁以上'] += 1
+    listResult = []
+    for k,v in ageDic.items():
+        listResult.append({
+            'name':k,
+            'value':v
+        })
+    return listResult
+
+def legacyConfigOne(casesList):
+    caseDic = {}
+    for caseItem in casesList:
+        if caseDic.get(caseItem[1],-1) == -1:
+            caseDic[caseItem[1]] = 1
+        else:
+            caseDic[caseItem[1]] += 1
+    listResult = []
+    for k,v in caseDic.items():
+        listResult.append({
+            'name':k,
+            'value':v
+        })
+    return listResult[:6],listResult
+
+def legacyFoundData(casesList):
+    maxNum = len(list(casesList))
+    typeDic = {}
+    depDic = {}
+    hosDic = {}
+    maxAge = 0
+    minAge = 100
+    for caseItem in casesList:
+        #类型
+        if typeDic.get(caseItem[1],-1) == -1:
+            typeDic[caseItem[1]] = 1
+        else:
+            typeDic[caseItem[1]] += 1
+        #科室
+        if depDic.get(caseItem[8],-1) == -1:
+            depDic[caseItem[8]] = 1
+        else:
+            depDic[caseItem[8]] += 1
+        #医院
+        if hosDic.get(caseItem[7],-1) == -1:
+            hosDic[caseItem[7]] = 1
+        else:
+            hosDic[caseItem[7]] += 1
+        #年龄
+        if int(caseItem[3]) > maxAge:
+            maxAge = int(caseItem[3])
+        if int(caseItem[3]) < minAge:
+            minAge = int(caseItem[3])
+
+    typeSort = sorted(typeDic.items(),key=lambda data:data[1],reverse=True)
+    depSort = sorted(depDic.items(), key=lambda data: data[1], reverse=True)
+    hosSort = sorted(hosDic.items(), key=lambda data: data[1], reverse=True)
+    maxType = typeSort[0][0]
+    maxDep = depSort[0][0]
+    maxHos = hosSort[0][0]
+    return maxNum,maxType,maxDep,maxHos,maxAge,minAge
+
+def legacyGenderData(casesList):
+    boyDic = {}
+    girlDic = {}
+    boyNum = 0
+    girlNum = 0
+    for caseItem in casesList:
+        if caseItem[2] == '男':
+            boyNum += 1
+            if boyDic.get(caseItem[1],-1) == -1:
+                boyDic[caseItem[1]] = 1
+            else:
+                boyDic[caseItem[1]] += 1
+        elif caseItem[2] == '女':
+            girlNum += 1
+            if girlDic.get(caseItem[1],-1) == -1:
+                girlDic[caseItem[1]] = 1
+            else:
+                girlDic[caseItem[1]] += 1
+
+    ratioData = []
+    boyRatio = int(round(boyNum / len(casesList) * 100,0))
+    girlRatio = int(round(girlNum / len(casesList) * 100,0))
+    ratioData.append(girlRatio)
+    ratioData.append(boyRatio)
+    boyList = []
+    girlList = []
+    for k,v in boyDic.items():
+        boyList.append({
+            'name':k,
+            'value':v
+        })
+    for k,v in girlDic.items():
+        girlList.append({
+            'name':k,
+            'value':v
+        })
+    return boyList,girlList,ratioData
+
+def legacyCircleData(casesList):
+    depDic = {}
+    for caseItem in casesList:
+        if depDic.get(caseItem[8],-1) == -1:
+            depDic[caseItem[8]] = 1
+        else:
+            depDic[caseItem[8]] += 1
+    dataSort = sorted(depDic.items(),key=lambda data:data[1],reverse=True)
+    dataResultList = []
+    for i in dataSort:
+        dataResultList.append({
+            'name':i[0],
+            'value':i[1]
+        })
+
+    return dataResultList
+
+def legacyBodyData(casesList):
+    dataDic = {}
+    xData = []
+    sumData = []
+    for caseItem in casesList:
+        if dataDic.get(caseItem[1],-1) == -1:
+            dataDic[caseItem[1]] = 1
+        else:
+            dataDic[caseItem[1]] += 1
+    dataSort = sorted(dataDic.items(),key=lambda data:data[1],reverse=True)
+    for i in dataSort:
+        xData.append(i[0])
+        sumData.append(i[1])
+    y1Data = [0 for x in range(len(xData))]
+    y2Data = [0 for x in range(len(xData))]
+    for caseItem in casesList:
+        for index,x in enumerate(xData):
+            if caseItem[1] == x:
+                if caseItem[10] and caseItem[11] == '无':
+                    y1Data[index] += 0
+                    y2Data[index] += 0
+                else:
+                    y1Data[index] += int(caseItem[10])
+                    y2Data[index] += int(caseItem[11])
+    for index,sum in enumerate(sumData):
+        y1Data[index] = round(y1Data[index]/sumData[index],0)
+        y2Data[index] = round(y2Data[index] / sumData[index], 0)
+    return xData,y1Data,y2Data
+
+
+def _legacyRows(casesList):
+    """
+    把与旧计数器有意不同的值换成旧代码能处理的等价值（见文件开头的说明）
+
+    返回：
+        tuple: (全部病例行, 只含年龄可解析病例的行)
+            身高或体重无法解析 → 两者都换成'无'（旧代码按0计）；年龄统计只用第二组
+    """
+    rows, ageRows = [], []
+    for row in casesList:
+        row = list(row)
+        if caseSchema.parseSmallInt(row[10]) is None or caseSchema.parseSmallInt(row[11]) is None:
+            row[10] = row[11] = '无'
+        if caseSchema.parseSmallInt(row[3]) is not None:
+            ageRows.append(row)
+        else:
+            row[3] = '0'  # 只参与非年龄字段，取值无关
+        rows.append(row)
+    return rows, ageRows
+
+
+def legacyHomeData(casesList):
+    """旧计数器给出的首页数据（字段与 getMaterializedHomeData 相同）"""
+    rows, ageRows = _legacyRows(casesList)
+    configOne, wordData = legacyConfigOne(rows)
+    maxNum, maxType, maxDep, maxHos, _, _ = legacyFoundData(rows)
+    _, _, _, _, maxAge, minAge = legacyFoundData(ageRows) if ageRows else (0, 0, 0, 0, 0, 100)
+    boyList, girlList, ratioData = legacyGenderData(rows)
+    xData, y1Data, y2Data = legacyBodyData(rows)
+    return {
+        'pieData': legacyPieData(ageRows),
+        'configOne': configOne,
+        'maxNum': maxNum,
+        'maxType': maxType,
+        'maxDep': maxDep,
+        'maxHos': maxHos,
+        'maxAge': maxAge,
+        'minAge': minAge,
+        'boyList': boyList,
+        'girlList': girlList,
+        'ratioData': ratioData,
+        'circleData': legacyCircleData(rows),
+        'wordData': wordData,
+        'lastData': {'xData': xData, 'y1Data': y1Data, 'y2Data': y2Data},
+    }
+
+
+# ==================== 检查 ====================
+
+def _insertCase(case):
+    """写入一条病例（已迁移时与爬虫一样同时写类型化列）"""
+    caseType, gender, age, visitTime, hospital, department, height, weight = case
+    fields = list(CASE_FIELDS)
+    values = [caseType, gender, age, visitTime, '病情描述', '医生', hospital, department, 'url', height, weight,
+              '无', '无']
+    if caseSchema.typedColumnsReady():
+        fields += [name for name, _ in caseSchema.TYPED_COLUMNS]
+        values += list(caseSchema.typedValues(age, height, weight, visitTime))
+    querys(f'insert into cases({", ".join(fields)}) values ({", ".join(["%s"] * len(values))})', values)
+
+
+def _loadFixedCases():
+    querys(CASES_DDL, [])
+    for case in FIXED_CASES + DIVERGENT_CASES:
+        _insertCase(case)
+
+
+def _expectedHomeData():
+    """旧计数器在当前 cases 表上的结果（按 id 顺序，与旧代码 select * 的读取顺序相同）"""
+    return legacyHomeData(querys('select * from cases order by id', [], 'select'))
+
+
+def _sqlHomeData():
+    """utils.getAllData 的 SQL 聚合，整理成与 getMaterializedHomeData 相同的字段"""
+    configOne, wordData = getConfigOne()
+    maxNum, maxType, maxDep, maxHos, maxAge, minAge = getFoundData()
+    xData, y1Data, y2Data = getBodyData()
+    return {
+        'configOne': configOne, 'wordData': wordData,
+        'maxNum': maxNum, 'maxType': maxType, 'maxDep': maxDep, 'maxHos': maxHos, 'maxAge': maxAge, 'minAge': minAge,
+        'circleData': getCircleData(),
+        'lastData': {'xData': xData, 'y1Data': y1Data, 'y2Data': y2Data},
+    }
+
+
+def _compare(label, actual, expected):
+    return [f'{label}.{k}' for k, v in actual.items() if v != expected[k]]
+
+
+def _checkState(state):
+    """当前状态（未迁移/已迁移）下的 SQL 聚合与全量重建的汇总表"""
+    caseSchema.resetTypedColumnsCache()
+    expected = _expectedHomeData()
+    mismatched = _compare(f'{state}.sql', _sqlHomeData(), expected)
+    rebuildAggregates()
+    mismatched += _compare(f'{state}.materialized', getMaterializedHomeData(), expected)
+    return mismatched
+
+
+def _checkIncremental():
+    """按爬虫的方式插入一条病例并增量更新，结果应与旧计数器以及再次全量重建相同"""
+    with aggregateLock():
+        _insertCase(EXTRA_CASE)
+        applyCaseChange(newCase=getCaseById(querys('select last_insert_id()', [], 'select')[0][0]))
+    expected = _expectedHomeData()
+    mismatched = _compare('incremental', getMaterializedHomeData(), expected)
+    rebuildAggregates()
+    return mismatched + _compare('incremental.rebuilt', getMaterializedHomeData(), expected)
+
+
+def checkFixedCases():
+    """
+    在临时库中用固定病例检查首页统计
+
+    返回：
+        list: 不一致的字段（空列表表示全部一致）
+    """
+    database = querys('select database()', [], 'select')[0][0]
+    querys(f'drop database if exists {CHECK_DATABASE}', [])
+    querys(f'create database {CHECK_DATABASE} default charset utf8mb4', [])
+    try:
+        querys(f'use {CHECK_DATABASE}', [])
+        caseSchema.resetTypedColumnsCache()
+        _loadFixedCases()
+        mismatched = _checkState('raw')
+        caseSchema.migrate()
+        mismatched += _checkState('typed')
+        mismatched += _checkIncremental()
+        return mismatched
+    finally:
+        querys(f'use {database}', [])
+        querys(f'drop database if exists {CHECK_DATABASE}', [])
+        caseSchema.resetTypedColumnsCache()
+
+
+if __name__ == '__main__':
+    import sys
+    mismatched = checkFixedCases()
+    if mismatched:
+        print(f"❌ 以下字段与旧计数器的结果不一致: {', '.join(mismatched)}")
+        sys.exit(1)
+    print("✅ 固定数据检查通过（未迁移 / 已迁移 / 增量更新）")
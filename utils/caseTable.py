@@ -0,0 +1,396 @@
+import base64
+import datetime
+import json
+import math
+import re
+import threading
+import time
+from utils.query import querys
+from utils.homeAggregates import countFromAggregates
+from utils.caseSchema import TYPED_COLUMNS, fulltextReady, typedSql
+
+# ==================== 病例列表：分页、筛选、排序 ====================
+# /tableData 不再一次返回全表：
+#   - keyset 分页：按 (排序列, id) 记录上一页最后一行，下一页从它之后取，深翻页不需要 offset 扫描
+#   - 只查询 fields 指定的列；排序、筛选在 MySQL 中完成（类型化列经 typedSql()，未迁移时退回原始列现场解析）
+#   - content 用全文索引检索（ngram 分词，支持中文）；还没有全文索引时退回 like
+#   - 总数优先读首页汇总表 case_aggregates（取值按 cases 列自身的排序规则比较，与列表的筛选结果一致）；
+#     汇总表覆盖不了的筛选组合才 count(*)，结果缓存一段时间
+#   - 病例数据页的统计卡片和分析图表（/tableData/stats）按原始列 GROUP BY 后在这里分类，前端不再下载全表
+
+CASE_COLUMNS = ['id', 'type', 'gender', 'age', 'time', 'content', 'docName', 'docHospital', 'department',
+                'detailUrl', 'height', 'weight', 'illDuration', 'allergy']
+# 排序参数 → 排序列（数值/日期用类型化列，查询时经 typedSql() 取表达式）
+SORT_COLUMNS = {
+    'id': 'id',
+    'age': 'age_years',
+    'height': 'height_cm',
+    'weight': 'weight_kg',
+    'time': 'visit_date',
+    'type': 'type',
+    'department': 'department',
+    'hospital': 'docHospital',
+}
+# 等值筛选参数 → 列
+EQUAL_FILTERS = {'type': 'type', 'department': 'department', 'hospital': 'docHospital', 'gender': 'gender'}
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+HOME_CASES_LIMIT = 50  # 首页病例列表展示的条数
+COUNT_CACHE_TTL = 60  # count(*) 结果的缓存时间（秒）
+
+# 病例数据页分析图表的分类（与 TableData.vue 原先在前端的计算相同）
+DURATION_LABELS = ['一周内', '一月内', '半年内', '大于半年', '10年以上', '无记录']
+BMI_LABELS = ['偏瘦 (<18.5)', '正常 (18.5-24)', '超重 (24-28)', '肥胖 (≥28)', '数据缺失']
+HEATMAP_DISEASES = ['高血压', '感冒', '骨折', '颈椎病', '腰椎间盘突出', '胃炎', '抑郁症']
+HEATMAP_AGE_RANGES = [('0-30岁', 0, 30), ('31-45岁', 31, 45), ('46-60岁', 46, 60), ('61岁以上', 61, None)]
+
+# 与 JS 的 parseInt / parseFloat 相同的前缀解析
+JS_INT_RE = re.compile(r'\s*([+-]?[0-9]+)')
+JS_FLOAT_RE = re.compile(r'\s*([+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?)')
+
+TYPED_NAMES = {name for name, _ in TYPED_COLUMNS}
+SQL_NAME_RE = re.compile(r'\w+')
+
+_countCache = {}
+_countCacheLock = threading.Lock()
+_collations = None
+_statsCache = None
+
+
+def _encodeCursor(value, caseId):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, caseId]).encode()).decode()
+
+
+def _decodeCursor(cursor):
+    try:
+        value, caseId = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return value, int(caseId)
+    except Exception:
+        raise ValueError('无效的 cursor')
+
+
+def _toInt(name, value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} 必须是整数')
+
+
+def parseTableParams(args):
+    """
+    把请求参数整理成查询条件（参数不合法时抛 ValueError）
+
+    参数：
+        args (dict): 请求参数（query string 或 JSON）
+            fields     逗号分隔的列名（默认全部）
+            sort       排序字段：id / age / height / weight / time / type / department / hospital（默认 id）
+            order      asc / desc（默认 asc）
+            cursor     上一页返回的 nextCursor
+            limit      每页条数（默认20，最多200）
+            type / department / hospital / gender   等值筛选
+            ageMin / ageMax                         年龄范围（含端点）
+            q          病情描述全文检索
+
+    返回：
+        dict: queryCases 的关键字参数
+    """
+    fields = args.get('fields') or ','.join(CASE_COLUMNS)
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if isinstance(fields, str) else list(fields)
+    unknown = [f for f in fields if f not in CASE_COLUMNS]
+    if unknown:
+        raise ValueError(f'未知的列: {", ".join(unknown)}')
+    sort = args.get('sort') or 'id'
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f'不支持的排序字段: {sort}（可选: {", ".join(SORT_COLUMNS)}）')
+    order = (args.get('order') or 'asc').lower()
+    if order not in ('asc', 'desc'):
+        raise ValueError('order 只能是 asc 或 desc')
+    limit = _toInt('limit', args.get('limit') or PAGE_SIZE)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit 必须在 1~{MAX_PAGE_SIZE} 之间')
+    filters = {k: args[k] for k in EQUAL_FILTERS if args.get(k)}
+    for k in ('ageMin', 'ageMax'):
+        if args.get(k) not in (None, ''):
+            filters[k] = _toInt(k, args[k])
+    q = str(args.get('q') or '').strip()
+    if q:
+        filters['q'] = q
+    return {'fields': fields, 'sort': sort, 'desc': order == 'desc', 'cursor': args.get('cursor') or None,
+            'limit': limit, 'filters': filters}
+
+
+def _columnSql(col):
+    """排序/筛选列的 SQL（类型化列未迁移时是原始列的解析表达式）"""
+    return typedSql(col) if col in TYPED_NAMES else col
+
+
+def _whereClause(filters):
+    where, params = [], []
+    for k, col in EQUAL_FILTERS.items():
+        if k in filters:
+            where.append(f'{col} = %s')
+            params.append(filters[k])
+    age = _columnSql('age_years')
+    if 'ageMin' in filters:
+        where.append(f'{age} >= %s')
+        params.append(filters['ageMin'])
+    if 'ageMax' in filters:
+        where.append(f'{age} <= %s')
+        params.append(filters['ageMax'])
+    if 'q' in filters:
+        if fulltextReady():
+            # 整句作为短语匹配（去掉布尔模式的运算符引号）
+            where.append('match(content) against (%s in boolean mode)')
+            params.append('"' + filters['q'].replace('"', ' ') + '"')
+        else:
+            where.append('content like %s')
+            params.append('%' + filters['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    return where, params
+
+
+def _afterCursor(col, desc, value, lastId):
+    """keyset 条件：排在 (value, lastId) 之后的行（MySQL 中 NULL 升序排最前、降序排最后）"""
+    op = '<' if desc else '>'
+    if col == 'id':
+        return f'id {op} %s', [lastId]
+    if value is None:
+        if desc:
+            return f'({col} is null and id < %s)', [lastId]
+        return f'({col} is null and id > %s or {col} is not null)', [lastId]
+    cond = f'({col} {op} %s or {col} = %s and id {op} %s' + (f' or {col} is null)' if desc else ')')
+    return cond, [value, value, lastId]
+
+
+def _columnCollation(col):
+    """cases 列的 (字符集, 排序规则)；查不到时返回None"""
+    global _collations
+    if _collations is None:
+        try:
+            rows = querys("select column_name, character_set_name, collation_name from information_schema.columns "
+                          "where table_schema = database() and table_name = 'cases'", [], 'select')
+        except Exception:
+            return None
+        _collations = {name: (charset, collation) for name, charset, collation in rows
+                       if charset and collation and SQL_NAME_RE.fullmatch(charset) and SQL_NAME_RE.fullmatch(collation)}
+    return _collations.get(col)
+
+
+def _countFromAggregates(filters):
+    """
+    汇总表能直接给出总数的筛选组合；覆盖不了时返回None
+
+    说明：
+        汇总表按字节区分取值（'Flu'/'flu'、'flu'/'flu '是不同的行），列表的 type = %s 按列的排序规则比较，
+        所以按列的排序规则把所有相等的取值加起来；查不到列的排序规则时不用汇总表。
+        性别没有对应的维度（boyType/girlType 只按"男"/"女"精确归类），带性别的筛选都走 count(*)
+    """
+    keys = set(filters)
+    if not keys:
+        return countFromAggregates('type')
+    for dim, key in (('type', 'type'), ('department', 'department'), ('hospital', 'hospital')):
+        if keys == {key}:
+            collation = _columnCollation(EQUAL_FILTERS[key])
+            return countFromAggregates(dim, filters[key], collation=collation) if collation else None
+    if keys <= {'ageMin', 'ageMax'}:
+        return countFromAggregates('age', ageMin=filters.get('ageMin'), ageMax=filters.get('ageMax'))
+    return None
+
+
+def countCases(filters):
+    """符合筛选条件的病例总数（先查汇总表，再查缓存，最后 count(*)）"""
+    total = _countFromAggregates(filters)
+    if total is not None:
+        return total
+    key = tuple(sorted(filters.items()))
+    now = time.time()
+    with _countCacheLock:
+        cached = _countCache.get(key)
+        if cached and now - cached[1] < COUNT_CACHE_TTL:
+            return cached[0]
+    where, params = _whereClause(filters)
+    sql = 'select count(*) from cases' + (' where ' + ' and '.join(where) if where else '')
+    total = int(querys(sql, params, 'select')[0][0])
+    with _countCacheLock:
+        if len(_countCache) > 1000:
+            _countCache.clear()
+        _countCache[key] = (total, now)
+    return total
+
+
+def queryCases(fields=None, sort='id', desc=False, cursor=None, limit=PAGE_SIZE, filters=None, withTotal=True):
+    """
+    分页查询病例列表
+
+    返回：
+        dict: {
+            'rows': [{列名: 值}, ...],
+            'nextCursor': 下一页的 cursor（没有下一页时为None）,
+            'hasMore': bool,
+            'total': 符合筛选条件的总数（withTotal=False 时不返回）
+        }
+    """
+    fields = fields or CASE_COLUMNS
+    filters = filters or {}
+    col = _columnSql(SORT_COLUMNS[sort])
+    where, params = _whereClause(filters)
+    if cursor:
+        cond, condParams = _afterCursor(col, desc, *_decodeCursor(cursor))
+        where.append(cond)
+        params += condParams
+    direction = 'desc' if desc else 'asc'
+    orderBy = f'id {direction}' if col == 'id' else f'{col} {direction}, id {direction}'
+    sql = (f'select id, {col}, {", ".join(fields)} from cases'
+           + (' where ' + ' and '.join(where) if where else '')
+           + f' order by {orderBy} limit %s')
+    rows = querys(sql, params + [limit + 1], 'select')
+    hasMore = len(rows) > limit
+    rows = rows[:limit]
+    result = {
+        'rows': [dict(zip(fields, row[2:])) for row in rows],
+        'nextCursor': _encodeCursor(rows[-1][1], rows[-1][0]) if hasMore else None,
+        'hasMore': hasMore,
+    }
+    if withTotal:
+        result['total'] = countCases(filters)
+    return result
+
+
+def _jsInt(value):
+    match = JS_INT_RE.match(str(value)) if value is not None else None
+    return int(match.group(1)) if match else None
+
+
+def _jsFloat(value):
+    match = JS_FLOAT_RE.match(str(value)) if value is not None else None
+    return float(match.group(1)) if match else None
+
+
+def _durationLabel(duration):
+    duration = duration or '无'
+    if '周' in duration or '天' in duration or duration == '1日':
+        return '一周内'
+    if '月' in duration and '半年' not in duration:
+        return '一月内'
+    if '半年' in duration:
+        return '半年内'
+    if '年' in duration:
+        years = _jsInt(duration)
+        return '10年以上' if years is not None and years >= 10 else '大于半年'
+    return '无记录'
+
+
+def _bmi(height, weight):
+    """身高/体重缺失或为0时返回None"""
+    height, weight = _jsFloat(height), _jsFloat(weight)
+    if not height or not weight:
+        return None
+    return weight / ((height / 100) ** 2)
+
+
+def _bmiLabel(bmi):
+    if bmi is None:
+        return '数据缺失'
+    if bmi < 18.5:
+        return '偏瘦 (<18.5)'
+    if bmi < 24:
+        return '正常 (18.5-24)'
+    if bmi < 28:
+        return '超重 (24-28)'
+    return '肥胖 (≥28)'
+
+
+def _computeTableStats():
+    stats = {'total': 0, 'maleCount': 0, 'femaleCount': 0, 'avgAge': None}
+    for gender, cnt in querys('select min(gender), count(*) from cases group by cast(gender as binary)', [], 'select'):
+        stats['total'] += int(cnt)
+        if gender == '男':
+            stats['maleCount'] = int(cnt)
+        elif gender == '女':
+            stats['femaleCount'] = int(cnt)
+
+    ageSum = ageCnt = 0
+    for age, cnt in querys('select min(age), count(*) from cases group by cast(age as binary)', [], 'select'):
+        years = _jsInt(age)
+        if years is not None:
+            ageSum += years * int(cnt)
+            ageCnt += int(cnt)
+    if ageCnt:
+        stats['avgAge'] = math.floor(ageSum / ageCnt + 0.5)  # 与 JS 的 Math.round 相同
+
+    duration = dict.fromkeys(DURATION_LABELS, 0)
+    for illDuration, cnt in querys('select min(illDuration), count(*) from cases group by cast(illDuration as binary)',
+                                   [], 'select'):
+        duration[_durationLabel(illDuration)] += int(cnt)
+    stats['duration'] = {'xData': DURATION_LABELS, 'yData': list(duration.values())}
+
+    bmi = dict.fromkeys(BMI_LABELS, 0)
+    hypertension = {'count': 0, 'obese': 0}
+    hypertensionSql = "instr(type, '高血压') > 0"
+    rows = querys(f'select min(height), min(weight), {hypertensionSql}, count(*) from cases '
+                  f'group by cast(height as binary), cast(weight as binary), {hypertensionSql}', [], 'select')
+    for height, weight, isHypertension, cnt in rows:
+        value = _bmi(height, weight)
+        bmi[_bmiLabel(value)] += int(cnt)
+        if isHypertension:
+            hypertension['count'] += int(cnt)
+            if value is not None and value >= 28:
+                hypertension['obese'] += int(cnt)
+    stats['bmi'] = [{'name': name, 'value': value} for name, value in bmi.items()]
+    stats['hypertension'] = hypertension
+
+    counts = {}
+    rows = querys(f'select min(type), min(age), count(*) from cases '
+                  f'where type in ({", ".join(["%s"] * len(HEATMAP_DISEASES))}) '
+                  f'group by cast(type as binary), cast(age as binary)', HEATMAP_DISEASES, 'select')
+    for caseType, age, cnt in rows:
+        years = _jsInt(age)
+        # type in (...) 按列的排序规则比较（会匹配带尾部空格的取值），前端原先是精确比较
+        if years is None or caseType not in HEATMAP_DISEASES:
+            continue
+        for j, (_, low, high) in enumerate(HEATMAP_AGE_RANGES):
+            if years >= low and (high is None or years <= high):
+                key = (HEATMAP_DISEASES.index(caseType), j)
+                counts[key] = counts.get(key, 0) + int(cnt)
+    stats['heatmap'] = {
+        'xData': HEATMAP_DISEASES,
+        'yData': [label for label, _, _ in HEATMAP_AGE_RANGES],
+        'data': [[i, j, counts.get((i, j), 0)]
+                 for i in range(len(HEATMAP_DISEASES)) for j in range(len(HEATMAP_AGE_RANGES))],
+    }
+    return stats
+
+
+def getTableStats():
+    """
+    病例数据页的统计卡片和分析图表（全表，结果缓存 COUNT_CACHE_TTL 秒）
+
+    说明：
+        每项统计只按相关的原始列 GROUP BY（按字节分组，与前端的精确比较一致；取值种类远少于行数），
+        分类规则与前端原先逐行计算的相同
+
+    返回：
+        dict: {
+            'total', 'maleCount', 'femaleCount', 'avgAge',
+            'duration': {'xData', 'yData'},        患病时长分布
+            'bmi': [{'name', 'value'}, ...],       BMI 分布
+            'hypertension': {'count', 'obese'},    高血压患者数 / 其中肥胖人数
+            'heatmap': {'xData', 'yData', 'data'}  疾病-年龄热力图
+        }
+    """
+    global _statsCache
+    now = time.time()
+    with _countCacheLock:
+        if _statsCache and now - _statsCache[1] < COUNT_CACHE_TTL:
+            return _statsCache[0]
+    stats = _computeTableStats()
+    with _countCacheLock:
+        _statsCache = (stats, now)
+    return stats
+
+
+def getHomeCases(limit=HOME_CASES_LIMIT):
+    """首页病例列表：前 limit 条（列顺序与原表相同，前端按下标取列）"""
+    return querys(f'select {", ".join(CASE_COLUMNS)} from cases order by id limit %s', [limit], 'select')
@@ -1,175 +1,52 @@
-from utils.getPublicData import getAllCasesData
-
-
-def getPieData():
-    casesList = getAllCasesData()
-    ageDic = {'0-10岁':0,'10-20岁':0,'10-20岁':0,'20-30岁':0,'30-40岁':0,'40-50岁':0,'50-60岁':0,'60岁以上':0}
-    for caseItem in casesList:
-        if int(caseItem[3]) < 10:
-            ageDic['0-10岁'] += 1
-        elif int(caseItem[3]) < 20:
-            ageDic['10-20岁'] += 1
-        elif int(caseItem[3]) < 30:
-            ageDic['20-30岁'] += 1
-        elif int(caseItem[3]) < 40:
-            ageDic['30-40岁'] += 1
-        elif int(caseItem[3]) < 50:
-            ageDic['40-50岁'] += 1
-        elif int(caseItem[3]) < 60:
-            ageDic['50-60岁'] += 1
-        else:
-            ageDic['60岁以上'] += 1
-    # print(ageDic)
-    listResult = []
-    for k,v in ageDic.items():
-        listResult.append({
-            'name':k,
-            'value':v
-        })
-    print(listResult)
-    return listResult
+from utils.query import querys
+from utils.caseSchema import typedSql
+
+# ==================== SQL 聚合 ====================
+# 统计在 MySQL 中用 GROUP BY 完成，只有聚合结果（每个类别一行）传回 Python。
+# 与原来逐条累加字典的写法保持一致：
+#   - 按 cast(col as binary) 分组：区分大小写和尾部空格，与 Python 字典的键相同
+#   - order by min(id)：类别按首次出现的顺序；排名时数量相同也按首次出现顺序（即稳定排序）
+#   - 年龄/身高/体重使用类型化列 age_years / height_cm / weight_kg（utils.caseSchema 迁移后可用），
+#     无法解析的原始值在这些列中为 NULL，不再逐行 cast；未迁移的库由 typedSql 退回现场解析原始列
+
+def bodySql(col):
+    """身高/体重都有值时取 col（height_cm / weight_kg），否则记0（原逻辑：身高有值且体重为'无'记0）"""
+    height, weight = typedSql('height_cm'), typedSql('weight_kg')
+    return f'case when {height} is not null and {weight} is not null then {typedSql(col)} else 0 end'
+
+def _groupCount(col, extra='', where='', order='min(id)', limit=''):
+    """按 col 分组计数，返回 [(取值, 数量, *extra), ...]"""
+    return querys(f'select min({col}), count(*){extra} from cases {where} '
+                  f'group by cast({col} as binary) order by {order} {limit}', [], 'select')
+
+def _topValue(col):
+    """数量最多的取值（并列时取首次出现的）"""
+    rows = _groupCount(col, order='count(*) desc, min(id)', limit='limit 1')
+    return rows[0][0] if rows else None
 
 def getConfigOne():
-    casesList = getAllCasesData()
-    caseDic = {}
-    for caseItem in casesList:
-        if caseDic.get(caseItem[1],-1) == -1:
-            caseDic[caseItem[1]] = 1
-        else:
-            caseDic[caseItem[1]] += 1
-    listResult = []
-    for k,v in caseDic.items():
-        listResult.append({
-            'name':k,
-            'value':v
-        })
-    print(1,listResult)
+    listResult = [{'name': k, 'value': int(v)} for k, v in _groupCount('type')]
     return listResult[:6],listResult
 
 def getFoundData():
-    casesList = getAllCasesData()
-    maxNum = len(list(casesList))
-    typeDic = {}
-    depDic = {}
-    hosDic = {}
-    maxAge = 0
-    minAge = 100
-    for caseItem in casesList:
-        #类型
-        if typeDic.get(caseItem[1],-1) == -1:
-            typeDic[caseItem[1]] = 1
-        else:
-            typeDic[caseItem[1]] += 1
-        #科室
-        if depDic.get(caseItem[8],-1) == -1:
-            depDic[caseItem[8]] = 1
-        else:
-            depDic[caseItem[8]] += 1
-        #医院
-        if hosDic.get(caseItem[7],-1) == -1:
-            hosDic[caseItem[7]] = 1
-        else:
-            hosDic[caseItem[7]] += 1
-        #年龄
-        if int(caseItem[3]) > maxAge:
-            maxAge = int(caseItem[3])
-        if int(caseItem[3]) < minAge:
-            minAge = int(caseItem[3])
-
-    typeSort = sorted(typeDic.items(),key=lambda data:data[1],reverse=True)
-    depSort = sorted(depDic.items(), key=lambda data: data[1], reverse=True)
-    hosSort = sorted(hosDic.items(), key=lambda data: data[1], reverse=True)
-    maxType = typeSort[0][0]
-    maxDep = depSort[0][0]
-    maxHos = hosSort[0][0]
-    return maxNum,maxType,maxDep,maxHos,maxAge,minAge
-
-def getGenderData():
-    casesList = getAllCasesData()
-    boyDic = {}
-    girlDic = {}
-    boyNum = 0
-    girlNum = 0
-    for caseItem in casesList:
-        if caseItem[2] == '男':
-            boyNum += 1
-            if boyDic.get(caseItem[1],-1) == -1:
-                boyDic[caseItem[1]] = 1
-            else:
-                boyDic[caseItem[1]] += 1
-        elif caseItem[2] == '女':
-            girlNum += 1
-            if girlDic.get(caseItem[1],-1) == -1:
-                girlDic[caseItem[1]] = 1
-            else:
-                girlDic[caseItem[1]] += 1
-
-    ratioData = []
-    boyRatio = int(round(boyNum / len(casesList) * 100,0))
-    girlRatio = int(round(girlNum / len(casesList) * 100,0))
-    print(boyRatio, girlRatio)
-    ratioData.append(girlRatio)
-    ratioData.append(boyRatio)
-    boyList = []
-    girlList = []
-    for k,v in boyDic.items():
-        boyList.append({
-            'name':k,
-            'value':v
-        })
-    for k,v in girlDic.items():
-        girlList.append({
-            'name':k,
-            'value':v
-        })
-    return boyList,girlList,ratioData
+    age = typedSql('age_years')
+    maxNum, maxAge, minAge = querys(f'select count(*), max({age}), min({age}) from cases', [], 'select')[0]
+    maxType = _topValue('type')
+    maxDep = _topValue('department')
+    maxHos = _topValue('docHospital')
+    maxAge = 0 if maxAge is None else max(0, int(maxAge))
+    minAge = 100 if minAge is None else min(100, int(minAge))
+    return int(maxNum),maxType,maxDep,maxHos,maxAge,minAge
 
 def getCircleData():
-    casesList = getAllCasesData()
-    depDic = {}
-    for caseItem in casesList:
-        if depDic.get(caseItem[8],-1) == -1:
-            depDic[caseItem[8]] = 1
-        else:
-            depDic[caseItem[8]] += 1
-    # print(depDic)
-    dataSort = sorted(depDic.items(),key=lambda data:data[1],reverse=True)
-    dataResultList = []
-    for i in dataSort:
-        dataResultList.append({
-            'name':i[0],
-            'value':i[1]
-        })
-
-    return dataResultList
+    rows = _groupCount('department', order='count(*) desc, min(id)')
+    return [{'name': k, 'value': int(v)} for k, v in rows]
 
 def getBodyData():
-    casesList = getAllCasesData()
-    dataDic = {}
-    xData = []
-    sumData = []
-    for caseItem in casesList:
-        if dataDic.get(caseItem[1],-1) == -1:
-            dataDic[caseItem[1]] = 1
-        else:
-            dataDic[caseItem[1]] += 1
-    dataSort = sorted(dataDic.items(),key=lambda data:data[1],reverse=True)
-    for i in dataSort:
-        xData.append(i[0])
-        sumData.append(i[1])
-    y1Data = [0 for x in range(len(xData))]
-    y2Data = [0 for x in range(len(xData))]
-    for caseItem in casesList:
-        for index,x in enumerate(xData):
-            if caseItem[1] == x:
-                if caseItem[10] and caseItem[11] == '无':
-                    y1Data[index] += 0
-                    y2Data[index] += 0
-                else:
-                    y1Data[index] += int(caseItem[10])
-                    y2Data[index] += int(caseItem[11])
-    print(y1Data,y2Data,sumData)
-    for index,sum in enumerate(sumData):
-        y1Data[index] = round(y1Data[index]/sumData[index],0)
-        y2Data[index] = round(y2Data[index] / sumData[index], 0)
+    rows = _groupCount('type', extra=f", sum({bodySql('height_cm')}), sum({bodySql('weight_kg')})",
+                       order='count(*) desc, min(id)')
+    xData = [k for k, _, _, _ in rows]
+    y1Data = [round(int(h) / int(n), 0) for _, n, h, _ in rows]
+    y2Data = [round(int(w) / int(n), 0) for _, n, _, w in rows]
     return xData,y1Data,y2Data
+
@@ -0,0 +1,363 @@
+import threading
+from utils.query import querys, namedLock
+from utils.caseSchema import parseSmallInt, typedSql
+from utils.getAllData import bodySql, getConfigOne, getFoundData, getCircleData, getBodyData
+
+# ==================== 首页统计的物化汇总表 ====================
+# case_aggregates 每行是一个 (维度, 取值) 的汇总：病例数、身高/体重合计、该取值首次出现的病例id。
+# 爬虫写入/更新 cases 时按增量累加（insert ... on duplicate key update），/getHomeData 只读这张表，
+# 耗时与类别数有关、与病例数无关；定时全量重建兜底（增量漏记、删除病例、类型被修改等情况）
+# 爬虫"写 cases + 增量更新"和全量重建用 MySQL 命名锁（GET_LOCK）互斥：否则重建期间的增量
+# 会写进随后被 rename 替换掉的旧表而丢失，或者既被重建统计到、又被增量再加一次
+#
+# 维度：
+#   age        年龄值（饼图分段、最大/最小年龄由它算出）
+#   type       病例类型（带身高/体重合计）
+#   department 科室
+#   hospital   医院
+#   boyType / girlType  男/女病例的类型
+
+AGG_TABLE = 'case_aggregates'
+AGG_REBUILD_INTERVAL = 3600  # 定时全量重建间隔（秒）
+AGG_LOCK_NAME = 'case_aggregates'  # GET_LOCK 锁名（跨进程：Web服务与爬虫）
+AGG_LOCK_TIMEOUT = 120  # 等待锁的最长时间（秒）
+AGE_BINS = [10, 20, 30, 40, 50, 60]
+AGE_LABELS = ['0-10岁', '10-20岁', '20-30岁', '30-40岁', '40-50岁', '50-60岁', '60岁以上']
+
+_rebuildLock = threading.Lock()
+_refresher = None
+_refresherLock = threading.Lock()
+
+
+def _createTableSql(table):
+    # name 用 varbinary：主键按字节比较，与重建时 group by cast(col as binary) 的分组一致
+    # （utf8mb4_bin 是 PAD SPACE 排序规则，'flu' 和 'flu ' 会撞主键）
+    return f'''
+        create table if not exists {table}
+        (
+            dim        varchar(32)  not null,
+            nameIsNull tinyint      not null default 0,
+            name       varbinary(1020) not null,
+            cnt        int          not null default 0,
+            heightSum  bigint       not null default 0,
+            weightSum  bigint       not null default 0,
+            firstId    int          not null,
+            primary key (dim, nameIsNull, name)
+        ) default charset = utf8mb4
+    '''
+
+
+def aggregateLock():
+    """
+    汇总表的跨进程互斥锁
+
+    示例：
+        >>> with aggregateLock():
+        ...     querys('insert into cases ...', [...])
+        ...     applyCaseChange(newCase=row)
+    """
+    return namedLock(AGG_LOCK_NAME, AGG_LOCK_TIMEOUT)
+
+
+def createAggregateTable():
+    querys(_createTableSql(AGG_TABLE), [])
+
+
+def _bodyValues(height, weight):
+    """身高/体重计入合计的值（两者都能解析时计入，否则记0，与 getBodyData 的 SQL 一致）"""
+    h, w = parseSmallInt(height), parseSmallInt(weight)
+    if h is None or w is None:
+        return 0, 0
+    return h, w
+
+
+def _rowDeltas(caseItem, sign=1):
+    """
+    一条病例对汇总表的贡献
+
+    参数：
+        caseItem: cases 表的一行（select * 的顺序）
+        sign (int): 1 计入，-1 撤销
+
+    返回：
+        list: [((dim, name), (cnt, heightSum, weightSum, firstId)), ...]
+    """
+    caseId, caseType, gender = caseItem[0], caseItem[1], caseItem[2]
+    h, w = _bodyValues(caseItem[10], caseItem[11])
+    deltas = [
+        (('type', caseType), (sign, sign * h, sign * w, caseId)),
+        (('department', caseItem[8]), (sign, 0, 0, caseId)),
+        (('hospital', caseItem[7]), (sign, 0, 0, caseId)),
+    ]
+    age = parseSmallInt(caseItem[3])
+    if age is not None:
+        deltas.append((('age', str(age)), (sign, 0, 0, caseId)))
+    if gender == '男':
+        deltas.append((('boyType', caseType), (sign, 0, 0, caseId)))
+    elif gender == '女':
+        deltas.append((('girlType', caseType), (sign, 0, 0, caseId)))
+    return deltas
+
+
+def _mergeDeltas(deltas, merged=None):
+    merged = {} if merged is None else merged
+    for key, (cnt, hSum, wSum, firstId) in deltas:
+        if key in merged:
+            c, hs, ws, f = merged[key]
+            merged[key] = (c + cnt, hs + hSum, ws + wSum, min(f, firstId))
+        else:
+            merged[key] = (cnt, hSum, wSum, firstId)
+    return merged
+
+
+def _upsert(table, merged):
+    sql = f'''
+        insert into {table}(dim, nameIsNull, name, cnt, heightSum, weightSum, firstId)
+        values (%s, %s, %s, %s, %s, %s, %s)
+        on duplicate key update cnt = cnt + values(cnt),
+                                heightSum = heightSum + values(heightSum),
+                                weightSum = weightSum + values(weightSum),
+                                firstId = least(firstId, values(firstId))
+    '''
+    for (dim, name), (cnt, hSum, wSum, firstId) in merged.items():
+        if cnt == 0 and hSum == 0 and wSum == 0:
+            continue
+        querys(sql, [dim, int(name is None), '' if name is None else str(name), cnt, hSum, wSum, firstId])
+
+
+def applyCaseChange(oldCase=None, newCase=None):
+    """
+    按一条病例的变化增量更新汇总表（爬虫写入 cases 后调用；写入和本函数应在同一个 aggregateLock 内）
+
+    参数：
+        oldCase: 变化前的行（新插入时为None）
+        newCase: 变化后的行（删除时为None）
+
+    示例：
+        >>> applyCaseChange(newCase=row)              # 新增
+        >>> applyCaseChange(oldCase=old, newCase=new)  # 更新（只有变化的部分会写入）
+    """
+    deltas = []
+    if oldCase is not None:
+        deltas += _rowDeltas(oldCase, -1)
+    if newCase is not None:
+        deltas += _rowDeltas(newCase, 1)
+    _upsert(AGG_TABLE, _mergeDeltas(deltas))
+
+
+def getCaseById(caseId):
+    rows = querys('select * from cases where id = %s', [caseId], 'select')
+    return rows[0] if rows else None
+
+
+def _rebuildSql(table, dim, col, where='', sums='0, 0'):
+    """按 col 分组写入一个维度（分组、排序规则与 utils.getAllData 的 SQL 聚合相同）"""
+    return (f"insert into {table}(dim, nameIsNull, name, cnt, heightSum, weightSum, firstId) "
+            f"select '{dim}', min({col}) is null, coalesce(min({col}), ''), count(*), {sums}, min(id) "
+            f"from cases {where} group by cast({col} as binary)")
+
+
+def rebuildAggregates():
+    """
+    从 cases 表全量重建汇总表
+
+    说明：
+        - 每个维度一条 insert ... select ... group by，统计完全在 MySQL 内完成，不向 Python 传输病例行
+        - 写入临时表后 rename 原子切换，读请求不会看到半成品
+        - 整个过程持有 aggregateLock，爬虫的写入和增量更新在重建前或重建后进行，不会丢失或重复计入
+
+    返回：
+        int: 参与统计的病例数
+    """
+    with _rebuildLock, aggregateLock():
+        staging = AGG_TABLE + '_new'
+        createAggregateTable()
+        querys(f'drop table if exists {staging}', [])
+        querys(_createTableSql(staging), [])
+        querys(_rebuildSql(staging, 'type', 'type', sums=f"sum({bodySql('height_cm')}), sum({bodySql('weight_kg')})"), [])
+        querys(_rebuildSql(staging, 'department', 'department'), [])
+        querys(_rebuildSql(staging, 'hospital', 'docHospital'), [])
+        querys(_rebuildSql(staging, 'boyType', 'type', where="where gender = '男'"), [])
+        querys(_rebuildSql(staging, 'girlType', 'type', where="where gender = '女'"), [])
+        age = typedSql('age_years')
+        querys(f"insert into {staging}(dim, nameIsNull, name, cnt, heightSum, weightSum, firstId) "
+               f"select 'age', 0, cast(min({age}) as char), count(*), 0, 0, min(id) "
+               f"from cases where {age} is not null group by {age}", [])
+        querys(f'rename table {AGG_TABLE} to {AGG_TABLE}_old, {staging} to {AGG_TABLE}', [])
+        querys(f'drop table if exists {AGG_TABLE}_old', [])
+        return int(querys('select count(*) from cases', [], 'select')[0][0])
+
+
+def _loadAggregates():
+    rows = querys(f'select dim, nameIsNull, name, cnt, heightSum, weightSum, firstId from {AGG_TABLE} '
+                  f'where cnt > 0 order by dim, firstId', [], 'select')
+    groups = {}
+    for dim, nameIsNull, name, cnt, hSum, wSum, firstId in rows:
+        if isinstance(name, (bytes, bytearray)):
+            name = name.decode('utf8')
+        groups.setdefault(dim, []).append((None if nameIsNull else name, int(cnt), int(hSum), int(wSum)))
+    return groups
+
+
+def countFromAggregates(dim, name=None, ageMin=None, ageMax=None, collation=None):
+    """
+    从汇总表读取病例数（分页列表的总数不必再 count(*) 扫表）
+
+    参数：
+        dim (str): 维度（type / department / hospital / boyType / girlType / age）
+        name (str): 取值；None 时汇总该维度的全部取值
+        ageMin / ageMax (int): dim='age' 时的年龄范围（含端点）
+        collation (tuple): (字符集, 排序规则)；给出时 name 按该排序规则比较，所有相等的取值合计
+            （汇总表的 name 按字节区分，传入 cases 列自身的排序规则才与 where col = name 的结果一致）
+
+    返回：
+        int 或 None: 汇总表不可用（未建立或为空）时返回None
+    """
+    where, params = ['dim = %s', 'cnt > 0'], [dim]
+    if name is not None:
+        if collation:
+            where.append(f'nameIsNull = 0 and convert(name using {collation[0]}) collate {collation[1]} = %s')
+        else:
+            where.append('nameIsNull = 0 and name = %s')
+        params.append(name)
+    if ageMin is not None:
+        where.append('cast(name as signed) >= %s')
+        params.append(ageMin)
+    if ageMax is not None:
+        where.append('cast(name as signed) <= %s')
+        params.append(ageMax)
+    try:
+        if not querys(f"select 1 from {AGG_TABLE} where dim = 'type' and cnt > 0 limit 1", [], 'select'):
+            return None
+        total = querys(f'select sum(cnt) from {AGG_TABLE} where {" and ".join(where)}', params, 'select')[0][0]
+    except Exception:
+        return None
+    return int(total or 0)
+
+
+def _byCount(items):
+    """按数量降序，数量相同保持首次出现顺序（与原函数的 sorted(..., reverse=True) 一致）"""
+    return sorted(items, key=lambda item: item[1], reverse=True)
+
+
+def getMaterializedHomeData():
+    """
+    从汇总表读取首页图表数据（/getHomeData 的 data 字段，不含 casesData）
+
+    说明：汇总表不存在或为空时先全量重建一次
+    """
+    try:
+        groups = _loadAggregates()
+    except Exception:
+        groups = {}
+    if not groups.get('type'):
+        rebuildAggregates()
+        groups = _loadAggregates()
+    types = groups.get('type', [])
+    if not types:
+        raise ValueError('cases表没有数据')
+    n = sum(cnt for _, cnt, _, _ in types)
+
+    ages = sorted((int(name), cnt) for name, cnt, _, _ in groups.get('age', []))
+    ageCounts = [0] * len(AGE_LABELS)
+    for age, cnt in ages:
+        ageCounts[sum(age >= b for b in AGE_BINS)] += cnt
+    pieData = [{'name': k, 'value': v} for k, v in zip(AGE_LABELS, ageCounts)]
+
+    wordData = [{'name': name, 'value': cnt} for name, cnt, _, _ in types]
+    typeSort = _byCount(types)
+    depSort = _byCount(groups.get('department', []))
+    hosSort = _byCount(groups.get('hospital', []))
+    boys = groups.get('boyType', [])
+    girls = groups.get('girlType', [])
+    boyRatio = int(round(sum(cnt for _, cnt, _, _ in boys) / n * 100, 0))
+    girlRatio = int(round(sum(cnt for _, cnt, _, _ in girls) / n * 100, 0))
+
+    return {
+        'pieData': pieData,
+        'configOne': wordData[:6],
+        'maxNum': n,
+        'maxType': typeSort[0][0],
+        'maxDep': depSort[0][0] if depSort else None,
+        'maxHos': hosSort[0][0] if hosSort else None,
+        'maxAge': max(0, ages[-1][0]) if ages else 0,
+        'minAge': min(100, ages[0][0]) if ages else 100,
+        'boyList': [{'name': name, 'value': cnt} for name, cnt, _, _ in boys],
+        'girlList': [{'name': name, 'value': cnt} for name, cnt, _, _ in girls],
+        'ratioData': [girlRatio, boyRatio],
+        'circleData': [{'name': name, 'value': cnt} for name, cnt, _, _ in depSort],
+        'wordData': wordData,
+        'lastData': {
+            'xData': [name for name, _, _, _ in typeSort],
+            'y1Data': [round(hSum / cnt, 0) for _, cnt, hSum, _ in typeSort],
+            'y2Data': [round(wSum / cnt, 0) for _, cnt, _, wSum in typeSort],
+        },
+    }
+
+
+# ==================== 定时全量重建 ====================
+
+def _refreshLoop(stop, interval):
+    while not stop.wait(interval):
+        try:
+            n = rebuildAggregates()
+            print(f"🔄 首页汇总表已重建（{n}条病例）")
+        except Exception as e:
+            print(f"⚠️  首页汇总表重建失败: {e}")
+
+
+def startAggregateRefresher(interval=None):
+    """启动定时全量重建线程（应用启动时调用一次；重复调用时直接返回）"""
+    global _refresher
+    with _refresherLock:
+        if _refresher is not None and _refresher[0].is_alive():
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=_refreshLoop, args=(stop, interval or AGG_REBUILD_INTERVAL),
+                                  name='aggregate-refresher', daemon=True)
+        thread.start()
+        _refresher = (thread, stop)
+
+
+def stopAggregateRefresher():
+    global _refresher
+    if _refresher is not None:
+        _refresher[1].set()
+        _refresher = None
+
+
+
+# ==================== 一致性检查 ====================
+
+def checkSqlAggregates():
+    """
+    对比按需 SQL 聚合（utils.getAllData）与全量重建后的汇总表给出的首页数据
+
+    返回：
+        list: 不一致的字段名（空列表表示完全一致）
+    """
+    configOne, wordData = getConfigOne()
+    maxNum, maxType, maxDep, maxHos, maxAge, minAge = getFoundData()
+    xData, y1Data, y2Data = getBodyData()
+    expected = {
+        'configOne': configOne, 'wordData': wordData,
+        'maxNum': maxNum, 'maxType': maxType, 'maxDep': maxDep, 'maxHos': maxHos, 'maxAge': maxAge, 'minAge': minAge,
+        'circleData': getCircleData(),
+        'lastData': {'xData': xData, 'y1Data': y1Data, 'y2Data': y2Data},
+    }
+    rebuildAggregates()
+    materialized = getMaterializedHomeData()
+    return [k for k, v in expected.items() if v != materialized[k]]
+
+if __name__ == '__main__':
+    # python -m utils.homeAggregates        手动全量重建（可放进 crontab）
+    # python -m utils.homeAggregates check  重建并检查汇总表与 SQL 聚合结果是否一致
+    import sys
+    if sys.argv[1:] == ['check']:
+        mismatched = checkSqlAggregates()
+        if mismatched:
+            print(f"❌ 以下字段不一致: {', '.join(mismatched)}")
+            sys.exit(1)
+        print("✅ 汇总表与 SQL 聚合结果一致")
+    else:
+        print(f"✅ 汇总表重建完成，共{rebuildAggregates()}条病例")
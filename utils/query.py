@@ -1,17 +1,33 @@
+import threading
+from contextlib import contextmanager
 from pymysql import *
 conn = connect(host='localhost', user='root', password='123456', database='medicalinfo', port=3306,
                            charset='utf8mb4')
 cursor = conn.cursor()
+# 连接和游标是模块级共享的，Flask 多线程和后台重建线程同时使用时需要串行化
+_lock = threading.Lock()
 
 
 
 def querys(sql,params,type='no_select'):
     params = tuple(params)
-    cursor.execute(sql,params)
-    if type != 'no_select':
-        data_list = cursor.fetchall()
-        conn.commit()
-        return data_list
-    else:
-        conn.commit()
-        return '执行成功'
\ No newline at end of file
+    with _lock:
+        cursor.execute(sql,params)
+        if type != 'no_select':
+            data_list = cursor.fetchall()
+            conn.commit()
+            return data_list
+        else:
+            conn.commit()
+            return '执行成功'
+
+
+@contextmanager
+def namedLock(name, timeout):
+    """MySQL 命名锁（GET_LOCK，跨进程互斥，连接断开时自动释放）；timeout 秒内拿不到锁时抛 TimeoutError"""
+    if querys('select get_lock(%s, %s)', [name, timeout], 'select')[0][0] != 1:
+        raise TimeoutError(f'等待锁 {name} 超时（{timeout}秒）')
+    try:
+        yield
+    finally:
+        querys('select release_lock(%s)', [name], 'select')
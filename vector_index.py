@@ -0,0 +1,445 @@
+"""
+================================================================================
+医疗疾病预测系统 - 向量检索索引（语义召回层）
+================================================================================
+功能模块：
+1. ExactIndex：精确检索（float32 暴力内积，适合数万条以内）
+2. IVFIndex：倒排文件索引（纯NumPy球面K-Means聚类，只扫描最近的 nprobe 个簇）
+3. HNSWIndex：分层可导航小世界图（基于 hnswlib，可选依赖）
+
+使用方式：
+    - 机器学习.py 的 build_index() 在保存 biencoder_index.npz 时，同目录写出
+      vector_index.json（+ 数据文件），disease_predictor.py 加载后先召回候选，
+      规则引擎只对候选（默认300个）打分
+    - 已有的 biencoder_index.npz 可直接补建：
+        python vector_index.py --index models/medical_biencoder/biencoder_index.npz --kind ivf
+
+存储格式：
+    vector_index.json       元信息（类型、参数、疾病数、向量维度）
+    vector_index.ivf.npz    IVF：簇中心 + 倒排表（向量本身复用 biencoder_index.npz）
+    vector_index.hnsw       HNSW：hnswlib 图文件
+
+作者：Your Name
+日期：2024-01-XX
+================================================================================
+"""
+
+# ==================== 第1部分：依赖导入 ====================
+import os  # 文件路径操作
+import json  # 元信息读写
+import time  # 计时
+import argparse  # 命令行参数解析
+import numpy as np  # 数值计算
+
+# ==================== 第2部分：配置 ====================
+
+KINDS = ('exact', 'ivf', 'hnsw')  # 支持的索引类型
+META_NAME = 'vector_index.json'  # 元信息文件名（与 biencoder_index.npz 同目录）
+
+# ===== IVF默认参数 =====
+IVF_TRAIN_ITERS = 20  # K-Means迭代次数
+IVF_TRAIN_SAMPLES = 100000  # 训练簇中心最多使用的样本数
+IVF_NPROBE = 16  # 查询时至少扫描的簇数
+IVF_MIN_SCAN = 8  # 扫描的向量数至少为召回数K的倍数（K较大时自动多扫描几个簇）
+
+# ===== HNSW默认参数 =====
+HNSW_M = 32  # 每个节点的最大连接数
+HNSW_EF_CONSTRUCTION = 200  # 建图时的候选队列长度
+HNSW_EF_SEARCH = 400  # 查询时的候选队列长度（需 ≥ 召回数）
+
+# ==================== 第3部分：工具函数 ====================
+
+def _as_matrix(q):
+    """将 (d,) 或 (B, d) 查询转为 float32 的 (B, d) 矩阵"""
+    q = np.asarray(q, dtype=np.float32)
+    return q[None, :] if q.ndim == 1 else q
+
+def select_topk(scores, k, min_score=None):
+    """
+    从一维得分向量中选出Top-K的下标（argpartition + 只对K个元素排序）
+
+    参数：
+        scores (np.ndarray): (N,) 得分
+        k (int): 返回数量
+        min_score (float): 最低得分阈值（None表示不过滤），先用掩码过滤再选Top-K
+
+    返回：
+        np.ndarray: 下标数组（最多K个），按得分降序；得分相同时下标小的在前
+
+    复杂度：
+        O(N + K·logK)，替代 np.argsort(-scores) 的 O(N·logN) 全排序
+
+    示例：
+        >>> select_topk(np.array([0.2, 0.9, 0.5, 0.7]), 2)
+        array([1, 3])
+        >>> select_topk(np.array([0.2, 0.9, 0.5, 0.7]), 5, min_score=0.6)
+        array([1, 3])
+    """
+    scores = np.asarray(scores)
+    cand = None
+    if min_score is not None:
+        cand = np.flatnonzero(scores >= min_score)
+        scores = scores[cand]
+
+    k = min(int(k), len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        part = np.sort(np.argpartition(-scores, k - 1)[:k])
+    else:
+        part = np.arange(len(scores))
+    part = part[np.argsort(-scores[part], kind='stable')]
+    return part if cand is None else cand[part]
+
+def _topk_rows(scores, k):
+    """
+    对 (B, M) 得分矩阵逐行取Top-K（argpartition + 小范围排序）
+
+    返回：
+        tuple: (ids, scores)，均为 (B, k) 且按得分降序
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+def _spherical_kmeans(x, n_clusters, iters=IVF_TRAIN_ITERS, seed=42):
+    """
+    球面K-Means（向量已L2归一化，用内积作为相似度）
+
+    参数：
+        x (np.ndarray): (M, d) 训练样本
+        n_clusters (int): 簇数
+        iters (int): 迭代次数
+        seed (int): 随机种子
+
+    返回：
+        np.ndarray: (n_clusters, d) 已归一化的簇中心
+    """
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+
+        # 按簇求和（空簇重新随机初始化，避免簇数退化）
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=n_clusters)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+    return centroids
+
+# ==================== 第4部分：索引实现 ====================
+
+class ExactIndex:
+    """
+    精确检索：对全部向量做一次矩阵-向量乘法，再用 argpartition 取Top-K
+
+    说明：
+        不单独存储数据，直接复用 biencoder_index.npz 中的 embeddings
+    """
+    kind = 'exact'
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.params = {}
+
+    def search(self, q, k):
+        """
+        检索与查询最相似的K个向量
+
+        参数：
+            q (np.ndarray): (d,) 或 (B, d) 已L2归一化的查询向量
+            k (int): 召回数量
+
+        返回：
+            tuple: (ids, scores)，均为 (B, k)，按内积降序
+        """
+        return _topk_rows(_as_matrix(q) @ self.embeddings.T, k)
+
+    def save(self, base):
+        pass
+
+    @classmethod
+    def load(cls, base, meta, embeddings):
+        return cls(embeddings)
+
+class IVFIndex:
+    """
+    倒排文件索引（IVF-Flat）：先找最近的 nprobe 个簇中心，只在这些簇内做精确内积
+
+    参数：
+        embeddings (np.ndarray): (N, d) 已L2归一化的向量
+        n_lists (int): 簇数（默认 4·√N）
+        nprobe (int): 查询时至少扫描的簇数（扫描量不足 IVF_MIN_SCAN·K 时继续扫描下一个最近的簇）
+
+    存储：
+        centroids (n_lists, d)、list_ids（按簇排序后的向量ID）、offsets（每个簇在 list_ids 中的起止位置）
+    """
+    kind = 'ivf'
+
+    def __init__(self, embeddings, centroids, list_ids, offsets, nprobe=IVF_NPROBE):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_ids = list_ids
+        self.offsets = offsets
+        self.nprobe = int(nprobe)
+        self.params = {'n_lists': int(len(centroids)), 'nprobe': self.nprobe}
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, nprobe=IVF_NPROBE, seed=42):
+        """
+        训练簇中心并构建倒排表
+        """
+        n = len(embeddings)
+        n_lists = int(n_lists or max(1, min(n, int(4 * np.sqrt(n)))))
+
+        rng = np.random.RandomState(seed)
+        train = embeddings
+        if n > IVF_TRAIN_SAMPLES:
+            train = embeddings[rng.choice(n, IVF_TRAIN_SAMPLES, replace=False)]
+        centroids = _spherical_kmeans(np.asarray(train, dtype=np.float32), n_lists, seed=seed)
+
+        # 分块分配，避免 N×n_lists 的大矩阵
+        assign = np.empty(n, dtype=np.int64)
+        for s in range(0, n, 65536):
+            assign[s:s + 65536] = np.argmax(embeddings[s:s + 65536] @ centroids.T, axis=1)
+
+        list_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+        return cls(embeddings, centroids, list_ids, offsets, nprobe)
+
+    def search(self, q, k):
+        """
+        检索与查询最相似的K个向量（返回格式同 ExactIndex.search）
+
+        说明：
+            候选不足K个时，剩余位置填充 ID=-1、得分=-inf
+        """
+        qm = _as_matrix(q)
+        sizes = np.diff(self.offsets)
+        probe_order = np.argsort(-(qm @ self.centroids.T), axis=1)
+
+        out_ids = np.full((len(qm), k), -1, dtype=np.int64)
+        out_scores = np.full((len(qm), k), -np.inf, dtype=np.float32)
+        for b in range(len(qm)):
+            # 按簇中心相似度依次扫描：至少 nprobe 个簇，且累计向量数 ≥ IVF_MIN_SCAN·K
+            scanned = np.cumsum(sizes[probe_order[b]])
+            n_probe = max(self.nprobe, int(np.searchsorted(scanned, IVF_MIN_SCAN * k)) + 1)
+            cand = np.concatenate([
+                self.list_ids[self.offsets[c]:self.offsets[c + 1]] for c in probe_order[b, :n_probe]
+            ])
+            if len(cand) == 0:
+                continue
+            ids, scores = _topk_rows((self.embeddings[cand] @ qm[b])[None, :], k)
+            out_ids[b, :ids.shape[1]] = cand[ids[0]]
+            out_scores[b, :ids.shape[1]] = scores[0]
+        return out_ids, out_scores
+
+    def save(self, base):
+        np.savez(base + '.ivf.npz', centroids=self.centroids, list_ids=self.list_ids, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, base, meta, embeddings):
+        data = np.load(base + '.ivf.npz')
+        return cls(embeddings, data['centroids'], data['list_ids'], data['offsets'],
+                   meta['params'].get('nprobe', IVF_NPROBE))
+
+class HNSWIndex:
+    """
+    HNSW图索引（需安装 hnswlib: pip install hnswlib）
+
+    参数：
+        M / ef_construction: 建图参数（越大召回越高、建图越慢）
+        ef: 查询时的候选队列长度（自动保证 ≥ 召回数K）
+    """
+    kind = 'hnsw'
+
+    def __init__(self, index, ef=HNSW_EF_SEARCH, params=None):
+        self.index = index
+        self.ef = int(ef)
+        self.params = dict(params or {}, ef=self.ef)
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError('HNSW索引需要安装 hnswlib: pip install hnswlib')
+        return hnswlib
+
+    @classmethod
+    def build(cls, embeddings, M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef=HNSW_EF_SEARCH, seed=42):
+        hnswlib = cls._hnswlib()
+        n, dim = embeddings.shape
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.init_index(max_elements=n, M=M, ef_construction=ef_construction, random_seed=seed)
+        index.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(n))
+        return cls(index, ef, {'M': M, 'ef_construction': ef_construction})
+
+    def search(self, q, k):
+        qm = _as_matrix(q)
+        k = min(k, self.index.get_current_count())
+        self.index.set_ef(max(self.ef, k))
+        labels, dists = self.index.knn_query(qm, k=k)
+        # hnswlib 的 ip 距离 = 1 - 内积
+        return labels.astype(np.int64), (1.0 - dists).astype(np.float32)
+
+    def save(self, base):
+        self.index.save_index(base + '.hnsw')
+
+    @classmethod
+    def load(cls, base, meta, embeddings):
+        hnswlib = cls._hnswlib()
+        index = hnswlib.Index(space='ip', dim=meta['dim'])
+        index.load_index(base + '.hnsw', max_elements=meta['n'])
+        params = dict(meta['params'])
+        return cls(index, params.pop('ef', HNSW_EF_SEARCH), params)
+
+_CLASSES = {'exact': ExactIndex, 'ivf': IVFIndex, 'hnsw': HNSWIndex}
+
+# ==================== 第5部分：构建/保存/加载 ====================
+
+def build_vector_index(embeddings, kind='exact', **params):
+    """
+    构建向量索引
+
+    参数：
+        embeddings (np.ndarray): (N, d) 已L2归一化的疾病向量
+        kind (str): 'exact' / 'ivf' / 'hnsw'
+        **params: 对应索引类的构建参数（如 n_lists、nprobe、M、ef）
+
+    返回：
+        ExactIndex / IVFIndex / HNSWIndex
+    """
+    if kind not in KINDS:
+        raise ValueError(f'未知的向量索引类型: {kind}（可选: {", ".join(KINDS)}）')
+    if kind == 'exact':
+        return ExactIndex(embeddings)
+    return _CLASSES[kind].build(embeddings, **params)
+
+def save_vector_index(index, meta_path, n, dim, store_build=None):
+    """
+    保存向量索引（元信息写入 meta_path，数据文件与其同名不同后缀）
+
+    参数：
+        store_build (str): 对应疾病索引目录的 build_id（见 index_store.write_index_store），
+            预测服务只在两者一致时加载新版本
+    """
+    base = os.path.splitext(meta_path)[0]
+    index.save(base)
+    meta = {'kind': index.kind, 'params': index.params, 'n': int(n), 'dim': int(dim)}
+    if store_build:
+        meta['store_build'] = store_build
+    tmp = meta_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, meta_path)
+
+def vector_index_build(meta_path):
+    """
+    向量索引对应的疾病索引 build_id（没有向量索引或旧版本元信息时返回None）
+    """
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('store_build')
+    except (OSError, ValueError):
+        return None
+
+def load_vector_index(meta_path, embeddings):
+    """
+    加载向量索引
+
+    参数：
+        meta_path (str): vector_index.json 路径
+        embeddings (np.ndarray): (N, d) 疾病向量（exact/ivf 直接复用，不重复存储）
+
+    返回：
+        索引对象；疾病数或维度与 embeddings 不一致时抛出 ValueError（说明索引已过期）
+    """
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta['n'] != len(embeddings) or meta['dim'] != embeddings.shape[1]:
+        raise ValueError(
+            f"向量索引与疾病索引不一致: {meta['n']}×{meta['dim']} vs {embeddings.shape[0]}×{embeddings.shape[1]}，"
+            f"请重新运行 --build_index"
+        )
+    return _CLASSES[meta['kind']].load(os.path.splitext(meta_path)[0], meta, embeddings)
+
+def recall_at_k(index, embeddings, k=300, n_queries=200, noise=0.05, seed=42):
+    """
+    评估近似索引相对精确检索的召回率
+
+    参数：
+        index: 待评估的索引
+        embeddings (np.ndarray): (N, d) 疾病向量
+        k (int): 召回数量
+        n_queries (int): 查询数量（随机疾病向量加噪声后归一化，模拟真实查询）
+
+    返回：
+        dict: {'recall': 平均召回率, 'latency_ms': 单查询平均耗时}
+    """
+    rng = np.random.RandomState(seed)
+    qs = embeddings[rng.choice(len(embeddings), n_queries, replace=len(embeddings) < n_queries)]
+    qs = qs + noise * rng.randn(*qs.shape).astype(np.float32)
+    qs = (qs / np.linalg.norm(qs, axis=1, keepdims=True)).astype(np.float32)
+
+    truth, _ = _topk_rows(qs @ embeddings.T, k)
+    t0 = time.perf_counter()
+    found = [index.search(q, k)[0][0] for q in qs]
+    latency = (time.perf_counter() - t0) * 1000.0 / n_queries
+
+    recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(truth, found)])
+    return {'recall': float(recall), 'latency_ms': round(latency, 3)}
+
+# ==================== 第6部分：命令行入口 ====================
+
+def main():
+    """
+    为已有的 biencoder_index.npz 构建向量索引（无需重新编码文档）
+
+    用法：
+        python vector_index.py --index models/medical_biencoder/biencoder_index.npz --kind ivf
+        python vector_index.py --index models/medical_biencoder/biencoder_index.npz --kind hnsw --eval
+    """
+    ap = argparse.ArgumentParser(description='构建疾病向量检索索引')
+    ap.add_argument('--index', type=str, required=True, help='biencoder_index.npz 或 biencoder_index/ 目录路径')
+    ap.add_argument('--kind', type=str, default='ivf', choices=list(KINDS), help='索引类型')
+    ap.add_argument('--n_lists', type=int, default=None, help='IVF簇数（默认 4·√N）')
+    ap.add_argument('--nprobe', type=int, default=IVF_NPROBE, help='IVF查询扫描簇数')
+    ap.add_argument('--eval', action='store_true', help='构建后评估 Recall@K')
+    ap.add_argument('--k', type=int, default=300, help='评估使用的召回数量')
+    args = ap.parse_args()
+
+    from index_store import open_index, store_build_id
+    from embedding_compress import load_embeddings
+    embs = load_embeddings(open_index(args.index))  # npz 或索引目录；降维/量化索引还原为 float32
+    params = {'ivf': {'n_lists': args.n_lists, 'nprobe': args.nprobe}}.get(args.kind, {})
+
+    t0 = time.time()
+    index = build_vector_index(embs, args.kind, **params)
+    print(f'✅ {args.kind} 索引构建完成: {len(embs)} 个向量，耗时 {time.time() - t0:.1f}s')
+
+    meta_path = os.path.join(os.path.dirname(os.path.abspath(args.index)), META_NAME)
+    save_vector_index(index, meta_path, *embs.shape, store_build=store_build_id(args.index))
+    print(f'✅ 已保存到: {meta_path}')
+
+    if args.eval:
+        r = recall_at_k(index, embs, k=args.k)
+        print(f"📊 Recall@{args.k} = {r['recall']:.4f}，单查询 {r['latency_ms']:.2f} ms")
+
+# ==================== 第7部分：程序入口 ====================
+if __name__ == '__main__':
+    main()
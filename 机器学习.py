@@ -25,10 +25,17 @@ import ast  # 安全解析Python字面量（如字符串形式的列表）
 import argparse  # 命令行参数解析
 import json  # JSON数据处理
 import random  # 随机数生成（用于数据集划分）
+import itertools  # 流式编码时拼接结束标记
+import time  # 训练吞吐量计时
+import hashlib  # 预分词缓存的键、行内容哈希
+import copy  # 复制模型配置（蒸馏学生模型）
+import multiprocessing  # 多进程分片编码文档
+import shutil  # 删除分片检查点目录
+from functools import partial  # 可被DataLoader worker序列化的collate函数
 import numpy as np  # 数值计算（向量操作）
 import pandas as pd  # 数据表格处理（读取CSV）
 import torch  # PyTorch深度学习框架
-from torch.utils.data import Dataset, DataLoader  # 数据集和数据加载器
+from torch.utils.data import Dataset, DataLoader, Sampler  # 数据集、数据加载器和batch采样器
 from torch.optim import AdamW  # AdamW优化器（带权重衰减的Adam）
 from transformers import (
     BertTokenizer,  # BERT分词器
@@ -37,6 +44,12 @@ from transformers import (
 )
 from tqdm import tqdm  # 进度条显示
 from math import log  # 数学对数函数（计算IDF）
+from index_store import write_index_store, open_index  # 内存映射索引目录（免解压、免pickle）
+from embedding_compress import (  # 向量降维与压缩存储
+    STORE_DTYPES, fit_pca, quantize, dequantize, explained_variance,
+    topk_agreement, load_embeddings, load_projection, project_queries
+)
+from vector_index import KINDS as VECTOR_INDEX_KINDS, META_NAME as VECTOR_INDEX_NAME, build_vector_index, save_vector_index, select_topk  # 向量召回索引、Top-K选择
 
 # ==================== 第2部分：路径和超参数配置 ====================
 
@@ -45,6 +58,8 @@ MODEL_PATH = r'C:\bert-base-chinese'  # BERT预训练模型路径（本地模型
 DATA_PATH = r'C:\Users\Gustav  Adolf\Music\基于python医疗疾病数据分析大屏可视化系统\medical.csv'  # 医疗数据CSV文件路径
 OUT_DIR = r'C:\medical_biencoder'  # 输出目录（保存训练后的模型和索引）
 INDEX_PATH = os.path.join(OUT_DIR, 'biencoder_index.npz')  # 疾病索引文件路径（NumPy压缩格式）
+INDEX_STORE_PATH = os.path.join(OUT_DIR, 'biencoder_index')  # 内存映射索引目录（预测服务优先加载）
+VECTOR_INDEX_PATH = os.path.join(OUT_DIR, VECTOR_INDEX_NAME)  # 向量召回索引（与疾病索引同目录）
 
 # ===== 训练超参数 =====
 MAX_LEN = 128  # BERT输入序列的最大长度（超过会截断）
@@ -55,6 +70,37 @@ WARMUP = 0.1  # 预热步数比例（总步数的10%用于线性预热）
 TEMP = 0.05  # 对比学习温度参数（控制相似度分布的平滑程度）
 SEED = 42  # 随机种子（确保实验可复现）
 
+# ===== 训练加速 =====
+NUM_WORKERS = 2  # DataLoader worker进程数（0表示在主进程中组batch）
+GRAD_ACCUM_STEPS = 1  # 梯度累积步数（>1时 batch内负样本数扩大为 BATCH_SIZE × 累积步数）
+BUCKET_CHUNK = 50  # 长度分桶：打乱后每 BUCKET_CHUNK 个batch的样本按文档长度排序再切分
+TOKEN_CACHE_DIR = os.path.join(OUT_DIR, 'token_cache')  # 预分词缓存目录（每个数据集只分词一次）
+
+# ===== 难负样本挖掘 =====
+HARD_NEG_K = 20  # 负样本池中每个query保留的易混淆疾病数
+HARD_NEG_PER_QUERY = 1  # 每个训练query每步从池中抽取的难负样本数
+HARD_NEG_REFRESH = 1000  # 每隔多少次参数更新用当前模型重新挖掘一次（0表示只在开始时挖掘）
+HARD_NEG_CHUNK = 256  # 挖掘时每块计算相似度的query数（每块占用 256×N 个float32）
+
+# ===== 查询编码器蒸馏 =====
+STUDENT_DIR = os.path.join(OUT_DIR, 'student')  # 学生查询编码器输出目录
+STUDENT_LAYERS = 4  # 学生模型层数（从教师的12层中均匀选取）
+DISTILL_EPOCHS = 3  # 蒸馏轮数
+DISTILL_BATCH = 64  # 蒸馏batch大小（查询很短，可以比训练batch大）
+DISTILL_LR = 1e-4  # 蒸馏学习率
+DISTILL_QUERIES_PER_ROW = 4  # 每个疾病额外随机组合的查询数
+
+# ===== 流式数据读取 =====
+CSV_CHUNK_SIZE = 2000  # 流式读取CSV时每块的行数（内存占用与CSV总大小无关）
+CSV_COLUMNS = ('name', 'symptom', 'desc', 'cause', 'category')  # 构建样本只需要这些列
+COMPRESS_CHUNK = 65536  # 降维/量化时每块处理的向量数
+
+# ===== 构建索引时的文档编码 =====
+ENCODE_BATCH_SIZE = 64  # 推理batch大小（不需要反向传播，可以比训练的 BATCH_SIZE 大）
+ENCODE_WORKERS = 1  # 编码进程数（>1 时文档分片到多个CPU进程并行编码）
+ENCODE_CHECKPOINT_ROWS = 4096  # 每个分片每编码多少行保存一次检查点
+ENCODE_CKPT_DIR = os.path.join(OUT_DIR, 'encode_shards')  # 分片检查点目录（构建成功后删除）
+
 # ===== 字段标记（结构化表示） =====
 # 用于区分文本中的不同字段（症状/描述/病因/科室）
 # 示例："[SYM] 头痛 发热 [SEP] [DESC] 常见感冒症状 [SEP] [CAT] 呼吸内科"
@@ -116,6 +162,34 @@ def parse_list_str(x):
     # 5. 作为单个字符串处理
     return [s.strip()] if s.strip() else []
 
+_LIST_LITERAL_RE = r"\[(?:'[^'\\]*'(?:, '[^'\\]*')*)?\]"  # 最常见的列表写法：['头痛', '发热']
+
+def parse_list_column(series):
+    """
+    按列解析字符串形式的列表（parse_list_str 的向量化版本，结果与逐个调用完全一致）
+    
+    参数：
+        series (pd.Series): 一列原始值（可含NaN）
+    
+    返回：
+        list[list[str]]: 与 series 顺序一致的解析结果
+    
+    做法：
+        1. 用向量化的正则判断是否为标准写法 ['a', 'b']（元素内不含引号和反斜杠）
+        2. 标准写法直接去掉首尾的 [' 和 '] 再按 ', ' 切分（pandas 字符串操作，不调用 ast）
+        3. 其余写法（双引号、转义、普通字符串等）退回 parse_list_str
+    """
+    values = series.reset_index(drop=True)
+    out = [[] for _ in range(len(values))]
+    text = values[values.notna()].astype(str)
+    fast = text.str.fullmatch(_LIST_LITERAL_RE)
+    
+    for i, items in text[fast].str.slice(2, -2).str.split("', '").items():
+        out[i] = [t.strip() for t in items if t.strip()]
+    for i, v in text[~fast].items():
+        out[i] = parse_list_str(v)
+    return out
+
 def format_query(symps):
     """
     格式化用户查询（添加字段标记）
@@ -181,6 +255,22 @@ def format_doc(symps, desc, cause, cat):
     # 5. 用空格连接所有字段
     return ' '.join(parts).strip()
 
+def content_hash(name, symps, desc, cause, cats):
+    """
+    疾病行的内容哈希（增量重建索引时判断该行是否需要重新编码）
+    
+    参数：
+        name (str): 疾病名称
+        symps (list[str]): 症状列表
+        desc / cause (str): 描述 / 病因
+        cats (list[str]): 科室分类（完整层级）
+    
+    返回：
+        str: 40位SHA1十六进制字符串
+    """
+    payload = json.dumps([name, symps, desc, cause, cats], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
 def build_rows(df):
     """
     从DataFrame构建训练样本（Query-Document对）
@@ -200,6 +290,7 @@ def build_rows(df):
             - name: 疾病名称
             - category: 科室
             - symptoms: 症状列表
+            - content_hash: 内容哈希（name/symptom/desc/cause/category）
     
     示例：
         >>> rows = build_rows(df)
@@ -209,47 +300,72 @@ def build_rows(df):
             'doc': '[SYM] 头痛 发热 [SEP] [DESC] ...',
             'name': '感冒',
             'category': '呼吸内科',
-            'symptoms': ['头痛', '发热', '咳嗽']
+            'symptoms': ['头痛', '发热', '咳嗽'],
+            'content_hash': '3f2a...'
         }
     """
-    rows = []
+    return list(_rows_from_frame(df))
+
+def _rows_from_frame(df):
+    """
+    从一块DataFrame逐条产出训练样本（build_rows 和 iter_rows 共用）
     
-    # 遍历每一行疾病数据
-    for _, r in df.iterrows():
-        # 1. 提取疾病名称
-        name = str(r.get('name', '')).strip()
-        
-        # 2. 提取描述和病因（可能为空）
-        desc = '' if pd.isna(r.get('desc')) else str(r.get('desc'))
-        cause = '' if pd.isna(r.get('cause')) else str(r.get('cause'))
-        
-        # 3. 解析症状列表
-        symps = parse_list_str(r.get('symptom'))
-        
-        # 4. 解析科室分类（取最后一级）
-        cats = parse_list_str(r.get('category'))
+    说明：
+        按列取值、按列解析列表字段，不再逐行 iterrows（每行构造一个 Series 的开销很大）
+    """
+    n = len(df)
+    
+    # 1. 提取疾病名称、描述和病因（描述和病因可能为空）
+    names = df['name'].map(str).str.strip().tolist() if 'name' in df.columns else [''] * n  # 与原逻辑一致：缺失值为 'nan'
+    descs = df['desc'].fillna('').astype(str).tolist() if 'desc' in df.columns else [''] * n
+    causes = df['cause'].fillna('').astype(str).tolist() if 'cause' in df.columns else [''] * n
+    
+    # 2. 解析症状列表和科室分类
+    symp_lists = parse_list_column(df['symptom']) if 'symptom' in df.columns else [[] for _ in range(n)]
+    cat_lists = parse_list_column(df['category']) if 'category' in df.columns else [[] for _ in range(n)]
+    
+    for name, desc, cause, symps, cats in zip(names, descs, causes, symp_lists, cat_lists):
+        # 3. 科室取最后一级
         cat = cats[-1] if len(cats) > 0 else ''
         
-        # 5. 格式化查询文本（仅症状）
+        # 4. 格式化查询文本（仅症状），没有症状的疾病跳过
         q = format_query(symps)
-        
-        # 6. 如果没有症状，跳过该疾病
         if not q:
             continue
         
-        # 7. 格式化文档文本（多字段）
-        doc = format_doc(symps, desc, cause, cat)
-        
-        # 8. 构建样本字典
-        rows.append({
+        # 5. 格式化文档文本（多字段）并产出样本
+        yield {
             'query': q,
-            'doc': doc,
+            'doc': format_doc(symps, desc, cause, cat),
             'name': name,
             'category': cat,
-            'symptoms': symps
-        })
+            'symptoms': symps,
+            'content_hash': content_hash(name, symps, desc, cause, cats)
+        }
+
+def iter_rows(path=None, chunksize=None):
+    """
+    流式读取医疗数据CSV并逐条产出样本（不把整个CSV读成DataFrame）
+    
+    参数：
+        path (str): CSV路径（默认DATA_PATH）
+        chunksize (int): 每块读取的行数（默认CSV_CHUNK_SIZE）
     
-    return rows
+    返回：
+        Iterator[dict]: 与 build_rows 相同格式的样本，顺序与CSV一致
+    
+    示例：
+        >>> n = sum(1 for _ in iter_rows())  # 统计可用条目，内存占用只有一块数据
+    """
+    reader = pd.read_csv(
+        path or DATA_PATH,
+        encoding='utf-8',
+        dtype=str,  # 各块的列类型一致（不随块内容推断），内容哈希稳定
+        usecols=lambda c: c in CSV_COLUMNS,  # 其余列不解析
+        chunksize=chunksize or CSV_CHUNK_SIZE
+    )
+    for chunk in reader:
+        yield from _rows_from_frame(chunk)
 
 # ==================== 第4部分：BERT模型相关 ====================
 
@@ -417,6 +533,146 @@ def collate_fn(batch, tokenizer):
         'd_attn_mask': d_enc['attention_mask']   # Document的注意力掩码
     }
 
+def pretokenize_rows(rows, tokenizer, cache_dir=None):
+    """
+    预分词（结果写入磁盘缓存，同一数据集和分词器只分词一次）
+    
+    参数：
+        rows (list[dict]): 样本列表（由build_rows生成）
+        tokenizer (BertTokenizer): 已添加字段标记的分词器
+        cache_dir (str): 缓存目录（默认TOKEN_CACHE_DIR）
+    
+    返回：
+        dict: {'q_ids', 'q_offsets', 'd_ids', 'd_offsets'}
+            第i个query的token ID = q_ids[q_offsets[i]:q_offsets[i+1]]（已截断到MAX_LEN，含[CLS]/[SEP]）
+    
+    缓存键：
+        所有query/doc文本 + MAX_LEN + 词表大小 的SHA1，数据或分词器变化时自动失效
+    """
+    cache_dir = cache_dir or TOKEN_CACHE_DIR
+    h = hashlib.sha1(f'{MAX_LEN}|{len(tokenizer)}'.encode('utf-8'))
+    for r in rows:
+        h.update(r['query'].encode('utf-8') + b'\x00' + r['doc'].encode('utf-8') + b'\x01')
+    cache_path = os.path.join(cache_dir, f'pretok_{h.hexdigest()[:16]}.npz')
+    
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as z:
+            print(f'✓ 使用预分词缓存: {cache_path}')
+            return {k: z[k] for k in z.files}
+    
+    def encode_all(texts, desc):
+        ids = []
+        for i in tqdm(range(0, len(texts), 1024), desc=desc):
+            ids.extend(tokenizer(texts[i:i+1024], max_length=MAX_LEN, truncation=True)['input_ids'])
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in ids])
+        flat = np.fromiter((t for x in ids for t in x), dtype=np.int32, count=int(offsets[-1]))
+        return flat, offsets
+    
+    q_ids, q_offsets = encode_all([r['query'] for r in rows], '预分词查询')
+    d_ids, d_offsets = encode_all([r['doc'] for r in rows], '预分词文档')
+    data = {'q_ids': q_ids, 'q_offsets': q_offsets, 'd_ids': d_ids, 'd_offsets': d_offsets}
+    
+    # 先写临时文件再改名，中断时不会留下不完整的缓存
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = cache_path + '.tmp.npz'
+    np.savez(tmp, **data)
+    os.replace(tmp, cache_path)
+    print(f'✓ 预分词缓存已写入: {cache_path}')
+    return data
+
+class PretokenizedPairDataset(Dataset):
+    """
+    预分词后的Query-Document对数据集（__getitem__ 只做切片，不再调用分词器）
+    """
+    def __init__(self, tokens):
+        """
+        参数：
+            tokens (dict): pretokenize_rows() 的返回值
+        """
+        self.q_ids, self.q_offsets = tokens['q_ids'], tokens['q_offsets']
+        self.d_ids, self.d_offsets = tokens['d_ids'], tokens['d_offsets']
+        self.doc_lengths = np.diff(self.d_offsets)  # 文档token长度（用于长度分桶）
+    
+    def __len__(self):
+        return len(self.doc_lengths)
+    
+    def __getitem__(self, idx):
+        return (self.q_ids[self.q_offsets[idx]:self.q_offsets[idx + 1]],
+                self.d_ids[self.d_offsets[idx]:self.d_offsets[idx + 1]],
+                idx)
+    
+    def doc_ids(self, idx):
+        """第idx个文档的token ID（难负样本组batch用）"""
+        return self.d_ids[self.d_offsets[idx]:self.d_offsets[idx + 1]]
+
+def _pad_ids(seqs, pad_id):
+    """把变长token ID序列padding到batch内最大长度，返回 (input_ids, attention_mask)"""
+    width = max(len(x) for x in seqs)
+    ids = np.full((len(seqs), width), pad_id, dtype=np.int64)
+    mask = np.zeros((len(seqs), width), dtype=np.int64)
+    for i, x in enumerate(seqs):
+        ids[i, :len(x)] = x
+        mask[i, :len(x)] = 1
+    return torch.from_numpy(ids), torch.from_numpy(mask)
+
+def pad_collate(batch, pad_id=0):
+    """
+    预分词样本的collate函数（输出与collate_fn相同的键；模块级函数，可在worker进程中使用）
+    
+    参数：
+        batch (list[tuple]): [(query_ids, doc_ids, 样本下标), ...]
+        pad_id (int): padding的token ID
+    """
+    q_ids, q_ms = _pad_ids([b[0] for b in batch], pad_id)
+    d_ids, d_ms = _pad_ids([b[1] for b in batch], pad_id)
+    return {'q_input_ids': q_ids, 'q_attn_mask': q_ms, 'd_input_ids': d_ids, 'd_attn_mask': d_ms,
+            'rows': torch.tensor([b[2] for b in batch], dtype=torch.long)}
+
+class LengthBucketSampler(Sampler):
+    """
+    长度分桶的batch采样器
+    
+    做法：
+        1. 每轮打乱全部样本
+        2. 每 chunk_batches 个batch的样本为一块，块内按文档token长度排序后切成batch
+        3. 再打乱batch顺序
+    
+    说明：
+        - 同一batch内文档长度相近，padding大幅减少（文档最长128，短的只有几十个token）
+        - 分块排序只在局部改变顺序，batch的组成仍是随机的（对比学习需要随机的batch内负样本）
+        - bucket=False 时等价于普通的 shuffle=True
+    """
+    def __init__(self, lengths, batch_size, chunk_batches=BUCKET_CHUNK, shuffle=True, seed=SEED, bucket=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.chunk = batch_size * max(1, chunk_batches)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket = bucket
+        self.epoch = 0
+    
+    def set_epoch(self, epoch):
+        """每轮调用一次，使不同轮次的打乱结果不同"""
+        self.epoch = epoch
+    
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        n = len(self.lengths)
+        idx = rng.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for s in range(0, n, self.chunk):
+            part = idx[s:s+self.chunk]
+            if self.bucket:
+                part = part[np.argsort(self.lengths[part], kind='stable')]
+            batches.extend(part[i:i+self.batch_size].tolist() for i in range(0, len(part), self.batch_size))
+        order = rng.permutation(len(batches)) if self.shuffle else range(len(batches))
+        for i in order:
+            yield batches[i]
+    
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
 def add_field_tags_to_tokenizer_and_model(tokenizer, model_bert):
     """
     添加字段标记到tokenizer和BERT模型
@@ -444,7 +700,7 @@ def add_field_tags_to_tokenizer_and_model(tokenizer, model_bert):
     return num_added
 
 @torch.no_grad()  # 禁用梯度计算（推理模式）
-def embed_texts_with_bert(bert_model, tokenizer, texts, device, desc='Encode'):
+def embed_texts_with_bert(bert_model, tokenizer, texts, device, desc='Encode', batch_size=None):
     """
     批量编码文本为向量（推理模式）
     
@@ -454,6 +710,7 @@ def embed_texts_with_bert(bert_model, tokenizer, texts, device, desc='Encode'):
         texts (list[str]): 文本列表
         device (torch.device): 设备（CPU或GPU）
         desc (str): 进度条描述
+        batch_size (int): 每批文本数（默认BATCH_SIZE）
     
     返回：
         np.ndarray: 向量矩阵，形状 (len(texts), hidden_dim)
@@ -467,36 +724,234 @@ def embed_texts_with_bert(bert_model, tokenizer, texts, device, desc='Encode'):
     bert_model.eval()  # 设置为评估模式（禁用dropout）
     
     # 分批处理（每批BATCH_SIZE个样本）
-    for i in tqdm(range(0, len(texts), BATCH_SIZE), desc=desc):
-        batch = texts[i:i+BATCH_SIZE]  # 获取当前批次
-        
-        # 编码当前批次
-        enc = tokenizer(
-            batch,
-            max_length=MAX_LEN,
-            truncation=True,
-            padding=True,
-            return_tensors='pt'
-        )
-        
-        # 移动到指定设备
-        enc = {k: v.to(device) for k, v in enc.items()}
-        
-        # BERT前向传播
-        out = bert_model(**enc, return_dict=True)
-        
-        # 平均池化
-        pooled = mean_pooling(out.last_hidden_state, enc['attention_mask'])
-        
-        # L2归一化
-        pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
-        
-        # 转为NumPy并存储
-        vecs.append(pooled.cpu().numpy())
+    batch_size = batch_size or BATCH_SIZE
+    for i in tqdm(range(0, len(texts), batch_size), desc=desc):
+        batch = texts[i:i+batch_size]  # 获取当前批次
+        vecs.append(_encode_batch(bert_model, tokenizer, batch, device))
     
     # 拼接所有批次的向量 (N, hidden_dim)
     return np.vstack(vecs)
 
+def _encode_batch(bert_model, tokenizer, batch, device):
+    """
+    编码一批文本（分词 → BERT → 平均池化 → L2归一化），返回 (len(batch), hidden_dim) float32
+    """
+    # 编码当前批次
+    enc = tokenizer(
+        batch,
+        max_length=MAX_LEN,
+        truncation=True,
+        padding=True,
+        return_tensors='pt'
+    )
+    
+    # 移动到指定设备
+    enc = {k: v.to(device) for k, v in enc.items()}
+    
+    # BERT前向传播
+    out = bert_model(**enc, return_dict=True)
+    
+    # 平均池化
+    pooled = mean_pooling(out.last_hidden_state, enc['attention_mask'])
+    
+    # L2归一化
+    pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+    
+    # 转为NumPy
+    return pooled.cpu().numpy()
+
+@torch.no_grad()
+def embed_texts_to_memmap(bert_model, tokenizer, texts, n, out_path, device, desc='Encode', batch_size=ENCODE_BATCH_SIZE):
+    """
+    流式编码文本，向量直接写入预分配的 memmap 文件（内存占用与文本总数无关）
+    
+    参数：
+        bert_model (BertModel): BERT模型
+        tokenizer (BertTokenizer): 分词器
+        texts (Iterable[str]): 文本序列（可以是生成器，如 iter_rows() 产出的文档），恰好 n 条
+        n (int): 文本总数（用于预分配）
+        out_path (str): memmap 文件路径
+        device (torch.device): 设备
+        desc (str): 进度条描述
+        batch_size (int): 推理batch大小
+    
+    返回：
+        np.memmap: (n, hidden_dim) float32，batch_size 相同时与 embed_texts_with_bert 的结果逐批相同
+    """
+    bert_model.eval()
+    out = np.memmap(out_path, dtype=np.float32, mode='w+', shape=(n, bert_model.config.hidden_size))
+    
+    pos = 0
+    batch = []
+    with tqdm(total=n, desc=desc) as pbar:
+        for text in itertools.chain(texts, [None]):
+            if text is not None:
+                batch.append(text)
+            if batch and (len(batch) == batch_size or text is None):
+                if pos + len(batch) > n:
+                    raise RuntimeError(f'文本数超过预分配的 {n} 条（数据文件在构建过程中被修改？）')
+                out[pos:pos + len(batch)] = _encode_batch(bert_model, tokenizer, batch, device)
+                pos += len(batch)
+                pbar.update(len(batch))
+                batch = []
+    
+    if pos != n:
+        raise RuntimeError(f'文本数 {pos} 与预分配的 {n} 条不一致（数据文件在构建过程中被修改？）')
+    out.flush()
+    return out
+
+def _load_doc_encoder(enc_path, device):
+    """
+    载入训练后的编码器和分词器（添加字段标记、设置为评估模式）
+    """
+    tok = BertTokenizer.from_pretrained(enc_path, local_files_only=True)
+    enc = BertModel.from_pretrained(enc_path, local_files_only=True)
+    
+    # 添加字段标记
+    tok.add_special_tokens({'additional_special_tokens': FIELD_TAGS})
+    enc.resize_token_embeddings(len(tok))
+    enc.to(device).eval()
+    return tok, enc
+
+def _shard_bounds(n, shards):
+    """把 n 行均分为 shards 个连续区间 [(start, end), ...]"""
+    cuts = np.linspace(0, n, shards + 1).round().astype(int)
+    return [(int(cuts[i]), int(cuts[i + 1])) for i in range(shards)]
+
+def _write_json_atomic(path, obj):
+    """先写临时文件再改名（中断时不会留下写了一半的检查点）"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _read_shard_done(ckpt_path, start, end):
+    """读取分片检查点中已完成的行数（检查点不存在或区间不一致时为0）"""
+    if not os.path.exists(ckpt_path):
+        return 0
+    with open(ckpt_path, 'r', encoding='utf-8') as f:
+        ckpt = json.load(f)
+    if (ckpt.get('start'), ckpt.get('end')) != (start, end):
+        return 0
+    return int(ckpt.get('done', 0))
+
+@torch.no_grad()
+def _encode_shard(task):
+    """
+    编码进程：编码第 shard 个分片的文档，写入共享 memmap 的对应行
+    
+    参数：
+        task (dict): shard / start / end / data_path / enc_path / out_path / shape /
+                     batch_size / threads / ckpt_path
+    
+    返回：
+        tuple: (shard, 本次编码的行数)
+    
+    说明：
+        - 模块级函数，spawn 方式启动的子进程也能调用（所有路径通过参数传入，不依赖主进程修改过的全局变量）
+        - 每个进程只用 threads 个torch线程，K 个进程合计不超过CPU核数（避免线程超额订阅）
+        - 文档文本由子进程自己流式读取CSV并跳到分片起点，主进程不需要把文档传给子进程
+        - 每编码 ENCODE_CHECKPOINT_ROWS 行先 flush memmap 再更新检查点；中断后重新运行从检查点继续
+    """
+    torch.set_num_threads(task['threads'])
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # 已经执行过并行运算时不能再修改
+    
+    start, end = task['start'], task['end']
+    done = _read_shard_done(task['ckpt_path'], start, end)
+    pos = start + done
+    if pos >= end:
+        return task['shard'], 0
+    
+    tok, enc = _load_doc_encoder(task['enc_path'], torch.device('cpu'))
+    out = np.memmap(task['out_path'], dtype=np.float32, mode='r+', shape=task['shape'])
+    docs = (r['doc'] for r in itertools.islice(iter_rows(task['data_path']), pos, end))
+    
+    first, saved = pos, pos
+    batch = []
+    with tqdm(total=end - start, initial=done, desc=f'编码分片 {task["shard"]}', position=task['shard']) as pbar:
+        for text in itertools.chain(docs, [None]):
+            if text is not None:
+                batch.append(text)
+            if batch and (len(batch) == task['batch_size'] or text is None):
+                out[pos:pos + len(batch)] = _encode_batch(enc, tok, batch, torch.device('cpu'))
+                pos += len(batch)
+                pbar.update(len(batch))
+                batch = []
+                if pos - saved >= ENCODE_CHECKPOINT_ROWS:
+                    out.flush()
+                    _write_json_atomic(task['ckpt_path'], {'start': start, 'end': end, 'done': pos - start})
+                    saved = pos
+    
+    if pos != end:
+        raise RuntimeError(f'分片 {task["shard"]} 只读到 {pos - start} 行，应为 {end - start} 行（数据文件在构建过程中被修改？）')
+    out.flush()
+    _write_json_atomic(task['ckpt_path'], {'start': start, 'end': end, 'done': end - start})
+    return task['shard'], pos - first
+
+def embed_docs_sharded(enc_path, n, dim, out_path, key, workers, batch_size=ENCODE_BATCH_SIZE,
+                       threads=None, ckpt_dir=None):
+    """
+    多进程分片编码文档，向量写入共享 memmap（可断点续传）
+    
+    参数：
+        enc_path (str): 编码器目录
+        n (int): 文档总数（iter_rows() 产出的行数）
+        dim (int): 向量维度
+        out_path (str): memmap 文件路径（各进程写入自己分片对应的行）
+        key (str): 构建内容的标识（编码器指纹 + 每行内容哈希）；与检查点记录一致时才续传
+        workers (int): 编码进程数 K（文档均分为 K 个连续分片，每个进程一个）
+        batch_size (int): 推理batch大小
+        threads (int): 每个进程的torch线程数（None 表示 CPU核数 // K）
+        ckpt_dir (str): 检查点目录（默认 ENCODE_CKPT_DIR）
+    
+    返回：
+        np.memmap: (n, dim) float32
+    
+    断点续传：
+        检查点目录记录 key / n / dim / workers，每个分片记录已完成的行数。
+        重新运行时若记录一致，保留已写入的 memmap，各分片从检查点继续；否则清空重来
+    """
+    ckpt_dir = ckpt_dir or ENCODE_CKPT_DIR
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    meta = {'key': key, 'n': n, 'dim': dim, 'workers': workers}
+    meta_path = os.path.join(ckpt_dir, 'meta.json')
+    
+    resume = False
+    if os.path.exists(meta_path) and os.path.exists(out_path) and os.path.getsize(out_path) == n * dim * 4:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            resume = json.load(f) == meta
+    if not resume:
+        if os.path.isdir(ckpt_dir):
+            for fname in os.listdir(ckpt_dir):
+                os.remove(os.path.join(ckpt_dir, fname))
+        os.makedirs(ckpt_dir, exist_ok=True)
+        np.memmap(out_path, dtype=np.float32, mode='w+', shape=(n, dim)).flush()  # 预分配
+        _write_json_atomic(meta_path, meta)
+    
+    tasks = [{
+        'shard': k, 'start': s, 'end': e, 'data_path': DATA_PATH, 'enc_path': enc_path,
+        'out_path': out_path, 'shape': (n, dim), 'batch_size': batch_size, 'threads': threads,
+        'ckpt_path': os.path.join(ckpt_dir, f'shard_{k}.json'),
+    } for k, (s, e) in enumerate(_shard_bounds(n, workers))]
+    
+    pending = sum(t['end'] - t['start'] - _read_shard_done(t['ckpt_path'], t['start'], t['end']) for t in tasks)
+    print(f'🧵 多进程编码: {workers} 个进程 × {threads} 线程，batch={batch_size}'
+          f'{f"，从检查点继续（剩余 {pending} 条）" if resume else ""}')
+    
+    # spawn：子进程不继承主进程已初始化的torch线程池（fork 后使用 OpenMP 可能死锁），Windows 也只支持 spawn
+    ctx = multiprocessing.get_context('spawn')
+    t0 = time.perf_counter()
+    with ctx.Pool(workers) as pool:
+        encoded = sum(cnt for _, cnt in pool.imap_unordered(_encode_shard, tasks))
+        pool.close()
+        pool.join()  # 等子进程正常退出（直接 terminate 会留下子进程中的信号量）
+    elapsed = time.perf_counter() - t0
+    print(f'⏱️ 编码 {encoded} 条，用时 {elapsed:.1f}s，{encoded / max(elapsed, 1e-9):.1f} 条/秒')
+    return np.memmap(out_path, dtype=np.float32, mode='r', shape=(n, dim))
+
 # ==================== 第5部分：训练和评估 ====================
 
 def grouped_split_by_name(rows, val_ratio=0.1, seed=SEED):
@@ -552,33 +1007,327 @@ def grouped_split_by_name(rows, val_ratio=0.1, seed=SEED):
     # 7. 返回样本列表
     return [rows[i] for i in train_idx], [rows[i] for i in val_idx]
 
-def train(epochs=EPOCHS):
+def _info_nce_loss(q_vec, d_vec, ce, n_vec=None, n_mask=None):
+    """
+    对称InfoNCE损失（batch内其他document/query作为负样本）
+    
+    参数：
+        q_vec (Tensor): query向量 (batch, hidden_dim)
+        d_vec (Tensor): document向量 (batch, hidden_dim)，第i行是第i个query的正样本
+        ce: 交叉熵损失函数
+        n_vec (Tensor): 难负样本document向量 (n_neg, hidden_dim)，None表示只用batch内负样本
+        n_mask (Tensor): (batch, n_neg) bool，True表示该难负样本与该query属于同一疾病，不参与对比
+    
+    说明：
+        难负样本只加在 query→document 方向（作为所有query共享的额外候选），
+        document→query 方向仍只在batch内对比
+    """
+    # 1. 计算相似度矩阵（query-document），对角线元素是正样本对的相似度
+    logits_qd = (q_vec @ d_vec.t()) / TEMP  # (batch, batch)
+    
+    # 2. 构造标签（第i个query对应第i个document）
+    labels = torch.arange(logits_qd.size(0), device=logits_qd.device)
+    
+    # 3. query→document 和 document→query 的对比损失取平均
+    logits_q = logits_qd
+    if n_vec is not None:
+        logits_qn = (q_vec @ n_vec.t()) / TEMP  # (batch, n_neg)
+        if n_mask is not None:
+            logits_qn = logits_qn.masked_fill(n_mask, float('-inf'))
+        logits_q = torch.cat([logits_qd, logits_qn], dim=1)
+    loss1 = ce(logits_q, labels)
+    loss2 = ce(logits_qd.t(), labels)
+    return 0.5 * (loss1 + loss2)
+
+def _negative_mask(q_groups, n_groups, device):
+    """难负样本掩码：query与难负样本属于同一重复组时为True"""
+    return (q_groups[:, None] == n_groups[None, :]).to(device)
+
+def _rng_state(device):
+    """记录随机数状态（重放dropout用）"""
+    return torch.get_rng_state(), (torch.cuda.get_rng_state(device) if device.type == 'cuda' else None)
+
+def _set_rng_state(state, device):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state(state[1], device)
+
+def _encode_pair(model, batch, device, amp):
+    """编码一个batch的query和document（amp为autocast上下文工厂，输出转回float32）"""
+    with amp():
+        q_vec = model.encode(batch['q_input_ids'].to(device, non_blocking=True),
+                             batch['q_attn_mask'].to(device, non_blocking=True))
+        d_vec = model.encode(batch['d_input_ids'].to(device, non_blocking=True),
+                             batch['d_attn_mask'].to(device, non_blocking=True))
+    return q_vec.float(), d_vec.float()
+
+def _encode_negatives(model, batch, device, amp):
+    """编码batch附带的难负样本document（没有难负样本时返回None）"""
+    if 'n_input_ids' not in batch:
+        return None
+    with amp():
+        n_vec = model.encode(batch['n_input_ids'].to(device, non_blocking=True),
+                             batch['n_attn_mask'].to(device, non_blocking=True))
+    return n_vec.float()
+
+def _accumulated_contrastive_step(model, micro_batches, device, ce, amp):
+    """
+    梯度累积的对比学习步（多个微批共同组成一个大batch，负样本数 = 全部微批的样本数）
+    
+    参数：
+        model (BiEncoder): 双塔编码器
+        micro_batches (list[dict]): pad_collate 输出的微批
+        device (torch.device): 设备
+        ce: 交叉熵损失函数
+        amp: autocast上下文工厂
+    
+    返回：
+        tuple: (loss, 样本数)
+    
+    做法（梯度缓存）：
+        1. 无梯度地编码所有微批，拼成完整的 query/document 向量矩阵
+        2. 在完整矩阵上计算InfoNCE损失并反传，得到每个向量的梯度（只需保存向量，不保存激活）
+        3. 逐个微批重新前向（恢复第1遍的随机数状态，dropout掩码一致），
+           用 Σ(向量 × 向量梯度) 反传到模型参数
+    
+    说明：
+        普通的梯度累积只能把各微批的损失相加，每个query仍只和自己微批内的document对比；
+        这里的结果与一次性前向整个大batch的梯度相同，显存/内存占用只与微批大小有关。
+        微批附带的难负样本（见 HardNegativePool.attach）同样拼接后由所有query共享
+    """
+    # 第1遍：无梯度编码
+    states, q_parts, d_parts, n_parts = [], [], [], []
+    with torch.no_grad():
+        for mb in micro_batches:
+            states.append(_rng_state(device))
+            q_vec, d_vec = _encode_pair(model, mb, device, amp)
+            q_parts.append(q_vec)
+            d_parts.append(d_vec)
+            n_vec = _encode_negatives(model, mb, device, amp)
+            if n_vec is not None:
+                n_parts.append(n_vec)
+    
+    # 在完整的大batch上计算损失，得到向量梯度
+    q_all = torch.cat(q_parts).requires_grad_()
+    d_all = torch.cat(d_parts).requires_grad_()
+    n_all = n_mask = None
+    if n_parts:
+        n_all = torch.cat(n_parts).requires_grad_()
+        n_mask = _negative_mask(torch.cat([mb['q_groups'] for mb in micro_batches]),
+                                torch.cat([mb['n_groups'] for mb in micro_batches if 'n_groups' in mb]), device)
+    loss = _info_nce_loss(q_all, d_all, ce, n_all, n_mask)
+    loss.backward()
+    
+    # 第2遍：逐个微批重新前向，把向量梯度传回模型参数（梯度在参数上累加）
+    start = n_start = 0
+    for mb, state in zip(micro_batches, states):
+        _set_rng_state(state, device)
+        q_vec, d_vec = _encode_pair(model, mb, device, amp)
+        end = start + q_vec.size(0)
+        surrogate = (q_vec * q_all.grad[start:end]).sum() + (d_vec * d_all.grad[start:end]).sum()
+        n_vec = _encode_negatives(model, mb, device, amp)
+        if n_vec is not None:
+            n_end = n_start + n_vec.size(0)
+            surrogate = surrogate + (n_vec * n_all.grad[n_start:n_end]).sum()
+            n_start = n_end
+        surrogate.backward()
+        start = end
+    
+    return loss.detach(), start
+
+def duplicate_groups(rows):
+    """
+    重复组ID：疾病名称相同、或症状列表相同（query文本相同）的样本归为同一组
+    
+    参数：
+        rows (list[dict]): 样本列表
+    
+    返回：
+        np.ndarray: (N,) int64 组ID
+    
+    说明：
+        同组的文档对该query来说不是真正的负样本（同一疾病的多条记录，或症状完全相同无法区分），
+        挖掘和计算损失时都要排除
+    """
+    parent = list(range(len(rows)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    first = {}
+    for i, r in enumerate(rows):
+        for key in (('name', r['name']), ('query', r['query'])):
+            j = first.setdefault(key, i)
+            if j != i:
+                parent[find(i)] = find(j)
+    return np.array([find(i) for i in range(len(rows))], dtype=np.int64)
+
+def mine_hard_negatives(q_vecs, d_vecs, groups, k=HARD_NEG_K):
+    """
+    挖掘难负样本：每个query在全部文档中检索Top-K最相似、但不属于同一重复组的文档
+    
+    参数：
+        q_vecs (np.ndarray): (N, dim) query向量，第i行对应第i个样本
+        d_vecs (np.ndarray): (N, dim) 文档向量
+        groups (np.ndarray): duplicate_groups() 的返回值
+        k (int): 每个query保留的难负样本数
+    
+    返回：
+        np.ndarray: (N, k) int64 文档下标（Top-K集合，不排序）；候选不足时用 -1 填充
+    """
+    n = len(d_vecs)
+    k = max(0, min(k, n - 1))
+    pool = np.full((len(q_vecs), k), -1, dtype=np.int64)
+    if k == 0:
+        return pool
+    d_t = np.ascontiguousarray(np.asarray(d_vecs, dtype=np.float32).T)
+    for s in range(0, len(q_vecs), HARD_NEG_CHUNK):
+        sims = np.asarray(q_vecs[s:s + HARD_NEG_CHUNK], dtype=np.float32) @ d_t  # (chunk, N)
+        sims[groups[s:s + HARD_NEG_CHUNK, None] == groups[None, :]] = -np.inf  # 排除同组文档
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        valid = np.isfinite(np.take_along_axis(sims, top, axis=1))
+        pool[s:s + HARD_NEG_CHUNK] = np.where(valid, top, -1)
+    return pool
+
+def _index_doc_vectors(rows):
+    """
+    从已构建的索引中按内容哈希取出样本对应的文档向量
+    
+    返回：
+        np.ndarray 或 None: (N, k) float32；索引不存在、没有内容哈希或未覆盖全部样本时返回 None
+    """
+    path = INDEX_STORE_PATH if os.path.isdir(INDEX_STORE_PATH) else INDEX_PATH
+    if not os.path.exists(path):
+        return None
+    data = open_index(path)
+    if 'content_hashes' not in data:
+        return None
+    pos = {str(h): i for i, h in enumerate(data['content_hashes'])}
+    idx = [pos.get(r['content_hash']) for r in rows]
+    if any(i is None for i in idx):
+        print('⚠️ 已有索引与训练数据不一致，难负样本改用当前模型挖掘')
+        return None
+    return load_embeddings(data)[np.asarray(idx)]
+
+class HardNegativePool:
+    """
+    难负样本池（缓存每个训练query的Top-K易混淆疾病）
+    
+    做法：
+        1. 开始时优先用已构建的索引初始化（以正样本文档向量作为探针检索相近疾病，不需要编码）；
+           没有可用索引时用当前模型编码全部训练query和文档后挖掘
+        2. 训练中每隔 refresh_steps 次参数更新用当前模型重新挖掘一次，其余步骤只从池中抽样
+        3. 每个batch的每个query从自己的Top-K中随机抽 per_query 个文档，
+           去重后作为整个batch共享的额外负样本
+    
+    说明：
+        感冒 / 流行性感冒 / 上呼吸道感染 这类症状几乎相同的疾病，随机组成的batch里很少同时出现，
+        只靠batch内负样本学不到它们的区别；难负样本让模型在训练中直接对比这些易混淆的疾病
+    """
+    def __init__(self, rows, dataset, pad_id, k=HARD_NEG_K, per_query=HARD_NEG_PER_QUERY,
+                 refresh_steps=HARD_NEG_REFRESH, seed=SEED):
+        """
+        参数：
+            rows (list[dict]): 训练样本（与 dataset 下标一致）
+            dataset (PretokenizedPairDataset): 预分词数据集（取难负样本文档的token ID）
+            pad_id (int): padding的token ID
+            k (int): 每个query保留的难负样本数
+            per_query (int): 每个query每步抽取的难负样本数
+            refresh_steps (int): 重新挖掘的间隔（参数更新次数），0表示不刷新
+        """
+        self.rows = rows
+        self.dataset = dataset
+        self.pad_id = pad_id
+        self.k = k
+        self.per_query = per_query
+        self.refresh_steps = refresh_steps
+        self.groups = duplicate_groups(rows)
+        self.rng = np.random.RandomState(seed)
+        self.pool = None  # (N, k) 难负样本下标
+        self.last_refresh = 0  # 上次挖掘时的参数更新次数
+    
+    def seed_from_index(self):
+        """用已构建的索引初始化负样本池，成功返回True"""
+        vecs = _index_doc_vectors(self.rows)
+        if vecs is None:
+            return False
+        self.pool = mine_hard_negatives(vecs, vecs, self.groups, self.k)
+        print(f'✓ 难负样本池已由已有索引初始化（{len(self.rows)} 个query × {self.pool.shape[1]}）')
+        return True
+    
+    def refresh(self, model, tokenizer, device, step=0):
+        """用当前模型编码全部训练query和文档，重新挖掘"""
+        was_training = model.training
+        q_vecs = embed_texts_with_bert(model.bert, tokenizer, [r['query'] for r in self.rows], device, desc='挖掘难负样本(查询)')
+        d_vecs = embed_texts_with_bert(model.bert, tokenizer, [r['doc'] for r in self.rows], device, desc='挖掘难负样本(文档)')
+        model.train(was_training)  # embed_texts_with_bert 会切换到评估模式
+        self.pool = mine_hard_negatives(q_vecs, d_vecs, self.groups, self.k)
+        self.last_refresh = step
+        print(f'🔄 难负样本池已刷新（第{step}步，{len(self.rows)} 个query × {self.pool.shape[1]}）')
+    
+    def maybe_refresh(self, model, tokenizer, device, step):
+        """负样本池为空或距上次挖掘已满 refresh_steps 步时刷新"""
+        if self.pool is None or (self.refresh_steps > 0 and step - self.last_refresh >= self.refresh_steps):
+            self.refresh(model, tokenizer, device, step)
+    
+    def attach(self, batch):
+        """
+        为batch抽取难负样本（原地添加 n_input_ids / n_attn_mask / n_groups / q_groups 并返回）
+        """
+        rows = batch['rows'].numpy()
+        batch['q_groups'] = torch.from_numpy(self.groups[rows])
+        picked = []
+        for cand in self.pool[rows]:
+            cand = cand[cand >= 0]
+            if len(cand):
+                picked.extend(self.rng.choice(cand, min(self.per_query, len(cand)), replace=False).tolist())
+        picked = list(dict.fromkeys(picked))  # 多个query抽到同一文档时只保留一份
+        if not picked:
+            return batch
+        batch['n_input_ids'], batch['n_attn_mask'] = _pad_ids([self.dataset.doc_ids(i) for i in picked], self.pad_id)
+        batch['n_groups'] = torch.from_numpy(self.groups[picked])
+        return batch
+
+def train(epochs=EPOCHS, accum_steps=GRAD_ACCUM_STEPS, bf16=False, num_workers=NUM_WORKERS, bucket=True,
+          hard_negatives=False, neg_per_query=HARD_NEG_PER_QUERY, neg_refresh=HARD_NEG_REFRESH):
     """
     训练双塔编码器（对比学习）
     
     参数：
         epochs (int): 训练轮数
+        accum_steps (int): 梯度累积步数（每次参数更新的对比batch = BATCH_SIZE × accum_steps）
+        bf16 (bool): 是否使用 bfloat16 自动混合精度（CPU和支持bf16的GPU均可）
+        num_workers (int): DataLoader worker进程数
+        bucket (bool): 是否按文档长度分桶组batch
+        hard_negatives (bool): 是否加入难负样本（见 HardNegativePool）
+        neg_per_query (int): 每个query每步抽取的难负样本数
+        neg_refresh (int): 每隔多少次参数更新重新挖掘难负样本（0表示只在开始时挖掘）
     
     训练流程：
         1. 加载数据并构建Query-Document对
         2. 划分训练集和验证集（按疾病名称分组）
         3. 初始化BERT模型和分词器
-        4. 对比学习训练（InfoNCE损失）
-        5. 评估验证集Recall@10
-        6. 保存最佳模型
+        4. 预分词（磁盘缓存）+ 长度分桶的数据加载器
+        5. 对比学习训练（InfoNCE损失；可选难负样本池）
+        6. 评估验证集Recall@10
+        7. 保存最佳模型
     
     对比学习损失：
         L = -log( exp(q·d+/τ) / Σexp(q·di/τ) )
         其中：
         - q: query向量
         - d+: 正样本document向量
-        - di: batch内所有document向量（包括负样本）
+        - di: batch内所有document向量（包括负样本），启用难负样本时还包括从池中抽取的易混淆疾病
         - τ: 温度参数（TEMP=0.05）
     """
+    accum_steps = max(1, int(accum_steps))
+    
     # ===== 第1步：加载数据 =====
     print('📂 读取数据...')
-    df = pd.read_csv(DATA_PATH, encoding='utf-8')
-    rows = build_rows(df)  # 构建训练样本
+    rows = list(iter_rows())  # 流式读取并构建训练样本（不保留DataFrame）
     print(f'✓ 可训练条目: {len(rows)}')
 
     if len(rows) < 2:
@@ -595,27 +1344,27 @@ def train(epochs=EPOCHS):
     # 添加字段标记到分词器和模型
     add_field_tags_to_tokenizer_and_model(tokenizer, model.bert)
 
-    # ===== 第4步：设置设备 =====
+    # ===== 第4步：设置设备和混合精度 =====
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model.to(device)
-    print(f'✓ 设备: {device}')
+    if bf16 and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print('⚠️ 当前GPU不支持bfloat16，使用float32训练')
+        bf16 = False
+    amp = partial(torch.autocast, device_type=device.type, dtype=torch.bfloat16, enabled=bf16)
+    print(f'✓ 设备: {device}（{"bf16混合精度" if bf16 else "float32"}，'
+          f'对比batch={BATCH_SIZE}×{accum_steps}）')
 
-    # ===== 第5步：创建数据加载器 =====
-    train_ds = PairDataset(train_rows)
-    val_ds = PairDataset(val_rows)
+    # ===== 第5步：预分词并创建数据加载器 =====
+    train_ds = PretokenizedPairDataset(pretokenize_rows(train_rows, tokenizer))
+    sampler = LengthBucketSampler(train_ds.doc_lengths, BATCH_SIZE, bucket=bucket)
     
     train_loader = DataLoader(
         train_ds,
-        batch_size=BATCH_SIZE,
-        shuffle=True,  # 训练集打乱
-        collate_fn=lambda b: collate_fn(b, tokenizer)
-    )
-    
-    val_loader = DataLoader(
-        val_ds,
-        batch_size=BATCH_SIZE,
-        shuffle=False,  # 验证集不打乱
-        collate_fn=lambda b: collate_fn(b, tokenizer)
+        batch_sampler=sampler,  # 长度分桶 + 打乱
+        collate_fn=partial(pad_collate, pad_id=tokenizer.pad_token_id),
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        pin_memory=device.type == 'cuda'
     )
 
     # ===== 第6步：初始化优化器和学习率调度器 =====
@@ -625,7 +1374,8 @@ def train(epochs=EPOCHS):
         weight_decay=0.01  # 权重衰减（L2正则化）
     )
     
-    total_steps = max(1, len(train_loader) * epochs)  # 总训练步数
+    steps_per_epoch = (len(train_loader) + accum_steps - 1) // accum_steps  # 每轮参数更新次数
+    total_steps = max(1, steps_per_epoch * epochs)  # 总训练步数
     warmup_steps = int(total_steps * WARMUP)  # 预热步数（10%）
     
     scheduler = get_linear_schedule_with_warmup(
@@ -635,58 +1385,68 @@ def train(epochs=EPOCHS):
     )
     
     ce = torch.nn.CrossEntropyLoss()  # 交叉熵损失（用于对比学习）
+    
+    # 难负样本池（先尝试用已有索引初始化，否则在第一步前用当前模型挖掘）
+    neg_pool = None
+    if hard_negatives:
+        neg_pool = HardNegativePool(train_rows, train_ds, tokenizer.pad_token_id,
+                                    per_query=neg_per_query, refresh_steps=neg_refresh)
+        neg_pool.seed_from_index()
 
     # ===== 第7步：训练循环 =====
     best_r10 = 0.0  # 记录最佳Recall@10
+    global_step = 0  # 参数更新次数
     
     for epoch in range(epochs):
         # ===== 训练阶段 =====
         model.train()  # 设置为训练模式（启用dropout）
+        sampler.set_epoch(epoch)
         pbar = tqdm(train_loader, desc=f'🔧 训练 {epoch+1}/{epochs}')
         loss_running = 0.0  # 累计损失
         seen = 0  # 已处理样本数
+        pending = []  # 待累积的微批
+        t0 = time.perf_counter()
         
-        for batch in pbar:
-            # 1. 获取batch数据并移动到设备
-            q_ids = batch['q_input_ids'].to(device)
-            q_ms = batch['q_attn_mask'].to(device)
-            d_ids = batch['d_input_ids'].to(device)
-            d_ms = batch['d_attn_mask'].to(device)
-
-            # 2. 编码query和document
-            q_vec = model.encode(q_ids, q_ms)  # (batch, hidden_dim)
-            d_vec = model.encode(d_ids, d_ms)  # (batch, hidden_dim)
-
-            # 3. 计算相似度矩阵（query-document）
-            logits_qd = (q_vec @ d_vec.t()) / TEMP  # (batch, batch)
-            # 对角线元素是正样本对的相似度
-            # 非对角线元素是负样本对的相似度
+        for i, batch in enumerate(pbar):
+            pending.append(batch)
+            if len(pending) < accum_steps and i + 1 < len(train_loader):
+                continue
             
-            # 4. 构造标签（对角线为正样本）
-            labels = torch.arange(logits_qd.size(0), device=device)
-            # labels = [0, 1, 2, ...] 表示第i个query对应第i个document
+            # 1. 抽取难负样本（到期时先用当前模型刷新负样本池）
+            if neg_pool is not None:
+                neg_pool.maybe_refresh(model, tokenizer, device, global_step)
+                pending = [neg_pool.attach(b) for b in pending]
             
-            # 5. 计算query→document的对比损失
-            loss1 = ce(logits_qd, labels)
-
-            # 6. 计算document→query的对比损失（对称损失）
-            logits_dq = (d_vec @ q_vec.t()) / TEMP  # (batch, batch)
-            loss2 = ce(logits_dq, labels)
-
-            # 7. 最终损失（双向对比损失的平均）
-            loss = 0.5 * (loss1 + loss2)
-
-            # 8. 反向传播和优化
+            # 2. 前向 + 反向传播
             optimizer.zero_grad()  # 清空梯度
-            loss.backward()  # 反向传播
+            if len(pending) == 1:
+                batch = pending[0]
+                q_vec, d_vec = _encode_pair(model, batch, device, amp)
+                n_vec = _encode_negatives(model, batch, device, amp)
+                n_mask = _negative_mask(batch['q_groups'], batch['n_groups'], device) if n_vec is not None else None
+                loss = _info_nce_loss(q_vec, d_vec, ce, n_vec, n_mask)
+                loss.backward()
+                n = q_vec.size(0)
+            else:
+                loss, n = _accumulated_contrastive_step(model, pending, device, ce, amp)
+            pending = []
+            
+            # 3. 更新参数
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # 梯度裁剪（防止梯度爆炸）
             optimizer.step()  # 更新参数
             scheduler.step()  # 更新学习率
-
-            # 9. 记录损失
-            loss_running += loss.item() * q_ids.size(0)
-            seen += q_ids.size(0)
-            pbar.set_postfix({'loss': f'{loss_running / max(1, seen):.4f}'})
+            global_step += 1
+
+            # 4. 记录损失和吞吐量
+            loss_running += loss.item() * n
+            seen += n
+            pbar.set_postfix({
+                'loss': f'{loss_running / max(1, seen):.4f}',
+                'samples/s': f'{seen / max(1e-9, time.perf_counter() - t0):.1f}'
+            })
+        
+        elapsed = time.perf_counter() - t0
+        print(f'⏱️ 第{epoch+1}轮: {seen} 条样本，用时 {elapsed:.1f}s，{seen / max(1e-9, elapsed):.1f} samples/s')
 
         # ===== 验证阶段 =====
         r10 = eval_recall(model, tokenizer, val_rows, device, topk=10)
@@ -753,13 +1513,328 @@ def eval_recall(model, tokenizer, rows, device, topk=10, max_eval=512):
     # 7. 返回召回率
     return hits / idxs.shape[0]
 
+# ==================== 第5部分（续）：查询编码器蒸馏 ====================
+
+def make_distill_queries(rows, per_row=DISTILL_QUERIES_PER_ROW, seed=SEED):
+    """
+    构造蒸馏用的查询文本（与线上查询格式一致：症状去重排序后加 [SYM] 标记）
+    
+    参数：
+        rows (list[dict]): 样本列表
+        per_row (int): 每个疾病额外随机组合的查询数（每个取1~4个症状）
+        seed (int): 随机种子
+    
+    返回：
+        tuple: (查询文本列表, 对应的样本下标列表)
+    
+    说明：
+        用户输入通常只有几个症状，只用完整症状列表蒸馏的学生模型在短查询上偏差较大
+    """
+    rng = random.Random(seed)
+    texts, owners = [], []
+    seen = set()
+    for i, r in enumerate(rows):
+        symps = sorted(set(t for t in r['symptoms'] if t))
+        candidates = [symps] + [rng.sample(symps, min(len(symps), rng.randint(1, 4))) for _ in range(per_row)]
+        for c in candidates:
+            q = format_query(sorted(c))
+            if q and q not in seen:
+                seen.add(q)
+                texts.append(q)
+                owners.append(i)
+    return texts, owners
+
+def init_student(teacher, n_layers=STUDENT_LAYERS):
+    """
+    由教师模型初始化学生模型（保留词嵌入和均匀间隔的若干层Transformer）
+    
+    参数：
+        teacher (BertModel): 微调后的编码器
+        n_layers (int): 学生模型层数
+    
+    返回：
+        tuple: (学生模型 BertModel, 保留的教师层号列表)
+    
+    说明：
+        隐藏层维度与教师相同，输出向量直接与索引中的文档向量处于同一空间；
+        从教师权重初始化比随机初始化收敛快得多
+    """
+    total = teacher.config.num_hidden_layers
+    n_layers = max(1, min(n_layers, total))
+    keep = [int(round(x)) for x in np.linspace(0, total - 1, n_layers)]
+    
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = n_layers
+    student = BertModel(config)
+    student.embeddings.load_state_dict(teacher.embeddings.state_dict())
+    for i, j in enumerate(keep):
+        student.encoder.layer[i].load_state_dict(teacher.encoder.layer[j].state_dict())
+    if student.pooler is not None and teacher.pooler is not None:
+        student.pooler.load_state_dict(teacher.pooler.state_dict())
+    return student, keep
+
+def _encode_queries(bert_model, tokenizer, texts, device):
+    """带梯度地编码一批查询（平均池化 + L2归一化）"""
+    enc = tokenizer(texts, max_length=MAX_LEN, truncation=True, padding=True, return_tensors='pt')
+    enc = {k: v.to(device) for k, v in enc.items()}
+    out = bert_model(**enc, return_dict=True)
+    pooled = mean_pooling(out.last_hidden_state, enc['attention_mask'])
+    return torch.nn.functional.normalize(pooled.float(), p=2, dim=1)
+
+def _single_query_latency(bert_model, tokenizer, texts, device, n=200):
+    """逐条编码（batch_size=1，与线上单请求一致）的延迟统计（毫秒）"""
+    bert_model.eval()
+    samples = []
+    with torch.no_grad():
+        for q in texts[:n]:
+            t0 = time.perf_counter()
+            _encode_batch(bert_model, tokenizer, [q], device)
+            samples.append((time.perf_counter() - t0) * 1000.0)
+    a = np.asarray(samples)
+    return {'p50_ms': round(float(np.percentile(a, 50)), 3), 'p95_ms': round(float(np.percentile(a, 95)), 3),
+            'mean_ms': round(float(a.mean()), 3)}
+
+def _retrieval_docs(teacher, tokenizer, rows, device):
+    """
+    评估检索效果用的文档向量
+    
+    返回：
+        tuple: (文档向量 (M, k), 投影矩阵或None, 每个样本的正样本下标)
+        有覆盖这些样本的已构建索引时直接使用（含降维投影，与线上一致），否则用教师模型编码这些样本的文档
+    """
+    path = INDEX_STORE_PATH if os.path.isdir(INDEX_STORE_PATH) else INDEX_PATH
+    if os.path.exists(path):
+        data = open_index(path)
+        if 'content_hashes' in data:
+            pos = {str(h): i for i, h in enumerate(data['content_hashes'])}
+            idx = [pos.get(r['content_hash']) for r in rows]
+            if all(i is not None for i in idx):
+                return load_embeddings(data), load_projection(data), np.asarray(idx)
+    docs = embed_texts_with_bert(teacher, tokenizer, [r['doc'] for r in rows], device, desc='编码评估文档')
+    return docs, None, np.arange(len(rows))
+
+def compare_query_encoders(teacher, student, tokenizer, rows, device, topk=10, max_queries=2000):
+    """
+    教师/学生查询编码器并排对比：检索效果、与教师的一致性、单查询延迟
+    
+    参数：
+        teacher / student (BertModel): 两个编码器
+        rows (list[dict]): 评估样本（一般为验证集）
+        topk (int): Recall@K 和 Top-K一致率的K
+        max_queries (int): 最多评估的查询数
+    
+    返回：
+        dict: {'teacher': {...}, 'student': {...}}
+            - recall@1 / recall@K: 查询所属疾病出现在Top-K中的比例
+            - cos_mean / cos_min: 与教师查询向量的余弦相似度（学生）
+            - topk_agreement / top1_agreement: 与教师检索结果的一致率（学生）
+            - p50_ms / p95_ms / mean_ms: 单查询编码延迟
+    """
+    texts, owners = make_distill_queries(rows, seed=SEED + 1)
+    texts, owners = texts[:max_queries], np.asarray(owners[:max_queries])
+    docs, projection, positives = _retrieval_docs(teacher, tokenizer, rows, device)
+    k = min(topk, len(docs))
+    
+    vecs = {
+        'teacher': embed_texts_with_bert(teacher, tokenizer, texts, device, desc='教师编码'),
+        'student': embed_texts_with_bert(student, tokenizer, texts, device, desc='学生编码'),
+    }
+    report = {}
+    for name, q in vecs.items():
+        top = np.argsort(-(project_queries(q, projection) @ docs.T), axis=1)[:, :k]
+        hit = top == positives[owners][:, None]
+        report[name] = {'recall@1': float(hit[:, 0].mean()), f'recall@{k}': float(hit.any(axis=1).mean())}
+    
+    cos = np.sum(vecs['teacher'] * vecs['student'], axis=1)
+    report['student'].update({'cos_mean': float(cos.mean()), 'cos_min': float(cos.min())})
+    report['student'].update(topk_agreement(
+        project_queries(vecs['teacher'], projection), docs,
+        project_queries(vecs['student'], projection), docs, k=k
+    ))
+    for name, model in (('teacher', teacher), ('student', student)):
+        report[name].update(_single_query_latency(model, tokenizer, texts, device))
+        report[name]['layers'] = model.config.num_hidden_layers
+    
+    print(f'\n📊 查询编码器对比（{len(texts)} 个查询，{len(docs)} 个文档）')
+    print(f"   {'':8s} {'层数':>4s} {'R@1':>7s} {f'R@{k}':>7s} {'p50(ms)':>9s} {'p95(ms)':>9s}")
+    for name in ('teacher', 'student'):
+        m = report[name]
+        print(f"   {name:8s} {m['layers']:>4d} {m['recall@1']:>7.4f} {m[f'recall@{k}']:>7.4f} "
+              f"{m['p50_ms']:>9.2f} {m['p95_ms']:>9.2f}")
+    m = report['student']
+    print(f"   学生与教师：余弦 均值={m['cos_mean']:.4f} 最小={m['cos_min']:.4f}  "
+          f"Top-{k}一致率={m['topk_agreement']:.4f}  Top-1一致率={m['top1_agreement']:.4f}  "
+          f"加速 {report['teacher']['p50_ms'] / max(m['p50_ms'], 1e-9):.1f}x")
+    return report
+
+def distill(n_layers=STUDENT_LAYERS, epochs=DISTILL_EPOCHS, per_row=DISTILL_QUERIES_PER_ROW, bf16=False):
+    """
+    蒸馏小型查询编码器（学生模型拟合微调后编码器的查询向量）
+    
+    参数：
+        n_layers (int): 学生模型层数（默认4）
+        epochs (int): 训练轮数
+        per_row (int): 每个疾病额外随机组合的查询数
+        bf16 (bool): 是否使用 bfloat16 自动混合精度
+    
+    流程：
+        1. 载入教师模型（--train 的输出），按疾病名称划分训练/验证集
+        2. 构造查询文本，用教师模型编码为目标向量（只编码一次）
+        3. 由教师初始化学生模型，最小化 1 - cos(学生向量, 教师向量)
+        4. 每轮在验证集上计算平均余弦，保存最好的学生模型到 STUDENT_DIR
+        5. 输出教师/学生的检索效果和延迟对比，写入 STUDENT_DIR/distill_meta.json
+    
+    说明：
+        只替换查询编码器：文档向量仍来自教师模型（索引不用重建）。
+        distill_meta.json 记录教师模型指纹，预测服务据此检查学生模型与当前索引是否匹配
+    """
+    print('📦 载入教师编码器...')
+    enc_path = os.path.join(OUT_DIR, 'biencoder')
+    if not os.path.isdir(enc_path):
+        raise FileNotFoundError(f'未找到训练模型: {enc_path}。请先运行 --train')
+    
+    tokenizer = BertTokenizer.from_pretrained(enc_path, local_files_only=True)
+    teacher = BertModel.from_pretrained(enc_path, local_files_only=True)
+    tokenizer.add_special_tokens({'additional_special_tokens': FIELD_TAGS})
+    teacher.resize_token_embeddings(len(tokenizer))
+    
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    teacher.to(device).eval()
+    amp = partial(torch.autocast, device_type=device.type, dtype=torch.bfloat16, enabled=bf16)
+    
+    # ===== 查询文本和教师目标向量 =====
+    rows = list(iter_rows())
+    train_rows, val_rows = grouped_split_by_name(rows, val_ratio=0.1, seed=SEED)
+    train_texts, _ = make_distill_queries(train_rows, per_row)
+    val_texts, _ = make_distill_queries(val_rows, per_row, seed=SEED + 1)
+    print(f'✓ 蒸馏查询: 训练 {len(train_texts)} 条，验证 {len(val_texts)} 条')
+    train_targets = torch.from_numpy(embed_texts_with_bert(teacher, tokenizer, train_texts, device, desc='教师编码(训练)'))
+    val_targets = embed_texts_with_bert(teacher, tokenizer, val_texts, device, desc='教师编码(验证)')
+    
+    # ===== 初始化学生模型 =====
+    student, keep = init_student(teacher, n_layers)
+    student.to(device)
+    print(f'✓ 学生模型: {len(keep)} 层（取教师第 {keep} 层，教师共 {teacher.config.num_hidden_layers} 层）')
+    
+    optimizer = AdamW(student.parameters(), lr=DISTILL_LR, weight_decay=0.01)
+    total_steps = max(1, (len(train_texts) + DISTILL_BATCH - 1) // DISTILL_BATCH * epochs)
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(total_steps * WARMUP), total_steps)
+    
+    # ===== 训练 =====
+    best_cos = -1.0
+    rng = np.random.RandomState(SEED)
+    for epoch in range(epochs):
+        student.train()
+        order = rng.permutation(len(train_texts))
+        pbar = tqdm(range(0, len(order), DISTILL_BATCH), desc=f'🔧 蒸馏 {epoch+1}/{epochs}')
+        loss_running, seen = 0.0, 0
+        for s in pbar:
+            idx = order[s:s + DISTILL_BATCH]
+            with amp():
+                vecs = _encode_queries(student, tokenizer, [train_texts[i] for i in idx], device)
+            loss = (1.0 - (vecs * train_targets[idx].to(device)).sum(dim=1)).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            loss_running += loss.item() * len(idx)
+            seen += len(idx)
+            pbar.set_postfix({'loss': f'{loss_running / max(1, seen):.5f}'})
+        
+        val_vecs = embed_texts_with_bert(student, tokenizer, val_texts, device, desc='评估学生')
+        val_cos = float(np.mean(np.sum(val_vecs * val_targets, axis=1)))
+        print(f'📊 验证集 与教师的平均余弦: {val_cos:.5f}')
+        if val_cos > best_cos:
+            best_cos = val_cos
+            student.save_pretrained(STUDENT_DIR)
+            tokenizer.save_pretrained(STUDENT_DIR)
+            print(f'✅ 保存学生模型到: {STUDENT_DIR} (cos={best_cos:.5f})')
+    
+    # ===== 教师/学生对比报告 =====
+    best = BertModel.from_pretrained(STUDENT_DIR, local_files_only=True).to(device).eval()
+    report = compare_query_encoders(teacher, best, tokenizer, val_rows, device)
+    meta = {
+        'teacher_fingerprint': _encoder_fingerprint(enc_path),
+        'teacher_layers': teacher.config.num_hidden_layers,
+        'layers_kept': keep,
+        'val_cos': best_cos,
+        'report': report,
+    }
+    with open(os.path.join(STUDENT_DIR, 'distill_meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    print(f'🎉 蒸馏完成！验证集平均余弦={best_cos:.5f}')
+    return report
+
 # ==================== 第6部分：构建索引 ====================
 
 @torch.no_grad()
-def build_index():
+def _encoder_fingerprint(enc_path):
+    """
+    编码器指纹（模型目录下所有文件内容 + MAX_LEN 的SHA1）
+    
+    说明：
+        模型重新训练后，旧索引中的向量不能再复用，增量重建会自动退化为全量重建
+    """
+    h = hashlib.sha1(f'max_len={MAX_LEN}'.encode('utf-8'))
+    for fname in sorted(os.listdir(enc_path)):
+        fpath = os.path.join(enc_path, fname)
+        if not os.path.isfile(fpath):
+            continue
+        h.update(fname.encode('utf-8'))
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _load_previous_index(fingerprint):
+    """
+    读取上一次构建的索引（增量重建用）
+    
+    参数：
+        fingerprint (str): 当前编码器指纹
+    
+    返回：
+        dict 或 None: {'hashes', 'embeddings', 'embedding_scale', 'projection'}（均已复制到内存，
+        之后替换索引文件不受影响）；索引不存在、没有内容哈希或编码器已变化时返回 None
+    """
+    path = INDEX_STORE_PATH if os.path.isdir(INDEX_STORE_PATH) else INDEX_PATH
+    if not os.path.exists(path):
+        print('⚠️ 未找到已有索引，执行全量重建')
+        return None
+    
+    data = open_index(path)
+    if 'content_hashes' not in data or 'encoder_fingerprint' not in data:
+        print('⚠️ 已有索引没有记录内容哈希，执行全量重建')
+        return None
+    if str(data['encoder_fingerprint'][0]) != fingerprint:
+        print('⚠️ 编码器已变化（重新训练过），执行全量重建')
+        return None
+    
+    return {
+        'hashes': [str(h) for h in data['content_hashes']],
+        'embeddings': np.array(data['embeddings']),
+        'embedding_scale': np.array(data['embedding_scale']) if 'embedding_scale' in data else None,
+        'projection': np.array(data['projection'], dtype=np.float32) if 'projection' in data else None,
+    }
+
+def build_index(vector_index='exact', store_dtype=None, reduce_dim=None, incremental=False, write_npz=False,
+                workers=ENCODE_WORKERS, encode_batch_size=ENCODE_BATCH_SIZE, threads=None):
     """
     构建疾病索引（包含语义向量和IDF权重）
     
+    参数：
+        vector_index (str): 向量召回索引类型（exact / ivf / hnsw，见 vector_index.py）
+        store_dtype (str): 向量存储精度（float32 / float16 / int8，int8 为每个向量单独缩放）；
+            None 表示全量重建用 float32、增量重建沿用已有索引的精度
+        reduce_dim (int): PCA降维后的维度（如256）；None 表示全量重建不降维、增量重建沿用已有投影
+        incremental (bool): 增量重建（只编码新增/变更的行，删除已不存在的行）
+        write_npz (bool): 是否同时写出旧的 .npz 索引（默认不写：savez_compressed 需要把全部文档读入内存，
+            峰值内存随数据量增长；预测服务优先加载内存映射目录，只有旧工具需要 .npz 时再打开）
+        workers (int): 全量编码的进程数（>1 时按行均分为多个分片并行编码，见 embed_docs_sharded；仅CPU）
+        encode_batch_size (int): 推理batch大小
+        threads (int): 每个编码进程的torch线程数（None 表示 CPU核数 // workers）
+    
     索引内容：
         - embeddings: 所有疾病的BERT向量 (N, hidden_dim)
         - names: 疾病名称列表 (N,)
@@ -771,10 +1846,18 @@ def build_index():
     
     工作流程：
         1. 加载训练后的BERT模型
-        2. 读取医疗数据
-        3. 编码所有疾病文档
-        4. 计算症状IDF权重
-        5. 保存为压缩的NumPy文件
+        2. 流式读取医疗数据（第1遍只保留名称/科室/症状/哈希，统计IDF）
+        3. 流式编码所有疾病文档，向量直接写入预分配的 memmap（增量模式只编码内容哈希变化的行；
+           workers > 1 时多进程分片编码，中断后重新运行从各分片的检查点继续）
+        4. 计算症状IDF权重（始终基于合并后的全部疾病重新计算）
+        5. （可选）PCA降维 + float16/int8 压缩，报告与全精度索引的Top-10一致率
+        6. 保存为压缩的NumPy文件 + 内存映射目录（见 index_store.py），均先写临时文件再改名
+        7. 构建并保存向量召回索引（预测时先召回候选，规则引擎只对候选打分）
+    
+    增量重建：
+        - 索引中记录每行的内容哈希（name/symptom/desc/cause/category）和编码器指纹
+        - 哈希未变的行直接复用已存储的向量（已降维/量化的行原样复制），新增/变更的行用已有投影和精度编码
+        - 编码器指纹不同、或指定的 store_dtype / reduce_dim 与已有索引不一致时，退化为全量重建
     """
     # ===== 第1步：加载训练后的模型 =====
     print('📦 载入训练后的编码器...')
@@ -783,25 +1866,33 @@ def build_index():
     if not os.path.isdir(enc_path):
         raise FileNotFoundError(f'未找到训练模型: {enc_path}。请先运行 --train')
     
-    tok = BertTokenizer.from_pretrained(enc_path, local_files_only=True)
-    enc = BertModel.from_pretrained(enc_path, local_files_only=True)
-
-    # 添加字段标记
-    tok.add_special_tokens({'additional_special_tokens': FIELD_TAGS})
-    enc.resize_token_embeddings(len(tok))
-
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    enc.to(device).eval()
-
-    # ===== 第2步：读取数据 =====
-    print('📂 读取数据并构建文档...')
-    df = pd.read_csv(DATA_PATH, encoding='utf-8')
-    rows = build_rows(df)
+    tok, enc = _load_doc_encoder(enc_path, device)
+
+    # ===== 第2步：流式读取数据 =====
+    # 第1遍只保留每行的短字段；文档文本在编码和写出时再流式读取，不整体驻留内存
+    print('📂 流式读取数据...')
+    names = []  # 疾病名称列表
+    cats = []  # 科室列表
+    symps = []  # 症状列表（JSON字符串）
+    hashes = []  # 内容哈希列表
+    df_counts = {}  # 统计每个症状的文档频率
     
-    names = [r['name'] for r in rows]  # 疾病名称列表
-    cats = [r['category'] for r in rows]  # 科室列表
-    symps = [r['symptoms'] for r in rows]  # 症状列表
-    docs = [r['doc'] for r in rows]  # 文档列表
+    for r in iter_rows():
+        names.append(r['name'])
+        cats.append(r['category'])
+        symps.append(json.dumps(r['symptoms'], ensure_ascii=False))
+        hashes.append(r['content_hash'])
+        for s in set([t for t in r['symptoms'] if t]):
+            df_counts[s] = df_counts.get(s, 0) + 1
+    
+    if not names:
+        raise RuntimeError('没有可用于构建索引的有症状条目')
+    
+    def iter_docs():
+        return (r['doc'] for r in iter_rows())  # 文档文本（每次调用重新流式读取CSV）
+    
+    fingerprint = _encoder_fingerprint(enc_path)  # 编码器指纹
 
     # ===== 第3步：计算症状IDF权重 =====
     # IDF（逆文档频率）= log((N+1) / (DF+1)) + 1
@@ -813,13 +1904,7 @@ def build_index():
     # - 常见症状（如"发热"）IDF较低，权重小
     # - 罕见症状（如"牙龈出血"）IDF较高，权重大
     
-    N = len(rows)  # 总疾病数
-    df_counts = {}  # 统计每个症状的文档频率
-    
-    # 统计文档频率
-    for r in rows:
-        for s in set([t for t in r['symptoms'] if t]):
-            df_counts[s] = df_counts.get(s, 0) + 1
+    N = len(names)  # 总疾病数（文档频率已在第2步统计）
     
     # 计算IDF
     idf_terms = []  # 症状词表
@@ -834,23 +1919,186 @@ def build_index():
     idf_terms = np.array(idf_terms, dtype=object)
     idf_vals = np.array(idf_vals, dtype=np.float32)
 
-    # ===== 第4步：编码所有文档 =====
-    print(f'🤖 编码 {len(docs)} 个文档向量...')
-    vecs = embed_texts_with_bert(enc, tok, docs, device, desc='编码文档')
-
-    # ===== 第5步：保存索引 =====
-    np.savez_compressed(
-        INDEX_PATH,
-        embeddings=vecs,  # (N, hidden_dim)
-        names=np.array(names, dtype=object),
-        categories=np.array(cats, dtype=object),
-        symptoms=np.array([json.dumps(s, ensure_ascii=False) for s in symps], dtype=object),
-        docs=np.array(docs, dtype=object),
-        idf_terms=idf_terms,  # 症状词表
-        idf_vals=idf_vals  # IDF值
+    # ===== 第4步：编码文档 =====
+    prev = _load_previous_index(fingerprint) if incremental else None
+    if prev is not None:
+        prev_dtype = str(prev['embeddings'].dtype)
+        prev_dim = prev['projection'].shape[1] if prev['projection'] is not None else None
+        if store_dtype not in (None, prev_dtype) or reduce_dim not in (None, prev_dim):
+            print(f'⚠️ 指定的存储精度/降维维度与已有索引（{prev_dtype}，{prev_dim or "未降维"}）不一致，执行全量重建')
+            prev = None
+    
+    scratch = []  # 构建过程中的临时 memmap 文件
+    if prev is not None:
+        stored, scale, extras = _merge_previous_vectors(prev, hashes, iter_docs(), enc, tok, device, encode_batch_size)
+        store_dtype = str(stored.dtype)
+    else:
+        store_dtype = store_dtype or 'float32'
+        print(f'🤖 编码 {N} 个文档向量...')
+        scratch.append(os.path.join(OUT_DIR, 'embeddings.scratch.f32'))
+        if workers > 1 and device.type == 'cpu':
+            key = hashlib.sha1('\n'.join([fingerprint] + hashes).encode('utf-8')).hexdigest()
+            full_vecs = embed_docs_sharded(enc_path, N, enc.config.hidden_size, scratch[-1], key,
+                                           workers, encode_batch_size, threads)
+        else:
+            if workers > 1:
+                print('⚠️ 检测到GPU，多进程分片编码只用于CPU，改为单进程编码')
+            full_vecs = embed_texts_to_memmap(enc, tok, iter_docs(), N, scratch[-1], device,
+                                              desc='编码文档', batch_size=encode_batch_size)
+
+        # ===== 第5步：降维 + 压缩存储（可选） =====
+        # 投影矩阵记录在索引中，预测时对查询向量施加同一投影
+        extras = {}
+        projection = None
+        if reduce_dim:
+            projection = fit_pca(full_vecs, reduce_dim)
+            extras['projection'] = projection
+            print(f'📉 PCA降维: {full_vecs.shape[1]} → {projection.shape[1]} 维，'
+                  f'保留能量 {explained_variance(full_vecs, projection):.1%}')
+        
+        if projection is None and store_dtype == 'float32':
+            stored, scale = full_vecs, None
+        else:
+            scratch.append(os.path.join(OUT_DIR, 'embeddings.scratch.stored'))
+            stored, scale = _compress_to_memmap(full_vecs, projection, store_dtype, scratch[-1])
+        if scale is not None:
+            extras['embedding_scale'] = scale
+        
+        if extras:
+            _report_compression(enc, tok, device, symps, full_vecs, stored, scale, extras)
+
+    # ===== 第6步：保存索引 =====
+    # 先写临时文件再原子替换，正在加载索引的预测服务不会读到写了一半的文件
+    if write_npz:
+        tmp_path = INDEX_PATH + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                embeddings=stored,  # (N, hidden_dim) 或降维/量化后的 (N, k)，memmap 分块写入
+                **extras,
+                names=np.array(names, dtype=object),
+                categories=np.array(cats, dtype=object),
+                symptoms=np.array(symps, dtype=object),
+                docs=np.array(list(iter_docs()), dtype=object),
+                idf_terms=idf_terms,  # 症状词表
+                idf_vals=idf_vals,  # IDF值
+                content_hashes=np.array(hashes),  # 每行内容哈希（增量重建用）
+                encoder_fingerprint=np.array([fingerprint])  # 编码器指纹
+            )
+        os.replace(tmp_path, INDEX_PATH)
+        print(f'✅ 索引已保存到: {INDEX_PATH}')
+
+    # 未压缩的内存映射目录（预测服务优先加载，worker共享页缓存、启动无需解压）
+    store_build = write_index_store(
+        INDEX_STORE_PATH,
+        embeddings=stored,
+        names=names,
+        categories=cats,
+        symptoms=symps,
+        docs=iter_docs(),  # 流式写入字符串表
+        idf_terms=idf_terms,
+        idf_vals=idf_vals,
+        dtype=store_dtype,
+        extra_arrays=extras,
+        extra_strings={'content_hashes': hashes, 'encoder_fingerprint': [fingerprint]}
     )
+    print(f'✅ 内存映射索引已保存到: {INDEX_STORE_PATH}')
+
+    # 删除临时 memmap（先释放映射，Windows 下才能删除）
+    del stored, scale, extras
+    full_vecs = None
+    for path in scratch:
+        os.remove(path)
+    shutil.rmtree(ENCODE_CKPT_DIR, ignore_errors=True)  # 分片检查点（只在全部写出后删除）
+
+    # ===== 第7步：构建向量召回索引 =====
+    # 基于预测服务实际加载的向量（刚写出的内存映射目录，反量化后）构建；
+    # 记录目录的 build_id，预测服务在两者一致（本步骤写完）后才加载新索引
+    print(f'🧭 构建向量召回索引 ({vector_index})...')
+    serve_vecs = load_embeddings(open_index(INDEX_STORE_PATH))
+    vindex = build_vector_index(serve_vecs, kind=vector_index)
+    save_vector_index(vindex, VECTOR_INDEX_PATH, *serve_vecs.shape, store_build=store_build)
+    print(f'✅ 向量索引已保存到: {VECTOR_INDEX_PATH}')
+
+def _merge_previous_vectors(prev, hashes, docs, enc, tok, device, batch_size=ENCODE_BATCH_SIZE):
+    """
+    增量重建：复用内容哈希未变的行的向量，只编码新增/变更的行
+    
+    参数：
+        prev (dict): _load_previous_index() 的返回值
+        hashes (list[str]): 当前数据每行的内容哈希（顺序即新索引的顺序）
+        docs (Iterable[str]): 当前数据每行的文档文本（流式，只保留需要重新编码的行）
+        enc / tok / device: 编码器、分词器、设备
+        batch_size (int): 推理batch大小（变更的行通常不多，在主进程中编码）
+    
+    返回：
+        tuple: (stored, scale, extras)，与全量重建的第5步输出格式相同
+    """
+    pos = {h: i for i, h in enumerate(prev['hashes'])}
+    src = np.array([pos.get(h, -1) for h in hashes], dtype=np.int64)
+    changed = np.flatnonzero(src < 0)
+    reused = np.flatnonzero(src >= 0)
+    removed = len(prev['hashes']) - len(set(src[reused].tolist()))
+    print(f'♻️ 增量重建: 复用 {len(reused)} 条，重新编码 {len(changed)} 条（新增或变更），移除旧行 {removed} 条')
+    
+    old, old_scale, projection = prev['embeddings'], prev['embedding_scale'], prev['projection']
+    stored = np.empty((len(hashes), old.shape[1]), dtype=old.dtype)
+    scale = np.empty(len(hashes), dtype=np.float32) if old_scale is not None else None
+    stored[reused] = old[src[reused]]
+    if scale is not None:
+        scale[reused] = old_scale[src[reused]]
+    
+    if len(changed):
+        changed_docs = [doc for i, doc in enumerate(docs) if src[i] < 0] if len(src) else []
+        vecs = embed_texts_with_bert(enc, tok, changed_docs, device, desc='编码变更文档', batch_size=batch_size)
+        vecs = project_queries(vecs, projection)  # 沿用已有的PCA投影（未降维时原样返回）
+        q, s = quantize(vecs, str(old.dtype))
+        stored[changed] = q
+        if scale is not None:
+            scale[changed] = s
+    
+    extras = {}
+    if projection is not None:
+        extras['projection'] = projection
+    if scale is not None:
+        extras['embedding_scale'] = scale
+    return stored, scale, extras
+
+def _compress_to_memmap(vecs, projection, store_dtype, out_path):
+    """
+    分块降维 + 量化，结果写入预分配的 memmap（投影和量化都是逐行操作，分块结果与整体计算相同）
     
-    print(f'✅ 索引已保存到: {INDEX_PATH}')
+    返回：
+        tuple: (stored, scale)，scale 仅 int8 时非 None
+    """
+    n = len(vecs)
+    k = projection.shape[1] if projection is not None else vecs.shape[1]
+    stored = np.memmap(out_path, dtype=store_dtype, mode='w+', shape=(n, k))
+    scale = np.empty(n, dtype=np.float32) if store_dtype == 'int8' else None
+    
+    for s in range(0, n, COMPRESS_CHUNK):
+        q, sc = quantize(project_queries(np.asarray(vecs[s:s + COMPRESS_CHUNK]), projection), store_dtype)
+        stored[s:s + len(q)] = q
+        if scale is not None:
+            scale[s:s + len(q)] = sc
+    stored.flush()
+    return stored, scale
+
+def _report_compression(enc, tok, device, symps, full_vecs, stored, scale, extras, n_queries=500, k=10):
+    """
+    报告降维/量化前后的检索一致率（查询从疾病症状中随机组合1~3个，与线上查询形式一致）
+    """
+    rng = random.Random(SEED)
+    picked = [json.loads(s) for s in rng.choices(symps, k=n_queries)]  # symps 为症状列表的JSON字符串
+    queries = [format_query(rng.sample(s, min(len(s), rng.randint(1, 3)))) for s in picked]
+    full_q = embed_texts_with_bert(enc, tok, queries, device, desc='评估查询')
+    
+    small_q = project_queries(full_q, extras.get('projection'))
+    r = topk_agreement(full_q, full_vecs, small_q, dequantize(stored, scale), k=k)
+    
+    print(f'📊 压缩效果: {full_vecs.nbytes / 1024 / 1024:.1f} MB → {stored.nbytes / 1024 / 1024:.1f} MB，'
+          f'Top-{k}一致率 {r["topk_agreement"]:.2%}，Top-1一致率 {r["top1_agreement"]:.2%}')
+    return r
 
 # ==================== 第7部分：检索和词面匹配 ====================
 
@@ -1029,11 +2277,14 @@ def search(query, topk=5, min_score=0.0, alpha=0.7, lexical='fuzzy', debug=False
             症状: 发热、头痛、全身酸痛
     """
     # ===== 第1步：加载索引 =====
-    if not os.path.exists(INDEX_PATH):
+    # 优先使用内存映射目录，其次旧的npz
+    index_path = INDEX_STORE_PATH if os.path.isdir(INDEX_STORE_PATH) else INDEX_PATH
+    if not os.path.exists(index_path):
         raise FileNotFoundError('索引文件不存在。请先运行 --build_index')
     
-    data = np.load(INDEX_PATH, allow_pickle=True)
-    embs = data['embeddings']  # (N, hidden_dim)
+    data = open_index(index_path)
+    embs = load_embeddings(data)  # (N, hidden_dim)，降维/量化索引已还原为 float32
+    proj = load_projection(data)  # 降维索引的PCA投影（未降维时为None）
     names = data['names']  # (N,)
     cats = data['categories']  # (N,)
     symps = [json.loads(s) for s in data['symptoms']]  # list[list[str]]
@@ -1081,6 +2332,7 @@ def search(query, topk=5, min_score=0.0, alpha=0.7, lexical='fuzzy', debug=False
     # 平均池化 + L2归一化
     q = mean_pooling(out.last_hidden_state, enc_in['attention_mask'])
     q = torch.nn.functional.normalize(q, p=2, dim=1).cpu().numpy()[0]
+    q = project_queries(q, proj)  # 与疾病向量处于同一空间
 
     # ===== 第5步：计算语义相似度 =====
     sims = embs @ q  # (N,) 余弦相似度（因为向量已L2归一化）
@@ -1096,18 +2348,15 @@ def search(query, topk=5, min_score=0.0, alpha=0.7, lexical='fuzzy', debug=False
     # 最终分 = alpha * 语义相似度 + (1-alpha) * 词面匹配分
     final_scores = alpha * sims + (1.0 - alpha) * lex_scores
 
-    # ===== 第8步：排序并返回Top-K =====
-    order = np.argsort(-final_scores)  # 降序排序
+    # ===== 第8步：选出Top-K =====
+    # 先按 min_score 过滤，再用 argpartition 选Top-K（只对K个结果排序）
+    order = select_topk(final_scores, topk, min_score=min_score)
 
     # ===== 第9步：打印结果 =====
     print(f'\n🔍 查询: {" ".join(raw_query_tokens) if raw_query_tokens else query}')
     shown = 0
     
     for idx in order:
-        # 过滤低分结果
-        if final_scores[idx] < min_score:
-            continue
-        
         # 调试模式：打印详细得分
         if debug:
             print(f'{shown+1:>2}. {names[idx]} [{cats[idx]}] '
@@ -1121,10 +2370,6 @@ def search(query, topk=5, min_score=0.0, alpha=0.7, lexical='fuzzy', debug=False
             print(f'    症状: {"、".join(symps[idx][:8])}')
         
         shown += 1
-        
-        # 达到Top-K后停止
-        if shown >= topk:
-            break
     
     # 无结果提示
     if shown == 0:
@@ -1141,9 +2386,30 @@ def main():
         # 训练模型
         python script.py --train --epochs 3
         
+        # 训练模型（bf16混合精度 + 4步梯度累积，对比batch扩大到64）
+        python script.py --train --bf16 --accum_steps 4
+        
+        # 训练模型（加入难负样本，每500步用当前模型重新挖掘）
+        python script.py --train --hard_negatives --hard_neg_refresh 500
+        
+        # 蒸馏4层学生查询编码器（需先 --train；文档向量仍用教师模型，索引不用重建）
+        python script.py --distill --student_layers 4
+        
         # 构建索引
         python script.py --build_index
         
+        # 增量重建索引（只编码新增/变更的疾病）
+        python script.py --build_index --incremental
+        
+        # 构建索引（降维到256维 + int8存储，减小每个worker的内存）
+        python script.py --build_index --reduce_dim 256 --store_dtype int8
+        
+        # 构建索引（8个进程并行编码文档，推理batch=128；中断后重新运行会从检查点继续）
+        python script.py --build_index --encode_workers 8 --encode_batch_size 128
+        
+        # 构建索引（HNSW向量召回，适合几十万条以上的知识库）
+        python script.py --build_index --vector_index hnsw
+        
         # 检索（精确匹配）
         python script.py --query "头痛 发热" --lexical exact --alpha 0.5
         
@@ -1160,12 +2426,46 @@ def main():
                     help='训练双塔编码器（对比学习）')
     ap.add_argument('--build_index', action='store_true',
                     help='用训练后的编码器重建索引（含IDF）')
+    ap.add_argument('--distill', action='store_true',
+                    help='蒸馏小型学生查询编码器（拟合训练后编码器的查询向量）')
+    ap.add_argument('--student_layers', type=int, default=STUDENT_LAYERS,
+                    help=f'学生模型层数（默认{STUDENT_LAYERS}）')
+    ap.add_argument('--vector_index', type=str, default='exact', choices=list(VECTOR_INDEX_KINDS),
+                    help='向量召回索引类型：exact(暴力), ivf(倒排聚类), hnsw(需hnswlib)')
+    ap.add_argument('--incremental', action='store_true',
+                    help='与 --build_index 一起使用：按内容哈希只编码新增/变更的行')
+    ap.add_argument('--write_npz', action='store_true',
+                    help='与 --build_index 一起使用：同时写出旧的 .npz 索引（需要把全部文档读入内存，默认不写）')
+    ap.add_argument('--store_dtype', type=str, default=None, choices=list(STORE_DTYPES),
+                    help='向量存储精度：float32(默认) / float16(体积减半) / int8(每向量缩放，体积1/4)；增量重建默认沿用已有索引')
+    ap.add_argument('--reduce_dim', type=int, default=None,
+                    help='PCA降维后的维度（如256），默认不降维')
+    ap.add_argument('--encode_workers', type=int, default=ENCODE_WORKERS,
+                    help=f'与 --build_index 一起使用：编码文档的进程数，>1 时分片并行编码并支持断点续传（默认{ENCODE_WORKERS}）')
+    ap.add_argument('--encode_batch_size', type=int, default=ENCODE_BATCH_SIZE,
+                    help=f'与 --build_index 一起使用：推理batch大小（默认{ENCODE_BATCH_SIZE}）')
+    ap.add_argument('--encode_threads', type=int, default=None,
+                    help='与 --build_index 一起使用：每个编码进程的torch线程数（默认 CPU核数 / 进程数）')
     ap.add_argument('--query', type=str,
                     help='症状查询文本（空格分隔），支持已带字段标记的输入')
     
     # ===== 训练参数 =====
-    ap.add_argument('--epochs', type=int, default=EPOCHS,
-                    help='训练轮数（默认1）')
+    ap.add_argument('--epochs', type=int, default=None,
+                    help=f'训练轮数（--train 默认{EPOCHS}，--distill 默认{DISTILL_EPOCHS}）')
+    ap.add_argument('--accum_steps', type=int, default=GRAD_ACCUM_STEPS,
+                    help='梯度累积步数，batch内负样本数扩大为 BATCH_SIZE×accum_steps（默认1）')
+    ap.add_argument('--bf16', action='store_true',
+                    help='使用bfloat16自动混合精度训练（CPU也可用）')
+    ap.add_argument('--num_workers', type=int, default=NUM_WORKERS,
+                    help=f'DataLoader worker进程数（默认{NUM_WORKERS}）')
+    ap.add_argument('--no_bucket', action='store_true',
+                    help='关闭按文档长度分桶组batch')
+    ap.add_argument('--hard_negatives', action='store_true',
+                    help='加入难负样本（从已有索引/当前模型检索的易混淆疾病）')
+    ap.add_argument('--hard_neg_per_query', type=int, default=HARD_NEG_PER_QUERY,
+                    help=f'每个query每步抽取的难负样本数（默认{HARD_NEG_PER_QUERY}）')
+    ap.add_argument('--hard_neg_refresh', type=int, default=HARD_NEG_REFRESH,
+                    help=f'每隔多少次参数更新重新挖掘难负样本，0表示不刷新（默认{HARD_NEG_REFRESH}）')
     
     # ===== 检索参数 =====
     ap.add_argument('--topk', type=int, default=5,
@@ -1184,10 +2484,19 @@ def main():
 
     # ===== 执行对应操作 =====
     if args.train:
-        train(epochs=args.epochs)
+        train(epochs=args.epochs or EPOCHS, accum_steps=args.accum_steps, bf16=args.bf16,
+              num_workers=args.num_workers, bucket=not args.no_bucket,
+              hard_negatives=args.hard_negatives, neg_per_query=args.hard_neg_per_query,
+              neg_refresh=args.hard_neg_refresh)
+    
+    if args.distill:
+        distill(n_layers=args.student_layers, epochs=args.epochs or DISTILL_EPOCHS, bf16=args.bf16)
     
     if args.build_index:
-        build_index()
+        build_index(vector_index=args.vector_index, store_dtype=args.store_dtype,
+                    reduce_dim=args.reduce_dim, incremental=args.incremental, write_npz=args.write_npz,
+                    workers=args.encode_workers, encode_batch_size=args.encode_batch_size,
+                    threads=args.encode_threads)
     
     if args.query:
         search(
@@ -1200,7 +2509,7 @@ def main():
         )
     
     # 如果没有任何参数，打印帮助信息
-    if not (args.train or args.build_index or args.query):
+    if not (args.train or args.distill or args.build_index or args.query):
         ap.print_help()
 
 # ==================== 第10部分：程序入口 ====================